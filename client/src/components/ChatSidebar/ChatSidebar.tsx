@@ -345,7 +345,7 @@ const ChatSidebar: React.FC<ChatSidebarProps> = ({
                     textOverflow: 'ellipsis',
                     whiteSpace: 'nowrap'
                   }}>
-                    {group.member_count} miembro{group.member_count !== 1 ? 's' : ''} • {group.last_message || 'Sin mensajes'}
+                    {group.member_count} miembro{group.member_count !== 1 ? 's' : ''} • {group.last_message ? (group.unread ? `${group.unread} sin leer` : 'Mensaje cifrado') : 'Sin mensajes'}
                   </p>
                 </div>
               </div>
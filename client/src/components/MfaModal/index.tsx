@@ -59,7 +59,7 @@ const MfaModal: React.FC<MfaModalProps> = ({ isOpen }) => {
               </div>
               {qrcode && (
                 <img 
-                  src={`data:image/png;base64,${qrcode}`} 
+                  src={`data:image/svg+xml;base64,${qrcode}`} 
                   alt="QR Code para Google Authenticator" 
                   className="qrcode"
                 />
@@ -54,6 +54,7 @@ export type QueryFulfilled = {
 
 export interface MfaConfigureResponse {
   qrcode: string;
+  qrcode_format?: 'svg';
 }
 
 export interface VerifyMfaRequest {
@@ -130,11 +131,19 @@ export interface Group {
 	is_admin: boolean;
 	member_count: number;
 	members: GroupMember[];
-	last_message?: string;
-	last_message_time?: string;
+	last_message?: LastMessageRef | null;
+	last_message_time?: string | null;
+	unread?: number;
 	created_at: string;
 }
 
+// Referencia al último mensaje (el contenido se lee del historial)
+export interface LastMessageRef {
+	id: string;
+	sender_id: string;
+	timestamp: string;
+}
+
 export interface GroupMember {
 	id: string;
 	name: string;
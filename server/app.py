@@ -16,6 +16,17 @@ def create_app():
     app.config['REFRESH_TOKEN_EXPIRATION_TIME'] = os.getenv('REFRESH_TOKEN_EXPIRATION_TIME')
     app.config['ACCESS_TOKEN_EXPIRATION_TIME'] = os.getenv('ACCESS_TOKEN_EXPIRATION_TIME')
 
+    # JSON: ObjectId support for flask.json; routes serialize with utils.json_provider
+    from utils.json_provider import ChatJSONEncoder
+    app.json_encoder = ChatJSONEncoder
+
+    # Per-endpoint time/size metrics, then compression of large responses
+    # (registered in this order so the metrics see the compressed size)
+    from middleware.metrics import init_metrics
+    from middleware.compression import init_compression
+    init_metrics(app)
+    init_compression(app)
+
     # Register blueprints
     from routes.ums import auth_bp
     from routes.chat import chat_bp
@@ -23,6 +34,18 @@ def create_app():
     app.register_blueprint(auth_bp, url_prefix='/api/auth')
     app.register_blueprint(chat_bp, url_prefix='/api/chat')
 
+    # Invalidation of in-memory caches across workers (started in each worker)
+    from utils.invalidation import start_invalidation_bus
+    app.before_first_request(start_invalidation_bus)
+
+    # Delivery of messages stored by other workers to this worker's SSE connections
+    from utils.message_fanout import start_message_fanout
+    app.before_first_request(start_message_fanout)
+
+    # Start the password hashing processes before the first login arrives
+    from hashing.passwords import password_pool
+    app.before_first_request(password_pool.warm_up)
+
     return app
 
 if __name__ == '__main__':
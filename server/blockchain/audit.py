@@ -0,0 +1,335 @@
+'''
+Auditoría completa de la cadena de bloques en paralelo.
+
+Divide la cadena en segmentos de índices, verifica cada segmento en un
+proceso distinto leyendo la colección 'blocks' con un cursor por lotes, y
+luego une los segmentos comprobando que el previous_hash del primer bloque
+de cada segmento coincida con el hash del último bloque del anterior.
+
+Uso (desde la carpeta server):
+    python -m blockchain.audit --workers 8 --segment-size 50000
+    python -m blockchain.audit --chain-id dm:<user_a>:<user_b>
+    python -m blockchain.audit --backend journal --journal-dir ledger_journal
+    python -m blockchain.audit --backend journal --chain-id group:<group_id>
+    python -m blockchain.audit --reindex-messages
+    python -m blockchain.audit --reindex-messages --chain-id dm:<user_a>:<user_b>
+
+--reindex-messages sin --chain-id reconstruye la cadena global y todas las
+subcadenas del backend elegido.
+'''
+
+import argparse
+import os
+import sys
+import time
+from functools import partial
+from multiprocessing import Pool
+from dotenv import load_dotenv
+from pymongo import DESCENDING
+from blockchain.block import Block
+from blockchain.journal import JOURNAL_DIR, iter_segment_records, list_segments, segment_path
+from config.database import get_db_from_uri
+
+load_dotenv()
+
+DEFAULT_SEGMENT_SIZE = 50000
+DEFAULT_BATCH_SIZE = 5000
+
+# Conexión por proceso worker (se abre una sola vez en el initializer del pool)
+_worker_db = None
+
+
+def _init_worker(uri):
+    global _worker_db
+    _worker_db = get_db_from_uri(uri)
+
+
+def _blocks_query(chain_id, query):
+    '''Colección y filtro de la cadena global (chain_id None) o de una subcadena'''
+    if chain_id is None:
+        return "blocks", query
+    return "sub_blocks", dict(query, chain_id=chain_id)
+
+
+def verify_segment(args):
+    '''
+    Verifica los bloques con índice en [start, end] de forma secuencial.
+
+    Args:
+        args (tuple): (start, end, batch_size, chain_id)
+
+    Returns:
+        dict: start, end, count, first_previous_hash, last_hash y broken
+              (None, o (índice, motivo) del primer enlace roto del segmento)
+    '''
+    start, end, batch_size, chain_id = args
+    collection, query = _blocks_query(chain_id, {"index": {"$gte": start, "$lte": end}})
+    cursor = _worker_db[collection].find(
+        query,
+        projection={"_id": 0, "chain_id": 0}
+    ).sort("index", 1).batch_size(batch_size)
+
+    result = {
+        "start": start,
+        "end": end,
+        "count": 0,
+        "first_previous_hash": None,
+        "last_hash": None,
+        "broken": None
+    }
+
+    expected_index = start
+    previous_hash = None
+    for doc in cursor:
+        block = Block.from_dict(doc)
+
+        if block.index != expected_index:
+            result["broken"] = (expected_index, "bloque faltante")
+            return result
+
+        if block.hash != block.calculate_hash():
+            result["broken"] = (block.index, "hash del bloque alterado")
+            return result
+
+        if previous_hash is None:
+            result["first_previous_hash"] = block.previous_hash
+        elif block.previous_hash != previous_hash:
+            result["broken"] = (block.index, "previous_hash no coincide con el bloque anterior")
+            return result
+
+        previous_hash = block.hash
+        result["last_hash"] = block.hash
+        result["count"] += 1
+        expected_index += 1
+
+    if expected_index <= end:
+        result["broken"] = (expected_index, "bloque faltante")
+
+    return result
+
+
+def audit_chain(uri, workers=None, segment_size=DEFAULT_SEGMENT_SIZE, batch_size=DEFAULT_BATCH_SIZE, chain_id=None):
+    '''
+    Audita la cadena completa en paralelo.
+
+    Args:
+        uri (str): URI de MongoDB
+        workers (int): Procesos a usar (por defecto, la cantidad de CPUs)
+        segment_size (int): Bloques por segmento
+        batch_size (int): Tamaño de lote del cursor de cada worker
+        chain_id (str): Subcadena a auditar (conversación o grupo); None = global
+
+    Returns:
+        dict: total_blocks, verified_blocks, valid, first_broken_link
+              (None o {'index', 'reason'}), elapsed_seconds y blocks_per_second
+    '''
+    collection, query = _blocks_query(chain_id, {})
+    head = get_db_from_uri(uri)[collection].find_one(query, sort=[("index", DESCENDING)], projection={"index": 1})
+    total = head["index"] + 1 if head else 0
+
+    segments = [
+        (start, min(start + segment_size, total) - 1, batch_size, chain_id)
+        for start in range(0, total, segment_size)
+    ]
+
+    verified = 0
+    broken = None
+    previous_last_hash = "0"  # previous_hash del bloque génesis
+
+    started = time.perf_counter()
+    with Pool(processes=workers or os.cpu_count(), initializer=_init_worker, initargs=(uri,)) as pool:
+        # imap conserva el orden: los segmentos se unen a medida que terminan
+        for segment in pool.imap(verify_segment, segments):
+            if segment["count"] and segment["first_previous_hash"] != previous_last_hash:
+                broken = (segment["start"], "previous_hash no coincide con el final del segmento anterior")
+            elif segment["broken"]:
+                broken = segment["broken"]
+
+            if broken:
+                verified += max(0, broken[0] - segment["start"])
+                pool.terminate()
+                break
+
+            verified += segment["count"]
+            previous_last_hash = segment["last_hash"]
+    elapsed = time.perf_counter() - started
+
+    return {
+        "total_blocks": total,
+        "verified_blocks": verified,
+        "valid": broken is None,
+        "first_broken_link": {"index": broken[0], "reason": broken[1]} if broken else None,
+        "elapsed_seconds": elapsed,
+        "blocks_per_second": verified / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def verify_journal_segment(path, chain_ids=None):
+    '''
+    Verifica un segmento del journal leyéndolo por mmap. Como un segmento
+    mezcla bloques de varias cadenas, se resume cada cadena por separado
+    (sólo las de chain_ids si se indica).
+
+    Returns:
+        tuple: (path, dict chain_id -> first_index, first_previous_hash,
+                last_index, last_hash, count y broken, offset donde empiezan
+                bytes ilegibles o None)
+    '''
+    chains = {}
+    leido = 0
+    for _, doc, leido in iter_segment_records(path):
+        chain_id = doc.pop("chain_id", None)
+        if chain_ids is not None and chain_id not in chain_ids:
+            continue
+        block = Block.from_dict(doc)
+
+        resumen = chains.get(chain_id)
+        if resumen is None:
+            resumen = chains[chain_id] = {
+                "first_index": block.index,
+                "first_previous_hash": block.previous_hash,
+                "last_index": None,
+                "last_hash": None,
+                "count": 0,
+                "broken": None
+            }
+        if resumen["broken"]:
+            continue
+
+        if block.hash != block.calculate_hash():
+            resumen["broken"] = (block.index, "hash del bloque alterado")
+            continue
+        if resumen["last_index"] is not None:
+            if block.index != resumen["last_index"] + 1:
+                resumen["broken"] = (resumen["last_index"] + 1, "bloque faltante")
+                continue
+            if block.previous_hash != resumen["last_hash"]:
+                resumen["broken"] = (block.index, "previous_hash no coincide con el bloque anterior")
+                continue
+
+        resumen["last_index"] = block.index
+        resumen["last_hash"] = block.hash
+        resumen["count"] += 1
+
+    ilegible = leido if os.path.getsize(path) > leido else None
+    return path, chains, ilegible
+
+
+def audit_journal(directory=JOURNAL_DIR, workers=None, chain_ids=None):
+    '''
+    Audita las cadenas del journal (todas, o sólo las de chain_ids; None es
+    la global): cada segmento se verifica en un proceso y luego se unen, por
+    cadena, el final de un segmento con el comienzo de la siguiente
+    aparición de esa cadena.
+
+    Returns:
+        dict: Igual que audit_chain, con chain_id en first_broken_link
+    '''
+    paths = [segment_path(directory, seq) for seq in list_segments(directory)]
+    verify = partial(verify_journal_segment, chain_ids=set(chain_ids) if chain_ids is not None else None)
+
+    total = 0
+    broken = None
+    ultimos = {}  # chain_id -> (last_index, last_hash)
+
+    started = time.perf_counter()
+    with Pool(processes=workers or os.cpu_count()) as pool:
+        for path, chains, ilegible in pool.imap(verify, paths):
+            for chain_id, resumen in chains.items():
+                esperado_index, esperado_hash = ultimos.get(chain_id, (-1, "0"))
+                if resumen["first_index"] != esperado_index + 1:
+                    broken = (chain_id, esperado_index + 1, "bloque faltante")
+                elif resumen["first_previous_hash"] != esperado_hash:
+                    broken = (chain_id, resumen["first_index"], "previous_hash no coincide con el segmento anterior")
+                elif resumen["broken"]:
+                    broken = (chain_id,) + resumen["broken"]
+
+                total += resumen["count"]
+                if broken:
+                    break
+                ultimos[chain_id] = (resumen["last_index"], resumen["last_hash"])
+
+            # Una cola ilegible sólo es normal en el último segmento (escritura en curso)
+            if not broken and ilegible is not None and path != paths[-1]:
+                broken = (None, None, f"registro corrupto en {os.path.basename(path)} (offset {ilegible})")
+
+            if broken:
+                pool.terminate()
+                break
+    elapsed = time.perf_counter() - started
+
+    return {
+        "total_blocks": total,
+        "verified_blocks": total,
+        "valid": broken is None,
+        "first_broken_link": {"chain_id": broken[0], "index": broken[1], "reason": broken[2]} if broken else None,
+        "elapsed_seconds": elapsed,
+        "blocks_per_second": total / elapsed if elapsed > 0 else 0.0
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Auditoría paralela de la cadena de bloques")
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"), help="URI de MongoDB (por defecto MONGODB_URI)")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos a usar (por defecto, CPUs)")
+    parser.add_argument("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, help="Bloques por segmento")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Tamaño de lote del cursor")
+    parser.add_argument("--backend", choices=["mongo", "journal"], default=os.getenv("LEDGER_BACKEND", "mongo"),
+                        help="Almacenamiento de bloques a auditar (por defecto LEDGER_BACKEND)")
+    parser.add_argument("--journal-dir", default=JOURNAL_DIR, help="Carpeta del journal (backend journal)")
+    parser.add_argument("--chain-id", default=None,
+                        help="Audita o reindexa sólo la subcadena de una conversación o grupo (modo sharded)")
+    parser.add_argument("--reindex-messages", action="store_true",
+                        help="Reconstruye el índice mensaje → bloque en lugar de auditar")
+    args = parser.parse_args(argv)
+
+    if args.reindex_messages:
+        if not args.uri:
+            parser.error("Se requiere --uri o la variable de entorno MONGODB_URI")
+
+        from flask import Flask
+        from blockchain.chain import Blockchain
+        from blockchain.journal import FileJournalStore
+        from blockchain.storage import MongoBlockStore
+
+        store = FileJournalStore(args.journal_dir) if args.backend == "journal" else MongoBlockStore()
+        app = Flask(__name__)
+        app.config["MONGODB_URI"] = args.uri
+        with app.app_context():
+            # Sin --chain-id: la cadena global y todas las subcadenas
+            chain_ids = [args.chain_id] if args.chain_id else [None] + store.chain_ids()
+            if args.chain_id and store.head(args.chain_id) is None:
+                parser.error(f"La subcadena {args.chain_id} no existe")
+            total = 0
+            for chain_id in chain_ids:
+                total += Blockchain(window_size=1, chain_id=chain_id, store=store).reindex_messages()
+        print(f"✅ Mensajes indexados: {total} ({len(chain_ids)} cadenas)")
+        return 0
+
+    if args.backend == "journal":
+        chain_ids = [args.chain_id] if args.chain_id else None
+        report = audit_journal(args.journal_dir, args.workers, chain_ids)
+    else:
+        if not args.uri:
+            parser.error("Se requiere --uri o la variable de entorno MONGODB_URI")
+        report = audit_chain(args.uri, args.workers, args.segment_size, args.batch_size, args.chain_id)
+
+    print(f"🔎 Bloques en la cadena: {report['total_blocks']}")
+    print(f"✅ Bloques verificados: {report['verified_blocks']}")
+    print(f"⏱️ Tiempo: {report['elapsed_seconds']:.2f}s ({report['blocks_per_second']:.0f} bloques/s)")
+
+    if report["valid"]:
+        print("🔒 La cadena es válida")
+        return 0
+
+    link = report["first_broken_link"]
+    if link["index"] is None:
+        print(f"❌ {link['reason']}")
+        return 1
+    cadena = f" de la cadena {link['chain_id']}" if link.get("chain_id") else ""
+    print(f"❌ Primer enlace roto en el bloque {link['index']}{cadena}: {link['reason']}")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,56 @@
 import hashlib
 import json
 from datetime import datetime
-from config.database import get_db
+from blockchain.encoding import canonical_encode
+from blockchain.storage import get_block_store, record_message_reference
+
+# Versiones del cálculo de hash
+HASH_V1_JSON = 1        # json.dumps(sort_keys=True), bloques históricos
+HASH_V2_CANONICAL = 2   # serialización binaria canónica (blockchain/encoding.py)
 
 class Block:
-    def __init__(self, index, data, previous_hash):
+    # Sin __dict__ por instancia: la ventana en memoria de la cadena guarda miles de bloques
+    __slots__ = ("index", "timestamp", "data", "previous_hash", "hash_version", "hash")
+
+    def __init__(self, index, data, previous_hash, timestamp=None, hash=None, hash_version=HASH_V2_CANONICAL):
         self.index = index                          # Posición del bloque en la cadena
-        self.timestamp = datetime.utcnow().isoformat()  # Fecha y hora de creación en formato ISO
-        self.data = data                            # Diccionario con información del mensaje (nombre, fecha_envio, data_enviada)
+        self.timestamp = timestamp or datetime.utcnow().isoformat()  # Fecha y hora de creación en formato ISO
+        self.data = data                            # Payload del bloque (compacto para mensajes: id + digest + participantes)
         self.previous_hash = previous_hash          # Hash del bloque anterior (para encadenamiento)
-        self.hash = self.calculate_hash()           # Hash calculado del bloque actual
+        self.hash_version = hash_version            # Formato usado para calcular el hash
+        self.hash = hash or self.calculate_hash()   # Hash calculado del bloque actual (o el almacenado en BD)
+
+    @classmethod
+    def from_dict(cls, block):
+        """
+        Reconstruye un bloque leído de la base de datos conservando
+        su timestamp y hash originales (para poder validarlos después).
+        """
+        return cls(
+            index=block["index"],
+            data=block["data"],
+            previous_hash=block["previous_hash"],
+            timestamp=block["timestamp"],
+            hash=block["hash"],
+            # Los bloques guardados antes de existir el campo usan JSON
+            hash_version=block.get("hash_version", HASH_V1_JSON)
+        )
 
     def calculate_hash(self):
         """
         Calcula el hash del bloque utilizando SHA-256.
         Incluye: índice, timestamp, data y previous_hash.
         """
+        if self.hash_version == HASH_V2_CANONICAL:
+            block_bytes = canonical_encode([
+                HASH_V2_CANONICAL,
+                self.index,
+                self.timestamp,
+                self.data,
+                self.previous_hash
+            ])
+            return hashlib.sha256(block_bytes).hexdigest()
+
         block_string = json.dumps({
             'index': self.index,
             'timestamp': self.timestamp,
@@ -31,39 +66,22 @@ class Block:
             "timestamp": self.timestamp,
             "data": self.data,
             "previous_hash": self.previous_hash,
-            "hash": self.hash
+            "hash": self.hash,
+            "hash_version": self.hash_version
         }
     
-    def save_to_db(self):
-            """
-            Guarda el bloque en MongoDB.
-            - El bloque completo va a la colección 'blocks'.
-            - Los datos del mensaje (si no es génesis) van a 'message_chain'.
-            """
-            db = get_db()
-            blocks_collection = db["blocks"]
-            messages_collection = db["message_chain"]
-
-            block_data = self.to_dict()
-            blocks_collection.insert_one(block_data)
-
-            # Guardar el mensaje si no es el bloque génesis
-            if not block_data["data"].get("genesis"):
-                try:
-                    message_data = {
-                        "block_index": block_data["index"],
-                        "sender": block_data["data"].get("emisor").get("nombre"),
-                        "timestamp": block_data["data"].get("timestamp"),
-                        "message_encrypted": block_data["data"].get("contenido_cifrado"),
-                        "hash": block_data["hash"],
-                        "previous_hash": block_data["previous_hash"]
-                    }
-
-                    # Verificamos que todos los campos estén presentes
-                    if None in message_data.values():
-                        raise ValueError("Faltan campos en el mensaje seguro", block_data["data"])
-
-                    messages_collection.insert_one(message_data)
+    def save_to_db(self, store=None, chain_id=None):
+        """
+        Guarda el bloque en el almacenamiento configurado (LEDGER_BACKEND:
+        MongoDB por defecto, o el journal en archivo).
+        - Si el bloque registra un mensaje, su referencia (id + digest,
+          nunca el contenido cifrado) va a 'message_chain' en MongoDB.
 
-                except Exception as e:
-                    print(f"❌ Error al guardar mensaje seguro: {e}")
+        Si ya existe un bloque con el mismo índice (otro hilo o worker
+        ganó la carrera) se propaga BlockConflictError para que la cadena
+        reintente el append sobre la nueva cabeza.
+        """
+        store = store or get_block_store()
+        block_data = self.to_dict()
+        store.append(block_data, chain_id)
+        record_message_reference(block_data, chain_id)
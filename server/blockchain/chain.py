@@ -1,76 +1,347 @@
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from collections import deque
 from blockchain.block import Block
+from blockchain.storage import BlockConflictError, ensure_message_chain_index, get_block_store
 from config.database import get_db
 
+# Número máximo de reintentos cuando otro hilo/worker gana la carrera por el mismo índice
+APPEND_MAX_RETRIES = int(os.getenv('BLOCKCHAIN_APPEND_RETRIES', 25))
+
+# Cantidad de bloques recientes que se mantienen en memoria; el resto se lee de BD bajo demanda
+WINDOW_SIZE = int(os.getenv('BLOCKCHAIN_WINDOW_SIZE', 1000))
+
+
+class ChainAppendError(Exception):
+    """No se pudo agregar el bloque tras agotar los reintentos de compare-and-set"""
+
+
 class Blockchain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]  # Inicia la cadena con el bloque génesis
+    def __init__(self, window_size=WINDOW_SIZE, chain_id=None, store=None):
+        # Ventana acotada con la cola de la cadena; la fuente de verdad es el almacenamiento
+        self.chain = deque(maxlen=window_size)
+        # None = cadena global; si no, subcadena de una conversación o grupo
+        self.chain_id = chain_id
+        # Almacenamiento de bloques (LEDGER_BACKEND: MongoDB por defecto o journal en archivo)
+        self._store = store
+        self._lock = threading.Lock()
+        self._ready = False
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_block_store()
+        return self._store
+
+    def _ensure_ready(self):
+        """
+        Prepara el almacenamiento la primera vez que se usa (requiere app
+        context: 'message_chain' está en MongoDB con cualquier backend):
+        - El append del almacenamiento es atómico por índice (índice único en
+          MongoDB, flock en el journal): es el compare-and-set.
+        - Índice de 'message_chain' (en MongoDB con cualquier backend).
+        - Bloque génesis compartido por todos los workers.
+        - Carga en la ventana la cola de la cadena que ya existe en BD.
+        """
+        if self._ready:
+            return
+
+        with self._lock:
+            if self._ready:
+                return
+
+            self.store.ensure_ready(self.chain_id)
+            ensure_message_chain_index(get_db())
+
+            if self.store.get(0, self.chain_id) is None:
+                try:
+                    self.create_genesis_block().save_to_db(self.store, self.chain_id)
+                except BlockConflictError:
+                    pass  # Otro worker creó el génesis primero
+
+            self._ready = True
+
+        self.sync_from_db()
 
     def load_chain_from_db(self):
         """
         Carga todos los bloques desde la base de datos MongoDB en orden.
         Si no hay bloques, crea el bloque génesis.
+
+        Devuelve una lista completa: usar sólo para cadenas pequeñas,
+        para recorrer la cadena entera preferir iter_blocks().
         """
-        db = get_db()
-        blocks_collection = db["blocks"]
-        bloques = list(blocks_collection.find().sort("index", 1))  # Asegura orden
-
-        if not bloques:
-            genesis = self.create_genesis_block()
-            genesis.save_to_db()
-            return [genesis]
-        else:
-            return [Block(
-                index=block["index"],
-                data=block["data"],
-                previous_hash=block["previous_hash"]
-            ) for block in bloques]
+        return list(self.iter_blocks())
+
+    def iter_blocks(self, start=0, end=None):
+        """
+        Recorre los bloques en orden de índice sin cargarlos todos en
+        memoria (cursor por lotes en MongoDB, mmap en el journal).
+
+        Args:
+            start (int): Primer índice (incluido)
+            end (int): Último índice (incluido); None = hasta la cabeza
+        """
+        self._ensure_ready()
+        for block in self.store.iter_range(start, end, self.chain_id):
+            yield Block.from_dict(block)
+
+    def sync_from_db(self):
+        """
+        Agrega a la ventana los bloques que otros hilos o workers escribieron
+        en BD desde la última sincronización. Los bloques más antiguos salen
+        de la ventana automáticamente (deque con maxlen).
+
+        Sólo se leen los bloques que caben en la ventana: si otros workers
+        agregaron más que eso, la ventana se vacía y se carga la cola.
+        """
+        self._ensure_ready()
+
+        with self._lock:
+            head = self.store.head(self.chain_id)
+            if head is None:
+                return self.chain
+
+            cola = max(0, head["index"] - self.chain.maxlen + 1)
+            siguiente = self.chain[-1].index + 1 if self.chain else 0
+            if siguiente < cola:
+                # Hueco entre la ventana y la cola: lo anterior ya no sirve
+                self.chain.clear()
+                siguiente = cola
+            elif siguiente > head["index"]:
+                return self.chain
+
+            for block in self.store.iter_range(siguiente, head["index"], self.chain_id):
+                if block["index"] == siguiente:
+                    self.chain.append(Block.from_dict(block))
+                    siguiente += 1
+
+        return self.chain
 
     def create_genesis_block(self):
         """
         Crea el primer bloque de la cadena.
         Este bloque no tiene datos reales ni bloque anterior.
+        En las subcadenas el génesis fija el chain_id dentro del hash.
         """
+        if self.chain_id is not None:
+            return Block(0, {"genesis": True, "chain_id": self.chain_id}, "0")
         return Block(0, {"genesis": True}, "0")
 
     def get_latest_block(self):
         """
-        Devuelve el último bloque en la cadena.
+        Devuelve el último bloque de la cadena según la BD (la cabeza compartida).
+        """
+        self._ensure_ready()
+        return Block.from_dict(self.store.head(self.chain_id))
+
+    def get_block(self, index):
+        """
+        Devuelve el bloque con el índice indicado: desde la ventana si está
+        en memoria, o leyéndolo de BD si es más antiguo.
+        """
+        self._ensure_ready()
+        window = self.chain
+        if window and window[0].index <= index <= window[-1].index:
+            try:
+                block = window[index - window[0].index]
+                if block.index == index:
+                    return block
+            except IndexError:
+                pass  # La ventana avanzó mientras se leía
+
+        block = self.store.get(index, self.chain_id)
+        return Block.from_dict(block) if block else None
+
+    def locate_message(self, message_id):
+        """
+        Busca el bloque que registra un mensaje usando el índice de
+        'message_chain' (sin recorrer la cadena).
+
+        Returns:
+            dict: block, previous y next (índice y hashes de los vecinos,
+                  None en los extremos); None si el mensaje no está registrado
         """
-        return self.chain[-1]
+        self._ensure_ready()
+        entry = get_db()["message_chain"].find_one(
+            {"message_id": str(message_id), "chain_id": self.chain_id},
+            projection={"block_index": 1}
+        )
+        if not entry:
+            return None
+
+        return self.block_with_neighbors(entry["block_index"])
+
+    def block_with_neighbors(self, index):
+        """
+        Devuelve el bloque indicado junto con el índice y hash de sus vecinos.
+
+        Returns:
+            dict: block, previous y next (None en los extremos); None si no existe
+        """
+        block = self.get_block(index)
+        if block is None:
+            return None
+
+        previous = None
+        if block.index > 0:
+            anterior = self.get_block(block.index - 1)
+            previous = {"index": anterior.index, "hash": anterior.hash} if anterior else None
+
+        following = None
+        siguiente = self.get_block(block.index + 1)
+        if siguiente:
+            following = {"index": siguiente.index, "hash": siguiente.hash, "previous_hash": siguiente.previous_hash}
+
+        return {"block": block, "previous": previous, "next": following}
+
+    def reindex_messages(self):
+        """
+        Reconstruye el índice mensaje → bloque a partir de los bloques
+        (para bloques registrados antes de que existiera el índice).
+
+        Returns:
+            int: Cantidad de mensajes indexados
+        """
+        self._ensure_ready()
+        db = get_db()
+
+        total = 0
+        for doc in self.store.iter_range(0, None, self.chain_id):
+            # Los bloques de envíos múltiples registran varios mensajes
+            message_ids = doc["data"].get("mensajes_ids") or [doc["data"].get("mensaje_id")]
+            if not message_ids[0]:
+                continue
+            participantes = block_participants(doc["data"])
+            for message_id in message_ids:
+                filtro = {"block_index": doc["index"], "chain_id": self.chain_id}
+                if len(message_ids) > 1:
+                    filtro["message_id"] = message_id
+                db["message_chain"].update_one(
+                    filtro,
+                    {"$set": {
+                        "message_id": message_id,
+                        "sender_id": participantes[0] if participantes else None,
+                        "timestamp": doc["timestamp"],
+                        "digest": doc["data"].get("digest"),
+                        "hash": doc["hash"],
+                        "previous_hash": doc["previous_hash"]
+                    }},
+                    upsert=True
+                )
+                total += 1
+
+        return total
+
+    def length(self):
+        """
+        Devuelve la cantidad total de bloques (índice de la cabeza + 1).
+        """
+        return self.get_latest_block().index + 1
 
     def add_block(self, data):
         """
         Agrega un nuevo bloque con los datos proporcionados.
         Se encadena al bloque anterior con su hash.
+
+        El append es un compare-and-set: se lee la cabeza compartida, se
+        construye el bloque index+1 y se inserta. Si otro hilo o worker ya
+        ocupó ese índice, el almacenamiento rechaza la inserción y se
+        reintenta sobre la nueva cabeza.
         """
-        prev_block = self.get_latest_block()
-        new_block = Block(len(self.chain), data, prev_block.hash)
-        self.chain.append(new_block)
-        new_block.save_to_db()
+        self._ensure_ready()
+
+        for intento in range(APPEND_MAX_RETRIES):
+            prev_block = self.get_latest_block()
+            new_block = Block(prev_block.index + 1, data, prev_block.hash)
+            try:
+                new_block.save_to_db(self.store, self.chain_id)
+            except BlockConflictError:
+                # Perdimos la carrera: esperar un poco (con jitter) y reintentar
+                time.sleep(random.uniform(0, 0.005 * (intento + 1)))
+                continue
+
+            self.sync_from_db()
+            return new_block
+
+        raise ChainAppendError(
+            f"No se pudo agregar el bloque tras {APPEND_MAX_RETRIES} intentos"
+        )
 
     def is_chain_valid(self):
         """
         Verifica que toda la cadena sea válida:
         - Hash del bloque correcto.
         - Hash del bloque anterior coincide.
-        """
-        for i in range(1, len(self.chain)):
-            current = self.chain[i]
-            previous = self.chain[i - 1]
 
+        Recorre la cadena desde BD guardando sólo el bloque anterior.
+        """
+        previous = None
+        for current in self.iter_blocks():
             if current.hash != current.calculate_hash():
                 return False  # El hash actual fue modificado
 
-            if current.previous_hash != previous.hash:
+            if previous is not None and current.previous_hash != previous.hash:
                 return False  # El enlace entre bloques fue alterado
 
+            previous = current
+
         return True  # La cadena es válida
+
+    def memory_stats(self):
+        """
+        Reporta el uso de memoria de la ventana de bloques y del proceso.
+        El tamaño de la ventana es aproximado (sys.getsizeof de bloques y campos).
+        """
+        window = list(self.chain)
+        window_bytes = 0
+        for block in window:
+            window_bytes += sys.getsizeof(block)
+            window_bytes += sys.getsizeof(block.timestamp) + sys.getsizeof(block.hash)
+            window_bytes += sys.getsizeof(block.previous_hash) + _deep_sizeof(block.data)
+
+        return {
+            "window_blocks": len(window),
+            "window_capacity": self.chain.maxlen,
+            "window_bytes": window_bytes,
+            # En Linux ru_maxrss está en KB
+            "process_max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+
     def to_list(self):
         """
         Devuelve la blockchain completa como una lista de diccionarios (JSON serializable)
         """
-        return [block.to_dict() for block in self.chain]
-    
+        return [block.to_dict() for block in self.iter_blocks()]
+
+
+def block_participants(data):
+    """
+    Devuelve los IDs de los participantes registrados en el payload de un
+    bloque de mensaje (formato compacto o el formato v2 con emisor/receptor).
+    """
+    if "participantes" in data:
+        return list(data["participantes"])
+    return [
+        persona["id"]
+        for persona in (data.get("emisor"), data.get("receptor"))
+        if isinstance(persona, dict) and persona.get("id")
+    ]
+
+
+def _deep_sizeof(value):
+    """Tamaño aproximado de un payload de bloque (dicts/listas anidados)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_sizeof(item) for item in value)
+    return size
+
 
 # ✅ Instancia global del blockchain
-blockchain = Blockchain()
\ No newline at end of file
+blockchain = Blockchain()
@@ -0,0 +1,192 @@
+import hashlib
+import struct
+
+# Etiquetas de tipo de la serialización canónica
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT = b'I'
+_FLOAT = b'D'
+_STR = b'S'
+_BYTES = b'B'
+_LIST = b'L'
+_MAP = b'M'
+
+_LEN = struct.Struct('>I')
+_DOUBLE = struct.Struct('>d')
+
+
+def canonical_encode(value):
+    """
+    Serializa un valor a bytes de forma canónica (determinista).
+
+    Cada valor se escribe como etiqueta de tipo + longitud + contenido, y los
+    diccionarios se ordenan por la codificación de sus claves. A diferencia de
+    json.dumps(sort_keys=True) no hay escapes ni formateo de texto, y el mismo
+    valor produce siempre los mismos bytes.
+
+    Args:
+        value: None, bool, int, float, str, bytes, list/tuple o dict (claves str)
+
+    Returns:
+        bytes: Representación canónica
+    """
+    out = bytearray()
+    _encode_into(value, out)
+    return bytes(out)
+
+
+def _encode_into(value, out):
+    if value is None:
+        out += _NONE
+    elif value is True:
+        out += _TRUE
+    elif value is False:
+        out += _FALSE
+    elif isinstance(value, int):
+        raw = str(value).encode('ascii')
+        out += _INT + _LEN.pack(len(raw)) + raw
+    elif isinstance(value, float):
+        out += _FLOAT + _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode('utf-8')
+        out += _STR + _LEN.pack(len(raw)) + raw
+    elif isinstance(value, (bytes, bytearray)):
+        out += _BYTES + _LEN.pack(len(value)) + value
+    elif isinstance(value, (list, tuple)):
+        out += _LIST + _LEN.pack(len(value))
+        for item in value:
+            _encode_into(item, out)
+    elif isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise TypeError(f"Las claves deben ser str, no {type(key).__name__}")
+            items.append((canonical_encode(key), item))
+        items.sort(key=lambda pair: pair[0])
+
+        out += _MAP + _LEN.pack(len(items))
+        for encoded_key, item in items:
+            out += encoded_key
+            _encode_into(item, out)
+    else:
+        raise TypeError(f"Tipo no soportado en la serialización canónica: {type(value).__name__}")
+
+
+def canonical_decode(data):
+    """
+    Operación inversa de canonical_encode.
+
+    Args:
+        data (bytes): Bytes producidos por canonical_encode
+
+    Returns:
+        El valor decodificado (las tuplas vuelven como listas)
+    """
+    value, offset = _decode_at(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError("Bytes sobrantes tras el valor canónico")
+    return value
+
+
+def _decode_at(buf, offset):
+    tag = bytes(buf[offset:offset + 1])
+    offset += 1
+
+    if tag == _NONE:
+        return None, offset
+    if tag == _TRUE:
+        return True, offset
+    if tag == _FALSE:
+        return False, offset
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(buf, offset)[0], offset + _DOUBLE.size
+
+    (length,) = _LEN.unpack_from(buf, offset)
+    offset += _LEN.size
+
+    if tag == _INT:
+        return int(bytes(buf[offset:offset + length]).decode('ascii')), offset + length
+    if tag == _STR:
+        return bytes(buf[offset:offset + length]).decode('utf-8'), offset + length
+    if tag == _BYTES:
+        return bytes(buf[offset:offset + length]), offset + length
+    if tag == _LIST:
+        items = []
+        for _ in range(length):
+            item, offset = _decode_at(buf, offset)
+            items.append(item)
+        return items, offset
+    if tag == _MAP:
+        result = {}
+        for _ in range(length):
+            key, offset = _decode_at(buf, offset)
+            result[key], offset = _decode_at(buf, offset)
+        return result, offset
+
+    raise ValueError(f"Etiqueta desconocida en la serialización canónica: {tag!r}")
+
+
+def message_digest(ciphertext_b64, signature):
+    """
+    Huella SHA-256 de un mensaje tal como quedó guardado en 'messages'.
+
+    Args:
+        ciphertext_b64 (str): Campo 'ciphertext' del mensaje
+        signature (str): Campo 'digital_signature' del mensaje
+
+    Returns:
+        str: Digest hexadecimal
+    """
+    return hashlib.sha256(canonical_encode([ciphertext_b64, signature])).hexdigest()
+
+
+def compact_message_payload(message_id, ciphertext_b64, signature, participant_ids, group_id=None):
+    """
+    Construye el payload compacto de un bloque de mensaje: en lugar de copiar
+    el contenido cifrado, la firma y los datos de los usuarios, el bloque sólo
+    referencia el mensaje por id y por el hash de lo almacenado.
+
+    Args:
+        message_id (str): ID del mensaje en la colección 'messages'
+        ciphertext_b64 (str): Contenido cifrado en base64
+        signature (str): Firma digital del contenido cifrado
+        participant_ids (list): IDs de los participantes (el emisor primero)
+        group_id (str): ID del grupo si es un mensaje grupal
+
+    Returns:
+        dict: Payload del bloque
+    """
+    payload = {
+        "tipo": "mensaje_seguro_v3",
+        "mensaje_id": str(message_id),
+        "digest": message_digest(ciphertext_b64, signature),
+        "participantes": [str(participant_id) for participant_id in participant_ids]
+    }
+    if group_id is not None:
+        payload["grupo_id"] = str(group_id)
+    return payload
+
+
+def multicast_message_payload(message_ids, ciphertext_b64, signature, sender_id, recipient_ids):
+    """
+    Payload de un bloque que registra varios mensajes de un envío múltiple:
+    todos comparten contenido cifrado y firma, así que un solo digest cubre
+    a todos.
+
+    Args:
+        message_ids (list): IDs de los mensajes en 'messages' (uno por destinatario)
+        ciphertext_b64 (str): Contenido cifrado en base64
+        signature (str): Firma digital del contenido cifrado
+        sender_id (str): ID del emisor
+        recipient_ids (list): IDs de los destinatarios, en el orden de message_ids
+
+    Returns:
+        dict: Payload del bloque
+    """
+    return {
+        "tipo": "mensaje_multicast_v1",
+        "mensajes_ids": [str(message_id) for message_id in message_ids],
+        "digest": message_digest(ciphertext_b64, signature),
+        "participantes": [str(sender_id)] + [str(recipient_id) for recipient_id in recipient_ids]
+    }
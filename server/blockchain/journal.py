@@ -0,0 +1,308 @@
+'''
+Almacenamiento de bloques en un journal local de solo-append.
+
+Los bloques (de la cadena global y de las subcadenas) se escriben en
+archivos de segmento como registros con prefijo de longitud:
+
+    [longitud: 4 bytes BE][crc32: 4 bytes BE][bloque en serialización canónica]
+
+Cuando un segmento supera LEDGER_SEGMENT_MAX_BYTES se abre el siguiente
+(segment-00000001.log, ...). El fsync se hace por lotes (cada
+LEDGER_FSYNC_BATCH registros o LEDGER_FSYNC_INTERVAL segundos; un hilo de
+fondo hace el fsync de los registros que quedan pendientes cuando dejan de
+llegar bloques) y las lecturas usan mmap. Varios procesos del mismo host pueden agregar bloques:
+el append se serializa con flock sobre el archivo de lock y cada proceso
+se pone al día leyendo lo que los demás escribieron.
+'''
+
+import atexit
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from blockchain.encoding import canonical_encode, canonical_decode
+from blockchain.storage import BlockStore, BlockConflictError
+
+JOURNAL_DIR = os.getenv('LEDGER_JOURNAL_DIR', 'ledger_journal')
+SEGMENT_MAX_BYTES = int(os.getenv('LEDGER_SEGMENT_MAX_BYTES', 64 * 1024 * 1024))
+FSYNC_BATCH = int(os.getenv('LEDGER_FSYNC_BATCH', 64))
+FSYNC_INTERVAL = float(os.getenv('LEDGER_FSYNC_INTERVAL', 0.05))
+
+_HEADER = struct.Struct('>II')  # longitud del payload, crc32 del payload
+
+# Posición de un bloque empaquetada en un entero: segmento << 40 | offset
+_OFFSET_BITS = 40
+_OFFSET_MASK = (1 << _OFFSET_BITS) - 1
+
+
+def segment_path(directory, seq):
+    return os.path.join(directory, f"segment-{seq:08d}.log")
+
+
+def list_segments(directory):
+    '''Devuelve los números de segmento existentes en orden'''
+    if not os.path.isdir(directory):
+        return []
+    seqs = []
+    for name in os.listdir(directory):
+        if name.startswith("segment-") and name.endswith(".log"):
+            seqs.append(int(name[len("segment-"):-len(".log")]))
+    return sorted(seqs)
+
+
+def iter_segment_records(path, start_offset=0):
+    '''
+    Recorre los registros completos de un segmento leyendo por mmap.
+    Se detiene en la cola si el último registro está incompleto o su CRC
+    no coincide (escritura interrumpida o todavía en curso).
+
+    Yields:
+        tuple: (offset, bloque (dict), offset del siguiente registro)
+    '''
+    size = os.path.getsize(path)
+    if size <= start_offset:
+        return
+
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = start_offset
+            while offset + _HEADER.size <= size:
+                length, crc = _HEADER.unpack_from(mm, offset)
+                end = offset + _HEADER.size + length
+                if end > size:
+                    break
+                payload = mm[offset + _HEADER.size:end]
+                if zlib.crc32(payload) != crc:
+                    break
+                yield offset, canonical_decode(payload), end
+                offset = end
+
+
+class FileJournalStore(BlockStore):
+    def __init__(self, directory=JOURNAL_DIR):
+        self.directory = directory
+        self._lock = threading.RLock()
+        self._opened = False
+
+        # Posiciones de los bloques por cadena: chain_id -> array de posiciones empaquetadas
+        self._positions = {}
+        # Hasta dónde se leyó el journal (segmento, offset)
+        self._scan_seq = 0
+        self._scan_offset = 0
+
+        self._lock_fd = None
+        self._write_fd = None
+        self._write_seq = None
+        self._pending_fsync = 0
+        self._last_fsync = time.monotonic()
+        self._maps = {}
+
+        # Hilo que hace el fsync de lo pendiente tras FSYNC_INTERVAL sin appends
+        self._dirty = threading.Event()
+        self._flusher_pid = None
+
+    # --- apertura y puesta al día ---
+
+    def _open(self):
+        if self._opened:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(self.directory, "journal.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        segments = list_segments(self.directory)
+        self._scan_seq = segments[0] if segments else 0
+        self._scan_offset = 0
+        self._opened = True
+        self._catch_up()
+        atexit.register(self.flush)
+
+    def _catch_up(self, repair=False):
+        '''
+        Registra los bloques escritos (por este u otros procesos) desde la
+        última lectura. Con repair=True (sólo con el flock tomado) se trunca
+        una cola incompleta que dejó un proceso que murió a medio escribir.
+        '''
+        for seq in list_segments(self.directory):
+            if seq < self._scan_seq:
+                continue
+            if seq > self._scan_seq:
+                self._scan_seq, self._scan_offset = seq, 0
+
+            path = segment_path(self.directory, seq)
+            for offset, doc, next_offset in iter_segment_records(path, self._scan_offset):
+                self._register(doc, seq, offset)
+                self._scan_offset = next_offset
+
+            if repair and os.path.getsize(path) > self._scan_offset:
+                print(f"⚠️ Journal: truncando cola incompleta de {path} en {self._scan_offset}")
+                os.truncate(path, self._scan_offset)
+
+    def _register(self, doc, seq, offset):
+        positions = self._positions.setdefault(doc.get("chain_id"), array('Q'))
+        if doc["index"] == len(positions):
+            positions.append((seq << _OFFSET_BITS) | offset)
+
+    # --- lectura ---
+
+    def _map(self, seq, needed):
+        mm = self._maps.get(seq)
+        if mm is None or len(mm) < needed:
+            if mm is not None:
+                mm.close()
+            with open(segment_path(self.directory, seq), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[seq] = mm
+        return mm
+
+    def _read_at(self, position):
+        seq, offset = position >> _OFFSET_BITS, position & _OFFSET_MASK
+        with self._lock:
+            mm = self._map(seq, offset + _HEADER.size)
+            length, _ = _HEADER.unpack_from(mm, offset)
+            mm = self._map(seq, offset + _HEADER.size + length)
+            payload = mm[offset + _HEADER.size:offset + _HEADER.size + length]
+
+        doc = canonical_decode(payload)
+        doc.pop("chain_id", None)
+        return doc
+
+    def _position(self, index, chain_id):
+        with self._lock:
+            self._open()
+            positions = self._positions.get(chain_id)
+            if positions is None or index >= len(positions):
+                self._catch_up()
+                positions = self._positions.get(chain_id)
+            if positions is None or not 0 <= index < len(positions):
+                return None
+            return positions[index]
+
+    # --- interfaz BlockStore ---
+
+    def ensure_ready(self, chain_id=None):
+        with self._lock:
+            self._open()
+
+    def head(self, chain_id=None):
+        with self._lock:
+            self._open()
+            self._catch_up()
+            positions = self._positions.get(chain_id)
+            if not positions:
+                return None
+            position = positions[-1]
+        return self._read_at(position)
+
+    def get(self, index, chain_id=None):
+        position = self._position(index, chain_id)
+        return self._read_at(position) if position is not None else None
+
+    def iter_range(self, start=0, end=None, chain_id=None):
+        with self._lock:
+            self._open()
+            self._catch_up()
+            positions = self._positions.get(chain_id, array('Q'))
+            last = len(positions) - 1 if end is None else min(end, len(positions) - 1)
+            snapshot = positions[start:last + 1] if start <= last else array('Q')
+
+        for position in snapshot:
+            yield self._read_at(position)
+
+    def chain_ids(self):
+        with self._lock:
+            self._open()
+            self._catch_up()
+            return sorted(chain_id for chain_id in self._positions if chain_id is not None)
+
+    def append(self, block_data, chain_id=None):
+        doc = dict(block_data, chain_id=chain_id)
+        payload = canonical_encode(doc)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._lock:
+            self._open()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                self._catch_up(repair=True)
+
+                positions = self._positions.get(chain_id)
+                if doc["index"] != (len(positions) if positions else 0):
+                    raise BlockConflictError(f"El índice {doc['index']} ya existe en la cadena")
+
+                seq, offset = self._writable_segment(len(record))
+                os.write(self._write_fd, record)
+                self._register(doc, seq, offset)
+                self._scan_offset = offset + len(record)
+                self._maybe_fsync()
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # --- escritura ---
+
+    def _writable_segment(self, record_size):
+        '''Devuelve (segmento, offset) donde escribir, rotando si el actual se llenó'''
+        seq, offset = self._scan_seq, self._scan_offset
+        if offset > 0 and offset + record_size > SEGMENT_MAX_BYTES:
+            self._fsync()
+            seq, offset = seq + 1, 0
+            self._scan_seq, self._scan_offset = seq, 0
+
+        if self._write_seq != seq:
+            if self._write_fd is not None:
+                self._fsync()
+                os.close(self._write_fd)
+            nuevo = not os.path.exists(segment_path(self.directory, seq))
+            self._write_fd = os.open(segment_path(self.directory, seq), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._write_seq = seq
+            if nuevo:
+                # Persistir la entrada del directorio del segmento nuevo
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+
+        return seq, offset
+
+    def _maybe_fsync(self):
+        self._pending_fsync += 1
+        if (self._pending_fsync >= FSYNC_BATCH
+                or time.monotonic() - self._last_fsync >= FSYNC_INTERVAL):
+            self._fsync()
+        else:
+            # Si no llega otro append, el hilo de fondo respeta el intervalo
+            self._ensure_flusher()
+            self._dirty.set()
+
+    def _ensure_flusher(self):
+        # Uno por proceso: tras un fork el hilo del padre no existe en el hijo
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        self._dirty = threading.Event()
+        threading.Thread(target=self._flush_loop, name='journal-fsync', daemon=True).start()
+
+    def _flush_loop(self):
+        dirty = self._dirty
+        while True:
+            dirty.wait()
+            time.sleep(FSYNC_INTERVAL)
+            with self._lock:
+                if time.monotonic() - self._last_fsync >= FSYNC_INTERVAL:
+                    self._fsync()
+                if not self._pending_fsync:
+                    dirty.clear()
+
+    def _fsync(self):
+        if self._write_fd is not None and self._pending_fsync:
+            os.fsync(self._write_fd)
+        self._pending_fsync = 0
+        self._last_fsync = time.monotonic()
+
+    def flush(self):
+        '''Fuerza el fsync de los registros pendientes'''
+        with self._lock:
+            self._fsync()
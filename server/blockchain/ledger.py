@@ -0,0 +1,211 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from blockchain.chain import Blockchain, blockchain
+from blockchain.encoding import canonical_encode
+from config.database import get_db
+
+# 'global' = una sola cadena para todo; 'sharded' = subcadena por conversación/grupo + anclas globales
+LEDGER_MODE = os.getenv('LEDGER_MODE', 'global')
+
+# Segundos entre bloques ancla en la cadena global (modo sharded)
+ANCHOR_INTERVAL = int(os.getenv('LEDGER_ANCHOR_INTERVAL', 60))
+
+# Subcadenas que se mantienen instanciadas en memoria y bloques en la ventana de cada una
+SUBCHAIN_CACHE_SIZE = int(os.getenv('LEDGER_SUBCHAIN_CACHE_SIZE', 1024))
+SUBCHAIN_WINDOW_SIZE = int(os.getenv('LEDGER_SUBCHAIN_WINDOW_SIZE', 16))
+
+
+def direct_chain_id(user_a, user_b):
+    """ID de la subcadena de una conversación directa (independiente del orden)"""
+    return "dm:" + ":".join(sorted([str(user_a), str(user_b)]))
+
+
+def group_chain_id(group_id):
+    """ID de la subcadena de un grupo"""
+    return f"group:{group_id}"
+
+
+def multicast_chain_id(sender_id):
+    """ID de la subcadena de los envíos múltiples de un usuario"""
+    return f"multicast:{sender_id}"
+
+
+class Ledger:
+    """
+    Punto de entrada al registro de mensajes.
+
+    En modo 'global' todo se agrega a la cadena global. En modo 'sharded'
+    cada conversación o grupo tiene su propia cadena de hashes (colección
+    'sub_blocks'), de modo que conversaciones no relacionadas agregan bloques
+    en paralelo; periódicamente un bloque ancla en la cadena global
+    compromete las cabezas de las subcadenas que avanzaron.
+    """
+
+    def __init__(self, mode=LEDGER_MODE, global_chain=blockchain):
+        self.mode = mode
+        self.global_chain = global_chain
+        self._subchains = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_anchor_check = 0.0
+
+    @property
+    def sharded(self):
+        return self.mode == 'sharded'
+
+    def chain_for(self, chain_id):
+        """
+        Devuelve la cadena correspondiente a un chain_id (None = global),
+        reutilizando las instancias recientes (LRU acotado).
+        """
+        if chain_id is None:
+            return self.global_chain
+
+        with self._lock:
+            chain = self._subchains.get(chain_id)
+            if chain is None:
+                chain = Blockchain(window_size=SUBCHAIN_WINDOW_SIZE, chain_id=chain_id)
+                self._subchains[chain_id] = chain
+                if len(self._subchains) > SUBCHAIN_CACHE_SIZE:
+                    self._subchains.popitem(last=False)
+            else:
+                self._subchains.move_to_end(chain_id)
+            return chain
+
+    def append(self, data, chain_id=None):
+        """
+        Registra un payload. En modo sharded va a la subcadena indicada;
+        en modo global (o sin chain_id) va a la cadena global.
+
+        Returns:
+            Block: El bloque agregado
+        """
+        if not self.sharded or chain_id is None:
+            return self.global_chain.add_block(data)
+
+        block = self.chain_for(chain_id).add_block(data)
+        self._record_head(chain_id, block)
+        self.maybe_anchor()
+        return block
+
+    def record(self, data, chain_id=None):
+        """
+        Como append, para registrar un mensaje que ya está guardado (y
+        publicado): si el registro falla se informa y se devuelve None en
+        lugar de propagar el error, para que el envío no responda 500 y el
+        cliente no lo reintente duplicando el mensaje.
+
+        Returns:
+            Block: El bloque agregado, o None si no se pudo registrar
+        """
+        try:
+            return self.append(data, chain_id)
+        except Exception as e:
+            mensajes = data.get("mensajes_ids") or [data.get("mensaje_id")]
+            print(f"❌ No se pudo registrar en el blockchain {', '.join(map(str, mensajes))}: {e}")
+            return None
+
+    def locate_message(self, message_id):
+        """
+        Busca el bloque de un mensaje en la cadena donde fue registrado.
+
+        Returns:
+            dict: chain_id, block, previous y next; None si no está registrado
+        """
+        entry = get_db()["message_chain"].find_one(
+            {"message_id": str(message_id)},
+            projection={"block_index": 1, "chain_id": 1}
+        )
+        if not entry:
+            return None
+
+        chain_id = entry.get("chain_id")
+        ubicacion = self.chain_for(chain_id).block_with_neighbors(entry["block_index"])
+        if ubicacion:
+            ubicacion["chain_id"] = chain_id
+        return ubicacion
+
+    def _record_head(self, chain_id, block):
+        """
+        Actualiza la cabeza conocida de la subcadena en 'chain_heads' sin
+        retroceder nunca (sólo si el índice nuevo es mayor) y la marca como
+        pendiente de anclar.
+        """
+        heads = get_db()["chain_heads"]
+        nueva_cabeza = {"index": block.index, "hash": block.hash, "pending": True}
+
+        result = heads.update_one(
+            {"_id": chain_id, "index": {"$lt": block.index}},
+            {"$set": nueva_cabeza}
+        )
+        if result.matched_count == 0:
+            try:
+                heads.insert_one(dict(nueva_cabeza, _id=chain_id))
+            except DuplicateKeyError:
+                pass  # Ya hay una cabeza igual o más nueva
+
+    def maybe_anchor(self):
+        """
+        Agrega un bloque ancla si ya pasó el intervalo. Entre todos los
+        workers sólo uno gana el turno (find_one_and_update sobre 'ledger_meta').
+        """
+        now = time.time()
+        if now < self._next_anchor_check:
+            return None
+        self._next_anchor_check = now + ANCHOR_INTERVAL
+
+        meta = get_db()["ledger_meta"]
+        try:
+            turno = meta.find_one_and_update(
+                {"_id": "anchor", "next_at": {"$lte": now}},
+                {"$set": {"next_at": now + ANCHOR_INTERVAL}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return None  # El documento existe y otro worker tiene el turno
+
+        return self.anchor() if turno else None
+
+    def anchor(self):
+        """
+        Compromete en la cadena global las cabezas de las subcadenas que
+        avanzaron desde el último ancla.
+
+        Returns:
+            Block: El bloque ancla, o None si no había cabezas pendientes
+        """
+        heads = get_db()["chain_heads"]
+        pendientes = list(heads.find({"pending": True}).sort("_id", 1))
+        if not pendientes:
+            return None
+
+        cabezas = [
+            {"chain_id": head["_id"], "index": head["index"], "hash": head["hash"]}
+            for head in pendientes
+        ]
+        bloque_ancla = self.global_chain.add_block({
+            "tipo": "ancla",
+            "cabezas": cabezas,
+            "raiz": hashlib.sha256(canonical_encode(cabezas)).hexdigest(),
+            "fecha_creacion": datetime.utcnow().isoformat()
+        })
+
+        # Sólo se desmarcan las cabezas que no avanzaron mientras se anclaba
+        for cabeza in cabezas:
+            heads.update_one(
+                {"_id": cabeza["chain_id"], "index": cabeza["index"]},
+                {"$set": {"pending": False, "anchor_index": bloque_ancla.index}}
+            )
+
+        print(f"⚓ Ancla {bloque_ancla.index}: {len(cabezas)} subcadenas comprometidas")
+        return bloque_ancla
+
+
+# ✅ Instancia global del ledger
+ledger = Ledger()
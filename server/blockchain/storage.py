@@ -0,0 +1,238 @@
+import os
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from config.database import get_db
+
+# 'mongo' (por defecto) o 'journal' (archivo local de solo-append, ver blockchain/journal.py)
+LEDGER_BACKEND = os.getenv('LEDGER_BACKEND', 'mongo')
+
+# Tamaño de lote del cursor al recorrer la cadena
+CURSOR_BATCH_SIZE = int(os.getenv('BLOCKCHAIN_CURSOR_BATCH_SIZE', 1000))
+
+# Prefijo de las colecciones donde se apartan los bloques de antes del índice único
+LEGACY_BLOCKS_PREFIX = 'legacy_blocks'
+
+
+class BlockConflictError(Exception):
+    """Ya existe un bloque con ese índice en la cadena (otro hilo o worker ganó la carrera)"""
+
+
+class BlockStore(ABC):
+    """
+    Interfaz de almacenamiento de bloques. Los bloques se manejan como
+    diccionarios (Block.to_dict()); chain_id None es la cadena global.
+    """
+
+    @abstractmethod
+    def ensure_ready(self, chain_id=None):
+        """Prepara el almacenamiento de la cadena (índices, archivos)"""
+
+    @abstractmethod
+    def append(self, block_data, chain_id=None):
+        """
+        Guarda un bloque nuevo. Debe ser atómico respecto al índice:
+        lanza BlockConflictError si el índice ya está ocupado.
+        """
+
+    @abstractmethod
+    def head(self, chain_id=None):
+        """Devuelve el último bloque de la cadena o None si está vacía"""
+
+    @abstractmethod
+    def get(self, index, chain_id=None):
+        """Devuelve el bloque con ese índice o None"""
+
+    @abstractmethod
+    def iter_range(self, start=0, end=None, chain_id=None):
+        """Recorre en orden los bloques con índice en [start, end] (end None = hasta la cabeza)"""
+
+    @abstractmethod
+    def chain_ids(self):
+        """Devuelve los chain_id de las subcadenas guardadas (sin la cadena global)"""
+
+
+class MongoBlockStore(BlockStore):
+    """
+    Bloques en MongoDB: la cadena global en 'blocks' y las subcadenas en
+    'sub_blocks' (con chain_id). El índice único hace de compare-and-set.
+    """
+
+    def __init__(self):
+        self._indexed = set()
+        self._lock = threading.Lock()
+
+    def _collection(self, chain_id):
+        return get_db()["blocks" if chain_id is None else "sub_blocks"]
+
+    def _query(self, query, chain_id):
+        if chain_id is not None:
+            query = dict(query, chain_id=chain_id)
+        return query
+
+    def ensure_ready(self, chain_id=None):
+        self._ensure_indexes(chain_id)
+
+    def _ensure_indexes(self, chain_id):
+        # Los índices se crean una vez por proceso y colección
+        nombre = "blocks" if chain_id is None else "sub_blocks"
+        if nombre in self._indexed:
+            return
+
+        with self._lock:
+            if nombre in self._indexed:
+                return
+            if chain_id is None:
+                try:
+                    self._collection(None).create_index([("index", ASCENDING)], unique=True)
+                except OperationFailure as e:
+                    if e.code != 11000:
+                        raise
+                    self._migrate_legacy_blocks()
+                    self._collection(None).create_index([("index", ASCENDING)], unique=True)
+            else:
+                self._collection(chain_id).create_index([("chain_id", ASCENDING), ("index", ASCENDING)], unique=True)
+            self._indexed.add(nombre)
+
+    def _migrate_legacy_blocks(self):
+        """
+        Las versiones anteriores no guardaban el bloque génesis y volvían al
+        índice 1 en cada arranque, así que 'blocks' puede tener índices
+        repetidos y el índice único no se puede crear. Esa cadena se aparta
+        completa (rename atómico) en legacy_blocks_<fecha> para auditarla
+        aparte, y la cadena nueva empieza con su génesis en 'blocks'.
+        """
+        db = get_db()
+        destino = f"{LEGACY_BLOCKS_PREFIX}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+        try:
+            db["blocks"].rename(destino)
+            print(f"⚠️ 'blocks' tenía índices repetidos (cadena anterior): movida a '{destino}'")
+        except OperationFailure as e:
+            # Otro worker ya la movió (la colección de origen no existe)
+            if e.code != 26:
+                raise
+
+    def append(self, block_data, chain_id=None):
+        doc = dict(block_data)
+        if chain_id is not None:
+            doc["chain_id"] = chain_id
+        try:
+            self._collection(chain_id).insert_one(doc)
+        except DuplicateKeyError:
+            raise BlockConflictError(f"El índice {doc['index']} ya existe en la cadena")
+
+    def head(self, chain_id=None):
+        return self._collection(chain_id).find_one(
+            self._query({}, chain_id),
+            sort=[("index", DESCENDING)],
+            projection={"_id": 0, "chain_id": 0}
+        )
+
+    def get(self, index, chain_id=None):
+        return self._collection(chain_id).find_one(
+            self._query({"index": index}, chain_id),
+            projection={"_id": 0, "chain_id": 0}
+        )
+
+    def iter_range(self, start=0, end=None, chain_id=None):
+        query = {"index": {"$gte": start}}
+        if end is not None:
+            query["index"]["$lte"] = end
+
+        cursor = self._collection(chain_id).find(
+            self._query(query, chain_id),
+            projection={"_id": 0, "chain_id": 0}
+        ).sort("index", 1).batch_size(CURSOR_BATCH_SIZE)
+        return iter(cursor)
+
+    def chain_ids(self):
+        # distinct sobre el prefijo del índice (chain_id, index)
+        return sorted(get_db()["sub_blocks"].distinct("chain_id"))
+
+
+_message_index_ready = False
+_message_index_lock = threading.Lock()
+
+
+def ensure_message_chain_index(db):
+    """
+    Índice único de 'message_chain' por message_id (una vez por proceso).
+    'message_chain' está siempre en MongoDB sea cual sea el backend de
+    bloques: lo crea Blockchain al prepararse, antes del primer append.
+    """
+    global _message_index_ready
+    if _message_index_ready:
+        return
+    with _message_index_lock:
+        if _message_index_ready:
+            return
+        # Los registros antiguos no tienen message_id
+        db["message_chain"].create_index(
+            [("message_id", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"message_id": {"$exists": True}}
+        )
+        _message_index_ready = True
+
+
+def record_message_reference(block_data, chain_id=None):
+    """
+    Guarda en 'message_chain' (siempre MongoDB) la referencia mensaje → bloque
+    si el bloque registra un mensaje: id + digest, nunca el contenido cifrado.
+    Los bloques de envíos múltiples ('mensajes_ids') guardan una referencia
+    por mensaje, todas al mismo bloque.
+    """
+    message_ids = block_data["data"].get("mensajes_ids") or [block_data["data"].get("mensaje_id")]
+    if not message_ids[0]:
+        return
+
+    messages_collection = get_db()["message_chain"]
+    try:
+        participantes = block_data["data"].get("participantes") or [None]
+        message_data = {
+            "block_index": block_data["index"],
+            "message_id": message_ids[0],
+            "sender_id": participantes[0],
+            "timestamp": block_data["timestamp"],
+            "digest": block_data["data"].get("digest"),
+            "hash": block_data["hash"],
+            "previous_hash": block_data["previous_hash"]
+        }
+
+        # Verificamos que todos los campos estén presentes
+        if None in message_data.values():
+            raise ValueError("Faltan campos en el mensaje seguro", block_data["data"])
+
+        if chain_id is not None:
+            message_data["chain_id"] = chain_id
+
+        if len(message_ids) == 1:
+            messages_collection.insert_one(message_data)
+        else:
+            messages_collection.insert_many(
+                [dict(message_data, message_id=message_id) for message_id in message_ids],
+                ordered=False
+            )
+
+    except Exception as e:
+        print(f"❌ Error al guardar mensaje seguro: {e}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_block_store():
+    """Devuelve el almacenamiento de bloques configurado con LEDGER_BACKEND (singleton por proceso)"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if LEDGER_BACKEND == 'journal':
+                    from blockchain.journal import FileJournalStore
+                    _store = FileJournalStore()
+                else:
+                    _store = MongoBlockStore()
+    return _store
@@ -1,6 +1,12 @@
 from pymongo import MongoClient
 from flask import current_app
 
+DATABASE_NAME = "file_system"
+
 def get_db():
-    client = MongoClient(current_app.config['MONGODB_URI'])
-    return client["file_system"]
\ No newline at end of file
+    return get_db_from_uri(current_app.config['MONGODB_URI'])
+
+def get_db_from_uri(uri):
+    # Para procesos sin app context (herramientas de línea de comandos, workers)
+    client = MongoClient(uri)
+    return client[DATABASE_NAME]
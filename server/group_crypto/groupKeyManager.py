@@ -2,7 +2,8 @@ from datetime import datetime
 from aes_crypto.aesCrypto import generate_aes_key, encrypt_aes_gcm, decrypt_aes_gcm
 from rsa_crypto.rsaCrypto import encrypt_with_public_key, decrypt_with_private_key
 import base64
-from bson.objectid import ObjectId
+from utils.identity_map import identity_map
+from utils.crypto_executor import run_crypto
 
 class GroupKeyManager:
     """
@@ -12,6 +13,8 @@ class GroupKeyManager:
     
     def __init__(self, db):
         self.db = db
+        # Usuarios y grupos ya leídos en la petición actual
+        self.identity = identity_map(db)
     
     def create_group(self, group_id, admin_id, group_name):
         """
@@ -43,6 +46,7 @@ class GroupKeyManager:
         
         # Insertar el grupo
         self.db.groups.insert_one(group_data)
+        self.identity.add_group(group_data)
         print(f"✅ Grupo creado en BD: {group_id}")
         
         return aes_key
@@ -63,8 +67,8 @@ class GroupKeyManager:
         print(f"👥 GroupKeyManager: Agregando miembro {new_member_id} al grupo {group_id}")
         
         # Verificar que el grupo existe y que el usuario es admin
-        group = self.db.groups.find_one({'_id': group_id, 'admin_id': admin_id})
-        if not group:
+        group = self.identity.get_group(group_id)
+        if not group or group['admin_id'] != admin_id:
             raise ValueError("Grupo no encontrado o no tienes permisos de administrador")
         
         # Verificar que el usuario no esté ya en el grupo
@@ -73,14 +77,14 @@ class GroupKeyManager:
         
         # Obtener la clave AES actual del grupo
         # Para esto, necesitamos descifrarla usando la clave del admin
-        admin = self.db.users.find_one({'_id': ObjectId(admin_id)})
+        admin = self.identity.get_user(admin_id)
         if not admin:
             raise ValueError("Administrador no encontrado")
         
         aes_key = self._get_group_aes_key(group_id, admin_id, admin['private_key'])
         
         # Cifrar la clave AES para el nuevo miembro
-        encrypted_key_for_member = encrypt_with_public_key(aes_key, member_public_key)
+        encrypted_key_for_member = run_crypto(encrypt_with_public_key, aes_key, member_public_key)
         
         # Guardar la clave cifrada para el nuevo miembro
         self.db.group_keys.insert_one({
@@ -92,13 +96,16 @@ class GroupKeyManager:
         })
         
         # Agregar el miembro a la lista del grupo
+        now = datetime.utcnow()
         self.db.groups.update_one(
             {'_id': group_id},
             {
                 '$push': {'members': new_member_id},
-                '$set': {'last_activity': datetime.utcnow()}
+                '$set': {'last_activity': now}
             }
         )
+        group['members'].append(new_member_id)
+        group['last_activity'] = now
         
         print(f"✅ Miembro {new_member_id} agregado al grupo {group_id}")
         return True
@@ -118,8 +125,8 @@ class GroupKeyManager:
         print(f"🔓 GroupKeyManager: Obteniendo clave del grupo {group_id} para usuario {user_id}")
         
         # Verificar que el usuario es miembro del grupo
-        group = self.db.groups.find_one({'_id': group_id, 'members': user_id})
-        if not group:
+        group = self.identity.get_group(group_id)
+        if not group or user_id not in group['members']:
             raise ValueError("No eres miembro de este grupo")
         
         return self._get_group_aes_key(group_id, user_id, user_private_key)
@@ -147,7 +154,7 @@ class GroupKeyManager:
         
         # Descifrar la clave AES
         encrypted_key = base64.b64decode(group_key_record['encrypted_key'])
-        aes_key = decrypt_with_private_key(encrypted_key, user_private_key)
+        aes_key = run_crypto(decrypt_with_private_key, encrypted_key, user_private_key)
         
         return aes_key
     
@@ -165,25 +172,26 @@ class GroupKeyManager:
         print(f"🔄 GroupKeyManager: Rotando clave del grupo {group_id}")
         
         # Verificar permisos de administrador
-        group = self.db.groups.find_one({'_id': group_id, 'admin_id': admin_id})
-        if not group:
+        group = self.identity.get_group(group_id)
+        if not group or group['admin_id'] != admin_id:
             raise ValueError("Grupo no encontrado o no tienes permisos de administrador")
         
         # Generar nueva clave AES
         new_aes_key = generate_aes_key()
         new_version = group['key_version'] + 1
         
-        # Obtener todos los miembros del grupo
+        # Obtener todos los miembros del grupo (una sola consulta para sus claves públicas)
         members = group['members']
+        member_docs = self.identity.get_users(members)
         
         # Eliminar claves anteriores
         self.db.group_keys.delete_many({'group_id': group_id})
         
         # Distribuir nueva clave a todos los miembros
         for member_id in members:
-            member = self.db.users.find_one({'_id': ObjectId(member_id)})
+            member = member_docs.get(member_id)
             if member:
-                encrypted_key = encrypt_with_public_key(new_aes_key, member['public_key'])
+                encrypted_key = run_crypto(encrypt_with_public_key, new_aes_key, member['public_key'])
                 
                 self.db.group_keys.insert_one({
                     'group_id': group_id,
@@ -194,15 +202,18 @@ class GroupKeyManager:
                 })
         
         # Actualizar versión en el grupo
+        now = datetime.utcnow()
         self.db.groups.update_one(
             {'_id': group_id},
             {
                 '$set': {
                     'key_version': new_version,
-                    'last_activity': datetime.utcnow()
+                    'last_activity': now
                 }
             }
         )
+        group['key_version'] = new_version
+        group['last_activity'] = now
         
         print(f"✅ Clave rotada a versión {new_version} para grupo {group_id}")
         return new_version
@@ -222,8 +233,8 @@ class GroupKeyManager:
         print(f"👥 GroupKeyManager: Removiendo miembro {member_id} del grupo {group_id}")
         
         # Verificar permisos
-        group = self.db.groups.find_one({'_id': group_id, 'admin_id': admin_id})
-        if not group:
+        group = self.identity.get_group(group_id)
+        if not group or group['admin_id'] != admin_id:
             raise ValueError("Grupo no encontrado o no tienes permisos de administrador")
         
         if member_id not in group['members']:
@@ -233,13 +244,16 @@ class GroupKeyManager:
             raise ValueError("El administrador no puede removerse a sí mismo")
         
         # Remover miembro de la lista
+        now = datetime.utcnow()
         self.db.groups.update_one(
             {'_id': group_id},
             {
                 '$pull': {'members': member_id},
-                '$set': {'last_activity': datetime.utcnow()}
+                '$set': {'last_activity': now}
             }
         )
+        group['members'].remove(member_id)
+        group['last_activity'] = now
         
         # Eliminar su acceso a la clave
         self.db.group_keys.delete_many({
@@ -265,8 +279,8 @@ class GroupKeyManager:
             dict: Información del grupo
         """
         # Verificar que el usuario es miembro
-        group = self.db.groups.find_one({'_id': group_id, 'members': user_id})
-        if not group:
+        group = self.identity.get_group(group_id)
+        if not group or user_id not in group['members']:
             return None
         
         return {
@@ -0,0 +1,158 @@
+'''
+Módulo de hashing de contraseñas en un pool de procesos acotado
+Descripción: PBKDF2 (werkzeug) fuera del hilo de la petición. Si el pool
+está saturado se rechaza de inmediato con PasswordPoolBusy en lugar de
+encolar sin límite, y los hashes con parámetros viejos se actualizan
+al verificar la contraseña en el login.
+
+Configuración:
+    PASSWORD_HASH_METHOD: método de werkzeug (por defecto pbkdf2:sha256:600000)
+    PASSWORD_POOL_WORKERS: procesos del pool
+    PASSWORD_POOL_MAX_PENDING: tareas en curso + en cola antes de rechazar
+    PASSWORD_POOL_TIMEOUT: segundos máximos de espera por un resultado
+'''
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+POOL_WORKERS = int(os.getenv('PASSWORD_POOL_WORKERS', max(1, min(4, (os.cpu_count() or 2) // 2))))
+MAX_PENDING = int(os.getenv('PASSWORD_POOL_MAX_PENDING', POOL_WORKERS * 4))
+POOL_TIMEOUT = float(os.getenv('PASSWORD_POOL_TIMEOUT', 5))
+
+
+class PasswordPoolBusy(Exception):
+    '''El pool de hashing está saturado o no respondió a tiempo'''
+
+    retry_after = 1
+
+
+'''
+Indica si un hash guardado usa parámetros distintos a los actuales
+
+Args:
+    stored_hash (str): Hash en formato werkzeug (método$sal$hash)
+    method (str): Método objetivo
+
+Returns:
+    bool: True si conviene recalcular el hash
+'''
+def needs_rehash(stored_hash: str, method: str = HASH_METHOD) -> bool:
+    return stored_hash.split('$', 1)[0] != method
+
+
+# --- Tareas que corren en los procesos del pool ---
+
+def _hash_task(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _noop_task():
+    return None
+
+
+def _verify_task(stored_hash, password, method):
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if needs_rehash(stored_hash, method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+class PasswordPool:
+    def __init__(self, workers=POOL_WORKERS, max_pending=MAX_PENDING, timeout=POOL_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Un pool por proceso: si el worker se forkeó después de crearlo, se crea otro
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordPoolBusy("Pool de contraseñas saturado")
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset()
+            raise PasswordPoolBusy("El pool de contraseñas se reinició")
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PasswordPoolBusy("El pool de contraseñas no respondió a tiempo")
+        except BrokenProcessPool:
+            self._reset()
+            raise PasswordPoolBusy("El pool de contraseñas se reinició")
+
+    def _reset(self):
+        # Murió un proceso del pool: se recrea en la próxima llamada
+        with self._lock:
+            self._executor = None
+
+    def warm_up(self):
+        '''Arranca los procesos del pool sin esperar (evita pagar el arranque en el primer login)'''
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_noop_task)
+
+    def hash(self, password):
+        return self._run(_hash_task, password, HASH_METHOD)
+
+    def verify(self, stored_hash, password):
+        '''
+        Returns:
+            tuple: (contraseña válida, nuevo hash si hay que actualizar el guardado o None)
+        '''
+        return self._run(_verify_task, stored_hash, password, HASH_METHOD)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordPool()
+
+
+'''
+Genera el hash de una contraseña en el pool
+
+Raises:
+    PasswordPoolBusy: Si el pool está saturado
+'''
+def hash_password(password: str) -> str:
+    return password_pool.hash(password)
+
+
+'''
+Verifica una contraseña en el pool y, si es válida y el hash usa
+parámetros viejos, devuelve también el hash nuevo para guardarlo
+
+Raises:
+    PasswordPoolBusy: Si el pool está saturado
+'''
+def verify_password(stored_hash: str, password: str) -> tuple:
+    return password_pool.verify(stored_hash, password)
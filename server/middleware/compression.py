@@ -0,0 +1,84 @@
+import gzip
+import os
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# responses smaller than this are sent as-is (headers and CPU would cost more than the savings)
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'true').lower() != 'false'
+GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 5))
+ZSTD_LEVEL = int(os.getenv('COMPRESS_ZSTD_LEVEL', 3))
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv'}
+
+
+def _zstd(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def _gzip(data):
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+# server preference when the client accepts several with the same quality
+ENCODERS = {}
+if zstandard is not None:
+    ENCODERS['zstd'] = _zstd
+if brotli is not None:
+    ENCODERS['br'] = _brotli
+ENCODERS['gzip'] = _gzip
+
+
+def available_encodings():
+    return list(ENCODERS)
+
+
+def compress_response(response):
+    """
+    Compresses a buffered response with the best encoding the client accepts.
+    Streamed responses (SSE, exports) and small bodies are left untouched.
+    """
+    if not COMPRESS_ENABLED or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    g.response_raw_bytes = len(data)
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    encoding = request.accept_encodings.best_match(list(ENCODERS))
+    if encoding is None:
+        return response
+
+    response.set_data(ENCODERS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+
+    # the compressed body is a different representation: a strong validator
+    # would promise byte equality with the identity one, so it becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
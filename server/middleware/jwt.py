@@ -1,8 +1,96 @@
 from functools import wraps
 from flask import request, jsonify, current_app
 import jwt
+import os
 from config.database import get_db
 from bson import ObjectId
+from utils.cache import TTLCache
+from utils.identity_map import identity_map
+from utils import invalidation
+
+# fields that are never kept in the principal cache; loaded on first access
+SECRET_FIELDS = ('private_key', 'signing_private_key', 'password', 'mfa_secret')
+PRINCIPAL_PROJECTION = {field: 0 for field in SECRET_FIELDS}
+
+# authenticated principals keyed by (user id, token id)
+principal_cache = TTLCache(
+    maxsize=int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('PRINCIPAL_CACHE_TTL', 30)),
+    group_of=lambda key: key[0]
+)
+
+
+class Principal(dict):
+    """
+    The authenticated user as seen by the routes: a slim projection of the
+    user document. Secret fields (private keys, password hash, MFA secret)
+    are loaded from the database only when a route reads one of them.
+    """
+
+    def __init__(self, data):
+        super().__init__(data)
+        self._secrets_loaded = False
+
+    def _load_secrets(self):
+        if self._secrets_loaded:
+            return
+        self._secrets_loaded = True
+        secrets = get_db().users.find_one(
+            {'_id': self['_id']},
+            {field: 1 for field in SECRET_FIELDS}
+        )
+        for field in SECRET_FIELDS:
+            if secrets and field in secrets:
+                dict.__setitem__(self, field, secrets[field])
+
+    def __missing__(self, key):
+        if key in SECRET_FIELDS and not self._secrets_loaded:
+            self._load_secrets()
+            return self[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in SECRET_FIELDS and not self._secrets_loaded:
+            self._load_secrets()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if key in SECRET_FIELDS and not self._secrets_loaded:
+            self._load_secrets()
+        return dict.__contains__(self, key)
+
+
+def invalidate_principal(user_id):
+    # drop every cached principal of the user (call after updating the user document)
+    principal_cache.invalidate_group(str(user_id))
+
+
+def _on_user_invalidation(event):
+    # updates made by other workers arrive through the invalidation bus
+    if event.kind == invalidation.ALL:
+        principal_cache.clear()
+    else:
+        invalidate_principal(event.key)
+
+
+invalidation.subscribe(invalidation.USER, _on_user_invalidation)
+
+
+def load_principal(token_data):
+    # return the principal for a decoded access token, from the cache when possible
+    user_id = str(token_data['sub'])
+    cache_key = (user_id, token_data.get('jti') or token_data.get('exp'))
+
+    user = principal_cache.get(cache_key)
+    if user is None:
+        user = get_db().users.find_one({'_id': ObjectId(user_id)}, PRINCIPAL_PROJECTION)
+        if not user:
+            return None
+        principal_cache.set(cache_key, user)
+
+    # each request gets its own copy so lazily loaded secrets never reach the cache
+    return Principal(user)
+
 
 # middleware to verify the token
 def token_required(f):
@@ -28,14 +116,16 @@ def token_required(f):
                 print("Invalid token type", data.get('type'))
                 return jsonify({'error': 'Invalid token type'}), 401
             
-            db = get_db()
-            current_user = db.users.find_one({'_id': ObjectId(data['sub'])})
+            current_user = load_principal(data)
             
             # if the user is not found, return an error
             if not current_user:
                 print("User not found")
                 return jsonify({'error': 'User not found'}), 401
 
+            # later lookups of the same user in this request are served from memory
+            identity_map().add_user(current_user)
+
         except jwt.ExpiredSignatureError:
             # if the token has expired, return an error
             print("Token has expired")
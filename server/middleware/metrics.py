@@ -0,0 +1,93 @@
+import threading
+import time
+from flask import g, request
+
+
+class EndpointMetrics:
+    """
+    Per-endpoint counters of response time, JSON serialization time and
+    body size (before and after compression). Streamed responses only count
+    the time until their headers are sent.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, status_code, seconds, json_seconds, raw_bytes, sent_bytes, streamed):
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    'requests': 0, 'errors': 0, 'streamed': 0, 'compressed': 0,
+                    'seconds': 0.0, 'max_seconds': 0.0, 'json_seconds': 0.0,
+                    'raw_bytes': 0, 'sent_bytes': 0
+                }
+            entry['requests'] += 1
+            entry['errors'] += status_code >= 500
+            entry['streamed'] += streamed
+            entry['compressed'] += sent_bytes < raw_bytes
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['json_seconds'] += json_seconds
+            entry['raw_bytes'] += raw_bytes
+            entry['sent_bytes'] += sent_bytes
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {name: dict(entry) for name, entry in self._endpoints.items()}
+
+        result = {}
+        for name, entry in sorted(endpoints.items()):
+            requests = entry['requests']
+            result[name] = {
+                'requests': requests,
+                'errors': entry['errors'],
+                'streamed': entry['streamed'],
+                'compressed': entry['compressed'],
+                'avg_ms': round(entry['seconds'] / requests * 1000, 3),
+                'max_ms': round(entry['max_seconds'] * 1000, 3),
+                'avg_json_ms': round(entry['json_seconds'] / requests * 1000, 3),
+                'raw_bytes': entry['raw_bytes'],
+                'sent_bytes': entry['sent_bytes'],
+                'avg_sent_bytes': entry['sent_bytes'] // requests,
+                'compression_ratio': round(entry['sent_bytes'] / entry['raw_bytes'], 3) if entry['raw_bytes'] else None
+            }
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+endpoint_metrics = EndpointMetrics()
+
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+
+def _record(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+
+    streamed = response.is_streamed or response.direct_passthrough
+    sent = 0 if streamed else response.calculate_content_length() or 0
+    endpoint_metrics.record(
+        request.endpoint or 'unmatched',
+        response.status_code,
+        time.perf_counter() - started,
+        g.get('json_seconds', 0.0),
+        g.get('response_raw_bytes', sent),
+        sent,
+        streamed
+    )
+    return response
+
+
+def init_metrics(app):
+    # register before init_compression: after_request hooks run in reverse
+    # order, so the sizes recorded here are the ones actually sent
+    app.before_request(_start_timer)
+    app.after_request(_record)
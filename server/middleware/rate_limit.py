@@ -0,0 +1,199 @@
+from functools import wraps
+from collections import OrderedDict
+from flask import g, jsonify, make_response
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from datetime import datetime, timedelta
+import math
+import os
+import threading
+import time
+from config.database import get_db
+
+# one bucket per user shared by every crypto-heavy endpoint; each request
+# takes tokens according to its cost (roughly one token per RSA private-key operation)
+CAPACITY = float(os.getenv('RATE_LIMIT_CAPACITY', 300))
+REFILL_PER_SECOND = float(os.getenv('RATE_LIMIT_REFILL_PER_SECOND', 30))
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # memory | mongo
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() != 'false'
+MEMORY_MAX_BUCKETS = int(os.getenv('RATE_LIMIT_MEMORY_MAX_BUCKETS', 100000))
+MONGO_CAS_ATTEMPTS = 5
+
+
+class RateLimitResult:
+    __slots__ = ('allowed', 'remaining', 'retry_after', 'reset')
+
+    def __init__(self, allowed, remaining, retry_after, reset):
+        self.allowed = allowed
+        self.remaining = remaining      # tokens left (may be negative after a post-charge)
+        self.retry_after = retry_after  # seconds until the request could succeed
+        self.reset = reset              # seconds until the bucket is full again
+
+
+def _refill(tokens, last, now, capacity, rate):
+    if tokens is None:
+        return capacity
+    return min(capacity, tokens + max(0.0, now - last) * rate)
+
+
+def _result(allowed, tokens, cost, capacity, rate):
+    missing = cost - tokens if not allowed else 0
+    return RateLimitResult(
+        allowed,
+        tokens,
+        math.ceil(missing / rate) if missing > 0 else 0,
+        math.ceil((capacity - tokens) / rate) if tokens < capacity else 0
+    )
+
+
+class BucketBackend:
+    """
+    Storage of token buckets. take() must be atomic per key: refill the
+    bucket for the elapsed time and, if it holds at least `cost` tokens (or
+    force is set), subtract them.
+    """
+
+    def take(self, key, cost, capacity, rate, force=False):
+        raise NotImplementedError
+
+
+class MemoryBucketBackend(BucketBackend):
+    # buckets of this process only (single worker or per-worker limits)
+
+    def __init__(self, max_buckets=MEMORY_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # key -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, capacity, rate, force=False):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (None, now))
+            tokens = _refill(tokens, last, now, capacity, rate)
+            allowed = force or tokens >= cost
+            if allowed:
+                # post-charges may leave a debt, bounded to one full bucket
+                tokens = max(tokens - cost, -capacity)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return _result(allowed, tokens, cost, capacity, rate)
+
+
+class MongoBucketBackend(BucketBackend):
+    # buckets shared by every worker, in the 'rate_limits' collection (compare-and-set on the last refill)
+
+    def __init__(self):
+        self._indexed = False
+
+    def _collection(self):
+        collection = get_db().rate_limits
+        if not self._indexed:
+            # idle buckets are full again anyway: let MongoDB drop them
+            collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def take(self, key, cost, capacity, rate, force=False):
+        collection = self._collection()
+        for _ in range(MONGO_CAS_ATTEMPTS):
+            now = time.time()
+            bucket = collection.find_one({'_id': key})
+            last = bucket['last'] if bucket else now
+            tokens = _refill(bucket['tokens'] if bucket else None, last, now, capacity, rate)
+            allowed = force or tokens >= cost
+            if not allowed:
+                return _result(False, tokens, cost, capacity, rate)
+
+            new_tokens = max(tokens - cost, -capacity)
+            update = {
+                'tokens': new_tokens,
+                'last': now,
+                'expires_at': datetime.utcnow() + timedelta(seconds=(capacity - new_tokens) / rate + 60)
+            }
+            try:
+                if bucket is None:
+                    collection.insert_one(dict(update, _id=key))
+                    return _result(True, new_tokens, cost, capacity, rate)
+                if collection.update_one({'_id': key, 'last': bucket['last']}, {'$set': update}).modified_count:
+                    return _result(True, new_tokens, cost, capacity, rate)
+            except DuplicateKeyError:
+                pass
+
+        # heavy contention on one bucket: let the request through rather than fail it
+        return _result(True, 0.0, cost, capacity, rate)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = MongoBucketBackend() if RATE_LIMIT_BACKEND == 'mongo' else MemoryBucketBackend()
+    return _backend
+
+
+def set_backend(backend):
+    # plug in another shared backend (e.g. one backed by Redis)
+    global _backend
+    _backend = backend
+
+
+def _headers(result):
+    return {
+        'RateLimit-Limit': str(int(CAPACITY)),
+        'RateLimit-Remaining': str(max(0, int(result.remaining))),
+        'RateLimit-Reset': str(result.reset)
+    }
+
+
+def rate_limited(cost=1):
+    """
+    Limits the decorated route per user (place it below @token_required).
+
+    `cost` tokens are taken before the route runs. Routes whose cost
+    depends on their work (e.g. how many messages were decrypted) add it
+    afterwards with charge().
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            if not RATE_LIMIT_ENABLED:
+                return f(current_user, *args, **kwargs)
+
+            key = f"user:{current_user['_id']}"
+            try:
+                result = get_backend().take(key, cost, CAPACITY, REFILL_PER_SECOND)
+            except PyMongoError as e:
+                # the limiter must not take the API down with it
+                print(f"Rate limiter unavailable: {e}")
+                return f(current_user, *args, **kwargs)
+
+            if not result.allowed:
+                headers = _headers(result)
+                headers['Retry-After'] = str(max(1, result.retry_after))
+                return jsonify({'error': 'Too many requests', 'retry_after': max(1, result.retry_after)}), 429, headers
+
+            g.rate_limit = {'key': key, 'result': result}
+            response = make_response(f(current_user, *args, **kwargs))
+            response.headers.extend(_headers(g.rate_limit['result']))
+            return response
+
+        return decorated
+    return decorator
+
+
+def charge(cost):
+    # add the variable part of the current request's cost (may leave the bucket in debt)
+    state = g.get('rate_limit')
+    if not state or cost <= 0:
+        return
+    try:
+        state['result'] = get_backend().take(state['key'], cost, CAPACITY, REFILL_PER_SECOND, force=True)
+    except PyMongoError as e:
+        print(f"Rate limiter unavailable: {e}")
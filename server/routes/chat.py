@@ -1,10 +1,32 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, current_app, g, stream_with_context
+from flask import json as flask_json
 import jwt
 import json
+import math
+import os
+import time
 from datetime import datetime, timedelta
 from config.database import get_db
 from middleware.jwt import token_required
-from blockchain.chain import blockchain 
+from middleware.rate_limit import rate_limited, charge as rate_limit_charge
+from utils.crypto_executor import run_crypto, map_crypto, crypto_bound, CryptoOverloaded
+from utils.json_provider import jsonify, get_backend as get_json_backend
+from middleware.metrics import endpoint_metrics
+from middleware.compression import available_encodings
+from utils.identity_map import identity_map
+from utils.message_broker import (
+    broker, message_audience,
+    SSE_HEARTBEAT, SSE_MAX_DURATION, SSE_REPLAY_LIMIT, SSE_RETRY_MS
+)
+from utils import inbox, history_transfer
+from utils.sync import (
+    SyncRequestError, ensure_message_indexes, parse_sync_request, sync_query, settled_cap, advance
+)
+from utils.history_etag import conditional_history, conversation_etag, group_history_etag
+from utils.public_keys import get_public_keys, batch_etag, BATCH_MAX as PUBLIC_KEY_BATCH_MAX
+from blockchain.chain import blockchain, block_participants
+from blockchain.ledger import ledger, direct_chain_id, group_chain_id, multicast_chain_id
+from blockchain.encoding import compact_message_payload, multicast_message_payload, message_digest
 from aes_crypto.aesCrypto import encrypt_aes_gcm, decrypt_aes_gcm, generate_aes_key
 from rsa_crypto.rsaCrypto import encrypt_with_public_key, decrypt_with_private_key
 from hashing.signing import sign_message, verify_signature
@@ -14,6 +36,10 @@ from group_crypto.groupKeyManager import GroupKeyManager
 
 chat_bp = Blueprint('chat', __name__)
 
+# Envío múltiple: destinatarios por petición y mensajes por bloque del blockchain
+MULTICAST_MAX_RECIPIENTS = int(os.getenv('MULTICAST_MAX_RECIPIENTS', 5000))
+MULTICAST_LEDGER_BATCH = int(os.getenv('MULTICAST_LEDGER_BATCH', 500))
+
 # ===============================================
 # 1. GET /users/{user}/key - Obtiene la llave pública del usuario
 # ===============================================
@@ -23,21 +49,85 @@ def get_user_public_key(current_user, user_id):
     """Obtiene la llave pública del usuario especificado"""
     db = get_db()
     
-    user = db.users.find_one({'_id': ObjectId(user_id)})
-    if not user:
+    entry = get_public_keys(db, [user_id]).get(user_id)
+    if not entry:
         return jsonify({'error': 'Usuario no encontrado'}), 404
     
+    # El cliente ya tiene esta versión de las llaves
+    if request.if_none_match.contains_weak(entry['etag']):
+        return '', 304, {'ETag': f'"{entry["etag"]}"', 'Cache-Control': 'private, no-cache'}
+    
     response = {
         'user_id': user_id,
-        'email': user['email'],
-        'name': f"{user['givenName']} {user['familyName']}",
-        'public_key': user['public_key'],
+        'email': entry['email'],
+        'name': entry['name'],
+        'public_key': entry['public_key'],
+        'fingerprints': entry['fingerprints']
     }
     
-    if 'signing_public_key' in user:
-        response['signing_public_key'] = user['signing_public_key']
+    if 'signing_public_key' in entry:
+        response['signing_public_key'] = entry['signing_public_key']
     
-    return jsonify(response), 200
+    response = jsonify(response)
+    response.set_etag(entry['etag'])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response, 200
+
+
+# ===============================================
+# 1.1 GET /users/keys?ids=a,b,c - Llaves públicas de varios usuarios
+# ===============================================
+@chat_bp.route('/users/keys', methods=['GET'])
+@token_required
+def get_users_public_keys(current_user):
+    """
+    Devuelve las llaves públicas (y sus huellas SHA-256) de hasta
+    PUBLIC_KEY_BATCH_MAX usuarios.
+    
+    If-None-Match admite el ETag del lote (304 si nada cambió) y los ETag
+    individuales de cada llave: las llaves que el cliente ya tiene se
+    devuelven sólo con 'not_modified', sin el PEM.
+    """
+    db = get_db()
+    
+    user_ids = list(dict.fromkeys(
+        user_id.strip() for user_id in request.args.get('ids', '').split(',') if user_id.strip()
+    ))
+    if not user_ids:
+        return jsonify({'error': 'El parámetro "ids" es requerido'}), 400
+    if len(user_ids) > PUBLIC_KEY_BATCH_MAX:
+        return jsonify({'error': f'Máximo {PUBLIC_KEY_BATCH_MAX} usuarios por petición'}), 400
+    
+    entries = get_public_keys(db, user_ids)
+    not_found = [user_id for user_id in user_ids if user_id not in entries]
+    
+    etag = batch_etag(entries.values(), not_found)
+    if request.if_none_match.contains_weak(etag):
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    
+    keys = []
+    for user_id in user_ids:
+        entry = entries.get(user_id)
+        if entry is None:
+            continue
+        if request.if_none_match.contains_weak(entry['etag']):
+            keys.append({
+                'user_id': user_id,
+                'not_modified': True,
+                'etag': entry['etag'],
+                'fingerprints': entry['fingerprints']
+            })
+        else:
+            keys.append(dict(entry))
+    
+    response = jsonify({
+        'keys': keys,
+        'not_found': not_found,
+        'count': len(keys)
+    })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response, 200
 
 
 # ===============================================
@@ -45,6 +135,8 @@ def get_user_public_key(current_user, user_id):
 # ===============================================
 @chat_bp.route('/messages/<user_destino>', methods=['POST'])
 @token_required
+@crypto_bound
+@rate_limited(cost=5)
 def send_secure_message(current_user, user_destino):
     """
     FLUJO CORRECTO:
@@ -60,12 +152,13 @@ def send_secure_message(current_user, user_destino):
     if not mensaje_original:
         return jsonify({'error': 'Campo "message" es requerido'}), 400
     
-    # Obtener usuarios completos desde la base de datos
-    emisor = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+    # Obtener usuarios completos (el emisor ya está en el mapa de identidad de la petición)
+    usuarios = identity_map(db)
+    emisor = usuarios.get_user(current_user['_id'])
     if not emisor:
         return jsonify({'error': 'Usuario emisor no encontrado'}), 404
     
-    destinatario = db.users.find_one({'_id': ObjectId(user_destino)})
+    destinatario = usuarios.get_user(user_destino)
     if not destinatario:
         return jsonify({'error': 'Destinatario no encontrado'}), 404
     
@@ -85,7 +178,7 @@ def send_secure_message(current_user, user_destino):
         
         # Generar clave AES única y cifrar
         aes_key = generate_aes_key()
-        nonce, ciphertext, tag = encrypt_aes_gcm(mensaje_json, aes_key)
+        nonce, ciphertext, tag = run_crypto(encrypt_aes_gcm, mensaje_json, aes_key)
         
         print(f"✅ Mensaje cifrado - Tamaño: {len(ciphertext)} bytes")
         
@@ -97,7 +190,7 @@ def send_secure_message(current_user, user_destino):
         
         # Firmar usando la clave del emisor (detecta automáticamente RSA/ECDSA + SHA-256)
         signing_key = emisor.get('signing_private_key', emisor['private_key'])
-        firma_digital = sign_message(signing_key, mensaje_para_firmar)
+        firma_digital = run_crypto(sign_message, signing_key, mensaje_para_firmar)
         
         print(f"✅ Firma digital generada - Algoritmo: SHA-256")
         
@@ -105,8 +198,8 @@ def send_secure_message(current_user, user_destino):
         print(f"🔑 PASO 3: Cifrando clave AES con RSA para ambos usuarios")
         
         # Cifrar para emisor y destinatario
-        encrypted_key_sender = encrypt_with_public_key(aes_key, emisor['public_key'])
-        encrypted_key_recipient = encrypt_with_public_key(aes_key, destinatario['public_key'])
+        encrypted_key_sender = run_crypto(encrypt_with_public_key, aes_key, emisor['public_key'])
+        encrypted_key_recipient = run_crypto(encrypt_with_public_key, aes_key, destinatario['public_key'])
         
         print(f"✅ Claves AES cifradas para ambos usuarios")
         
@@ -137,6 +230,8 @@ def send_secure_message(current_user, user_destino):
         }
         
         result = db.messages.insert_one(mensaje_seguro)
+        broker.publish(mensaje_seguro, message_audience(mensaje_seguro))
+        inbox.record_direct_message(db, mensaje_seguro)
         
         print(f"✅ GUARDADO COMPLETO:")
         print(f"  - Mensaje original: NUNCA se guarda en BD")
@@ -145,28 +240,20 @@ def send_secure_message(current_user, user_destino):
         print(f"  - ID en BD: {result.inserted_id}")
         
         # === PASO 5: BLOCKCHAIN ===
-        bloque_data = {
-            "tipo": "mensaje_seguro_v2",
-            "mensaje_id": str(result.inserted_id),
-            "contenido_cifrado": base64.b64encode(ciphertext).decode('utf-8'),
-            "firma_digital": firma_digital,
-            "emisor": {
-                "id": str(emisor['_id']),
-                "nombre": f"{emisor['givenName']} {emisor['familyName']}",
-                "email": emisor['email']
-            },
-            "receptor": {
-                "id": str(destinatario['_id']),
-                "nombre": f"{destinatario['givenName']} {destinatario['familyName']}",
-                "email": destinatario['email']
-            },
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        blockchain.add_block(bloque_data)
+        # El bloque sólo referencia el mensaje (id + digest de lo guardado)
+        bloque_data = compact_message_payload(
+            result.inserted_id,
+            mensaje_seguro['ciphertext'],
+            firma_digital,
+            [emisor['_id'], destinatario['_id']]
+        )
+        # El mensaje ya está guardado: un fallo del registro no hace fallar el envío
+        bloque = ledger.record(bloque_data, direct_chain_id(emisor['_id'], destinatario['_id']))
 
         return jsonify({
             'status': 'Mensaje seguro enviado con flujo correcto',
             'message_id': str(result.inserted_id),
+            'blockchain_recorded': bloque is not None,
             'security_features': {
                 'encrypted': True,
                 'signed': True,
@@ -184,11 +271,327 @@ def send_secure_message(current_user, user_destino):
         }), 500
 
 
+# ===============================================
+# 2.1 POST /messages/multicast - Un mensaje para varios destinatarios
+# ===============================================
+@chat_bp.route('/messages/multicast', methods=['POST'])
+@token_required
+@crypto_bound
+@rate_limited(cost=5)
+def send_multicast_message(current_user):
+    """
+    Mismo flujo que POST /messages/<user_destino>, para varios destinatarios:
+    1. Cifra el mensaje con AES-256 una sola vez
+    2. Firma el mensaje cifrado una sola vez
+    3. Cifra la clave AES con RSA para cada destinatario (repartido en el ejecutor)
+    4. Guarda un mensaje v2 por destinatario con un solo insert_many
+    5. Registra los mensajes en el blockchain en bloques de varios mensajes
+
+    Cada destinatario recibe un mensaje directo normal: se lee con
+    GET /messages/<user_origen>/<user_destino> como cualquier otro.
+    """
+    db = get_db()
+    data = request.get_json() or {}
+    
+    mensaje_original = data.get('message')
+    if not mensaje_original:
+        return jsonify({'error': 'Campo "message" es requerido'}), 400
+    
+    recipients = data.get('recipients')
+    if not isinstance(recipients, list) or not recipients:
+        return jsonify({'error': 'Campo "recipients" (lista de IDs) es requerido'}), 400
+    
+    # Sin repetidos, conservando el orden
+    recipient_ids = list(dict.fromkeys(str(recipient) for recipient in recipients))
+    if len(recipient_ids) > MULTICAST_MAX_RECIPIENTS:
+        return jsonify({'error': f'Máximo {MULTICAST_MAX_RECIPIENTS} destinatarios por envío'}), 400
+    
+    usuarios = identity_map(db)
+    emisor = usuarios.get_user(current_user['_id'])
+    if not emisor:
+        return jsonify({'error': 'Usuario emisor no encontrado'}), 404
+    
+    # Sólo hacen falta las llaves públicas (cache del directorio de llaves)
+    llaves = get_public_keys(db, recipient_ids)
+    not_found = [recipient_id for recipient_id in recipient_ids if recipient_id not in llaves]
+    if not_found:
+        return jsonify({'error': 'Destinatarios no encontrados', 'not_found': not_found}), 404
+    
+    print(f"📤 ENVÍO MÚLTIPLE - {emisor['email']} a {len(recipient_ids)} destinatarios")
+    
+    try:
+        # === PASO 1: CIFRAR EL MENSAJE CON AES-256 (una vez) ===
+        mensaje_con_metadata = {
+            "mensaje": mensaje_original,
+            "emisor_id": str(current_user['_id']),
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        mensaje_json = json.dumps(mensaje_con_metadata)
+        
+        aes_key = generate_aes_key()
+        nonce, ciphertext, tag = run_crypto(encrypt_aes_gcm, mensaje_json, aes_key)
+        ciphertext_b64 = base64.b64encode(ciphertext).decode('utf-8')
+        
+        # === PASO 2: FIRMAR EL MENSAJE CIFRADO (una vez) ===
+        signing_key = emisor.get('signing_private_key', emisor['private_key'])
+        firma_digital = run_crypto(sign_message, signing_key, ciphertext_b64)
+        
+        # === PASO 3: CIFRAR CLAVE AES PARA EL EMISOR Y CADA DESTINATARIO ===
+        encrypted_key_sender = run_crypto(encrypt_with_public_key, aes_key, emisor['public_key'])
+        encrypted_keys = map_crypto(
+            encrypt_with_public_key,
+            [(aes_key, llaves[recipient_id]['public_key']) for recipient_id in recipient_ids]
+        )
+        
+        print(f"✅ Mensaje cifrado y firmado una vez, {len(encrypted_keys)} claves AES cifradas")
+        
+        # === PASO 4: GUARDAR UN MENSAJE POR DESTINATARIO ===
+        multicast_id = ObjectId()
+        compartido = {
+            'sender_id': ObjectId(current_user['_id']),
+            'ciphertext': ciphertext_b64,
+            'nonce': base64.b64encode(nonce).decode('utf-8'),
+            'tag': base64.b64encode(tag).decode('utf-8'),
+            'encrypted_key_sender': base64.b64encode(encrypted_key_sender).decode('utf-8'),
+            'digital_signature': firma_digital,
+            'timestamp': datetime.utcnow(),
+            'is_signed': True,
+            'is_group': False,
+            'multicast_id': multicast_id,
+            'version': 'v2_correct_flow'
+        }
+        mensajes = [
+            dict(
+                compartido,
+                recipient_id=ObjectId(recipient_id),
+                encrypted_key_recipient=base64.b64encode(encrypted_key).decode('utf-8')
+            )
+            for recipient_id, encrypted_key in zip(recipient_ids, encrypted_keys)
+        ]
+        db.messages.insert_many(mensajes)
+        
+        for mensaje in mensajes:
+            broker.publish(mensaje, message_audience(mensaje))
+        inbox.record_direct_messages(db, mensajes)
+        
+        print(f"💾 {len(mensajes)} mensajes guardados (multicast {multicast_id})")
+        
+        # === PASO 5: BLOCKCHAIN ===
+        # Un bloque por lote: todos los mensajes comparten el mismo digest
+        registrados = True
+        for start in range(0, len(mensajes), MULTICAST_LEDGER_BATCH):
+            lote = mensajes[start:start + MULTICAST_LEDGER_BATCH]
+            bloque_data = multicast_message_payload(
+                [mensaje['_id'] for mensaje in lote],
+                ciphertext_b64,
+                firma_digital,
+                emisor['_id'],
+                [mensaje['recipient_id'] for mensaje in lote]
+            )
+            registrados = ledger.record(bloque_data, multicast_chain_id(emisor['_id'])) is not None and registrados
+        
+        # El costo crece con los destinatarios (cifrado RSA y escritura por cada uno)
+        rate_limit_charge(math.ceil(len(mensajes) / 10))
+        
+        return jsonify({
+            'status': 'Mensaje seguro enviado a varios destinatarios',
+            'multicast_id': str(multicast_id),
+            'recipient_count': len(mensajes),
+            'blockchain_recorded': registrados,
+            'message_ids': {str(mensaje['recipient_id']): str(mensaje['_id']) for mensaje in mensajes},
+            'security_features': {
+                'encrypted': True,
+                'signed': True,
+                'algorithm': 'AES-256-GCM + RSA-OAEP + SHA-256',
+                'flow': 'cifrar → firmar → guardar',
+                'stored_encrypted': True
+            }
+        }), 200
+        
+    except Exception as e:
+        print(f"❌ Error en envío múltiple: {str(e)}")
+        return jsonify({
+            'error': 'Error al procesar envío múltiple',
+            'details': str(e)
+        }), 500
+
+
+def _decrypt_direct_message(msg, current_user_id, user_from_db, usuarios):
+    """
+    Descifra un mensaje directo para current_user_id (emisor o destinatario).
+
+    Returns:
+        dict: Mensaje para la respuesta, o None si el usuario no puede verlo
+    """
+    try:
+        sender_id = str(msg['sender_id'])
+        recipient_id = str(msg['recipient_id'])
+
+        print(f"\n📨 Procesando mensaje ID: {msg['_id']}")
+        print(f"   De: {sender_id} → Para: {recipient_id}")
+
+        # === VERIFICAR SISTEMA (v2 = nuevo, v1 = antiguo) ===
+        is_new_system = msg.get('version') == 'v2_correct_flow'
+
+        if is_new_system:
+            print(f"🆕 Sistema NUEVO (v2) - Flujo correcto")
+
+            # === PASO 1: OBTENER CLAVE CIFRADA CORRECTA ===
+            if current_user_id == sender_id:
+                encrypted_key = base64.b64decode(msg['encrypted_key_sender'])
+                print(f"🔓 Usando clave para EMISOR")
+            elif current_user_id == recipient_id:
+                encrypted_key = base64.b64decode(msg['encrypted_key_recipient'])
+                print(f"🔓 Usando clave para DESTINATARIO")
+            else:
+                return None
+
+            # === PASO 2: DESCIFRAR CLAVE AES ===
+            aes_key = run_crypto(decrypt_with_private_key, encrypted_key, user_from_db['private_key'])
+            print(f"🔑 Clave AES descifrada")
+
+            # === PASO 3: VERIFICAR INTEGRIDAD (FIRMA) ===
+            ciphertext_b64 = msg['ciphertext']
+            firma_digital = msg['digital_signature']
+
+            # Obtener clave pública del emisor para verificar firma
+            emisor = usuarios.get_user(msg['sender_id'])
+            verification_key = emisor.get('signing_public_key', emisor['public_key'])
+
+            # Verificar firma del mensaje cifrado
+            signature_valid = run_crypto(verify_signature, verification_key, ciphertext_b64, firma_digital)
+            print(f"🔏 Verificación de integridad: {'VÁLIDA' if signature_valid else 'INVÁLIDA'}")
+
+            # === PASO 4: SOLO SI LA FIRMA ES VÁLIDA, DESCIFRAR ===
+            if signature_valid:
+                nonce = base64.b64decode(msg['nonce'])
+                ciphertext = base64.b64decode(msg['ciphertext'])
+                tag = base64.b64decode(msg['tag'])
+
+                mensaje_json_descifrado = run_crypto(decrypt_aes_gcm, ciphertext, aes_key, nonce, tag)
+                mensaje_con_metadata = json.loads(mensaje_json_descifrado.decode('utf-8'))
+
+                content = mensaje_con_metadata['mensaje']
+                print(f"✅ Mensaje descifrado: {content[:50]}...")
+            else:
+                content = "[MENSAJE CORRUPTO - Firma inválida]"
+                print(f"❌ Mensaje rechazado por firma inválida")
+
+            return {
+                'id': str(msg['_id']),
+                'sender_id': sender_id,
+                'recipient_id': recipient_id,
+                'content': content,
+                'timestamp': msg['timestamp'],
+                'security_info': {
+                    'is_signed': True,
+                    'signature_valid': signature_valid,
+                    'encrypted': True,
+                    'system': 'v2_correct_flow'
+                }
+            }
+
+        else:
+            # === COMPATIBILIDAD CON SISTEMA ANTIGUO ===
+            print(f"🔄 Sistema ANTIGUO (v1) - Compatibilidad")
+
+            # Lógica anterior para mensajes antiguos
+            if 'encrypted_key_sender' in msg and 'encrypted_key_recipient' in msg:
+                # Sistema de doble cifrado antiguo
+                if current_user_id == sender_id:
+                    encrypted_key = base64.b64decode(msg['encrypted_key_sender'])
+                elif current_user_id == recipient_id:
+                    encrypted_key = base64.b64decode(msg['encrypted_key_recipient'])
+                else:
+                    return None
+
+                aes_key = run_crypto(decrypt_with_private_key, encrypted_key, user_from_db['private_key'])
+                nonce = base64.b64decode(msg['nonce'])
+                ciphertext = base64.b64decode(msg['ciphertext'])
+                tag = base64.b64decode(msg['tag'])
+
+                mensaje_json_descifrado = run_crypto(decrypt_aes_gcm, ciphertext, aes_key, nonce, tag)
+                mensaje_con_firma = json.loads(mensaje_json_descifrado.decode('utf-8'))
+                content = mensaje_con_firma['mensaje']
+
+                # Verificar firma del mensaje original (sistema antiguo)
+                signature_valid = False
+                if msg.get('is_signed', False):
+                    emisor = usuarios.get_user(msg['sender_id'])
+                    if emisor:
+                        verification_key = emisor.get('signing_public_key', emisor['public_key'])
+                        signature_valid = run_crypto(
+                            verify_signature,
+                            verification_key,
+                            mensaje_con_firma['mensaje'],
+                            mensaje_con_firma['firma']
+                        )
+
+                return {
+                    'id': str(msg['_id']),
+                    'sender_id': sender_id,
+                    'recipient_id': recipient_id,
+                    'content': content,
+                    'timestamp': msg['timestamp'],
+                    'security_info': {
+                        'is_signed': msg.get('is_signed', False),
+                        'signature_valid': signature_valid,
+                        'encrypted': True,
+                        'system': 'v1_legacy'
+                    }
+                }
+
+            else:
+                # Sistema muy antiguo - solo destinatario puede ver
+                if current_user_id == recipient_id and 'encrypted_key' in msg:
+                    encrypted_key = base64.b64decode(msg['encrypted_key'])
+                    aes_key = run_crypto(decrypt_with_private_key, encrypted_key, user_from_db['private_key'])
+
+                    nonce = base64.b64decode(msg['nonce'])
+                    ciphertext = base64.b64decode(msg['ciphertext'])
+                    tag = base64.b64decode(msg['tag'])
+
+                    mensaje_json_descifrado = run_crypto(decrypt_aes_gcm, ciphertext, aes_key, nonce, tag)
+                    mensaje_con_firma = json.loads(mensaje_json_descifrado.decode('utf-8'))
+                    content = mensaje_con_firma['mensaje']
+                else:
+                    content = "[Mensaje del sistema antiguo - no visible para emisor]"
+
+                return {
+                    'id': str(msg['_id']),
+                    'sender_id': sender_id,
+                    'recipient_id': recipient_id,
+                    'content': content,
+                    'timestamp': msg['timestamp'],
+                    'security_info': {
+                        'is_signed': False,
+                        'signature_valid': False,
+                        'encrypted': True,
+                        'system': 'v0_very_old'
+                    }
+                }
+
+    except Exception as e:
+        print(f"❌ Error procesando mensaje {msg['_id']}: {str(e)}")
+        return {
+            'id': str(msg['_id']),
+            'sender_id': str(msg.get('sender_id', '')),
+            'recipient_id': str(msg.get('recipient_id', '')),
+            'content': 'Error al descifrar mensaje',
+            'error': f'Error: {str(e)}',
+            'timestamp': msg['timestamp'],
+            'security_info': {'is_signed': False, 'signature_valid': False, 'encrypted': True}
+        }
+
+
 # ===============================================
 # 3. GET /messages/{user_origen}/{user_destino} - RECEPCIÓN CORRECTA
 # ===============================================
 @chat_bp.route('/messages/<user_origen>/<user_destino>', methods=['GET'])
 @token_required
+@conditional_history(conversation_etag)
+@crypto_bound
+@rate_limited(cost=1)
 def get_conversation_messages(current_user, user_origen, user_destino):
     """
     FLUJO DE RECEPCIÓN CORRECTO:
@@ -196,6 +599,8 @@ def get_conversation_messages(current_user, user_origen, user_destino):
     2. Verifica la integridad (firma del mensaje cifrado)
     3. Si la firma es válida, descifra el mensaje
     4. Muestra mensaje descifrado + estado de firma en frontend
+
+    Con If-None-Match igual al ETag (último mensaje + página) responde 304 sin descifrar.
     """
     db = get_db()
     
@@ -205,7 +610,8 @@ def get_conversation_messages(current_user, user_origen, user_destino):
         return jsonify({'error': 'No tienes permisos para ver esta conversación'}), 403
     
     # Obtener usuario actual completo
-    user_from_db = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+    usuarios = identity_map(db)
+    user_from_db = usuarios.get_user(current_user['_id'])
     if not user_from_db:
         return jsonify({'error': 'Usuario no encontrado'}), 404
     
@@ -223,166 +629,14 @@ def get_conversation_messages(current_user, user_origen, user_destino):
     decrypted_messages = []
     
     for msg in messages:
-        try:
-            sender_id = str(msg['sender_id'])
-            recipient_id = str(msg['recipient_id'])
-            
-            print(f"\n📨 Procesando mensaje ID: {msg['_id']}")
-            print(f"   De: {sender_id} → Para: {recipient_id}")
-            
-            # === VERIFICAR SISTEMA (v2 = nuevo, v1 = antiguo) ===
-            is_new_system = msg.get('version') == 'v2_correct_flow'
-            
-            if is_new_system:
-                print(f"🆕 Sistema NUEVO (v2) - Flujo correcto")
-                
-                # === PASO 1: OBTENER CLAVE CIFRADA CORRECTA ===
-                if current_user_id == sender_id:
-                    encrypted_key = base64.b64decode(msg['encrypted_key_sender'])
-                    print(f"🔓 Usando clave para EMISOR")
-                elif current_user_id == recipient_id:
-                    encrypted_key = base64.b64decode(msg['encrypted_key_recipient'])
-                    print(f"🔓 Usando clave para DESTINATARIO")
-                else:
-                    continue
-                
-                # === PASO 2: DESCIFRAR CLAVE AES ===
-                aes_key = decrypt_with_private_key(encrypted_key, user_from_db['private_key'])
-                print(f"🔑 Clave AES descifrada")
-                
-                # === PASO 3: VERIFICAR INTEGRIDAD (FIRMA) ===
-                ciphertext_b64 = msg['ciphertext']
-                firma_digital = msg['digital_signature']
-                
-                # Obtener clave pública del emisor para verificar firma
-                emisor = db.users.find_one({'_id': msg['sender_id']})
-                verification_key = emisor.get('signing_public_key', emisor['public_key'])
-                
-                # Verificar firma del mensaje cifrado
-                signature_valid = verify_signature(verification_key, ciphertext_b64, firma_digital)
-                print(f"🔏 Verificación de integridad: {'VÁLIDA' if signature_valid else 'INVÁLIDA'}")
-                
-                # === PASO 4: SOLO SI LA FIRMA ES VÁLIDA, DESCIFRAR ===
-                if signature_valid:
-                    nonce = base64.b64decode(msg['nonce'])
-                    ciphertext = base64.b64decode(msg['ciphertext'])
-                    tag = base64.b64decode(msg['tag'])
-                    
-                    mensaje_json_descifrado = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                    mensaje_con_metadata = json.loads(mensaje_json_descifrado.decode('utf-8'))
-                    
-                    content = mensaje_con_metadata['mensaje']
-                    print(f"✅ Mensaje descifrado: {content[:50]}...")
-                else:
-                    content = "[MENSAJE CORRUPTO - Firma inválida]"
-                    print(f"❌ Mensaje rechazado por firma inválida")
-                
-                decrypted_messages.append({
-                    'id': str(msg['_id']),
-                    'sender_id': sender_id,
-                    'recipient_id': recipient_id,
-                    'content': content,
-                    'timestamp': msg['timestamp'],
-                    'security_info': {
-                        'is_signed': True,
-                        'signature_valid': signature_valid,
-                        'encrypted': True,
-                        'system': 'v2_correct_flow'
-                    }
-                })
-                
-            else:
-                # === COMPATIBILIDAD CON SISTEMA ANTIGUO ===
-                print(f"🔄 Sistema ANTIGUO (v1) - Compatibilidad")
-                
-                # Lógica anterior para mensajes antiguos
-                if 'encrypted_key_sender' in msg and 'encrypted_key_recipient' in msg:
-                    # Sistema de doble cifrado antiguo
-                    if current_user_id == sender_id:
-                        encrypted_key = base64.b64decode(msg['encrypted_key_sender'])
-                    elif current_user_id == recipient_id:
-                        encrypted_key = base64.b64decode(msg['encrypted_key_recipient'])
-                    else:
-                        continue
-                        
-                    aes_key = decrypt_with_private_key(encrypted_key, user_from_db['private_key'])
-                    nonce = base64.b64decode(msg['nonce'])
-                    ciphertext = base64.b64decode(msg['ciphertext'])
-                    tag = base64.b64decode(msg['tag'])
-                    
-                    mensaje_json_descifrado = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                    mensaje_con_firma = json.loads(mensaje_json_descifrado.decode('utf-8'))
-                    content = mensaje_con_firma['mensaje']
-                    
-                    # Verificar firma del mensaje original (sistema antiguo)
-                    signature_valid = False
-                    if msg.get('is_signed', False):
-                        emisor = db.users.find_one({'_id': msg['sender_id']})
-                        if emisor:
-                            verification_key = emisor.get('signing_public_key', emisor['public_key'])
-                            signature_valid = verify_signature(
-                                verification_key,
-                                mensaje_con_firma['mensaje'],
-                                mensaje_con_firma['firma']
-                            )
-                    
-                    decrypted_messages.append({
-                        'id': str(msg['_id']),
-                        'sender_id': sender_id,
-                        'recipient_id': recipient_id,
-                        'content': content,
-                        'timestamp': msg['timestamp'],
-                        'security_info': {
-                            'is_signed': msg.get('is_signed', False),
-                            'signature_valid': signature_valid,
-                            'encrypted': True,
-                            'system': 'v1_legacy'
-                        }
-                    })
-                    
-                else:
-                    # Sistema muy antiguo - solo destinatario puede ver
-                    if current_user_id == recipient_id and 'encrypted_key' in msg:
-                        encrypted_key = base64.b64decode(msg['encrypted_key'])
-                        aes_key = decrypt_with_private_key(encrypted_key, user_from_db['private_key'])
-                        
-                        nonce = base64.b64decode(msg['nonce'])
-                        ciphertext = base64.b64decode(msg['ciphertext'])
-                        tag = base64.b64decode(msg['tag'])
-                        
-                        mensaje_json_descifrado = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                        mensaje_con_firma = json.loads(mensaje_json_descifrado.decode('utf-8'))
-                        content = mensaje_con_firma['mensaje']
-                    else:
-                        content = "[Mensaje del sistema antiguo - no visible para emisor]"
-                    
-                    decrypted_messages.append({
-                        'id': str(msg['_id']),
-                        'sender_id': sender_id,
-                        'recipient_id': recipient_id,
-                        'content': content,
-                        'timestamp': msg['timestamp'],
-                        'security_info': {
-                            'is_signed': False,
-                            'signature_valid': False,
-                            'encrypted': True,
-                            'system': 'v0_very_old'
-                        }
-                    })
-                    
-        except Exception as e:
-            print(f"❌ Error procesando mensaje {msg['_id']}: {str(e)}")
-            decrypted_messages.append({
-                'id': str(msg['_id']),
-                'sender_id': str(msg.get('sender_id', '')),
-                'recipient_id': str(msg.get('recipient_id', '')),
-                'content': 'Error al descifrar mensaje',
-                'error': f'Error: {str(e)}',
-                'timestamp': msg['timestamp'],
-                'security_info': {'is_signed': False, 'signature_valid': False, 'encrypted': True}
-            })
+        item = _decrypt_direct_message(msg, current_user_id, user_from_db, usuarios)
+        if item is not None:
+            decrypted_messages.append(item)
     
     print(f"\n📋 Total mensajes procesados: {len(decrypted_messages)}")
+    
+    # Costo variable: un descifrado RSA por mensaje de la página
+    rate_limit_charge(len(decrypted_messages))
     print(f"🔒 Todos los mensajes originales permanecen cifrados en BD")
     
     return jsonify({
@@ -408,7 +662,7 @@ def create_transaction(current_user):
     if not transaction_data:
         return jsonify({'error': 'Campo "data" es requerido'}), 400
     
-    user = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+    user = identity_map(db).get_user(current_user['_id'])
     if not user:
         return jsonify({'error': 'Usuario no encontrado'}), 404
     
@@ -423,11 +677,11 @@ def create_transaction(current_user):
         "data": transaction_data
     }
     
-    blockchain.add_block(bloque_data)
+    nuevo_bloque = blockchain.add_block(bloque_data)
     
     return jsonify({
         "mensaje": "Transacción registrada en el blockchain",
-        "block_index": len(blockchain.chain) - 1,
+        "block_index": nuevo_bloque.index,
         "transaction_type": transaction_type
     }), 201
 
@@ -440,7 +694,7 @@ def create_transaction(current_user):
 def get_blockchain_history(current_user):
     """Obtiene el historial completo del blockchain"""
     chain_data = []
-    for block in blockchain.chain:
+    for block in blockchain.iter_blocks():
         block_info = {
             'index': block.index,
             'timestamp': block.timestamp,
@@ -452,19 +706,83 @@ def get_blockchain_history(current_user):
     
     return jsonify({
         'blockchain_info': {
-            'total_blocks': len(blockchain.chain),
+            'total_blocks': len(chain_data),
             'is_valid': blockchain.is_chain_valid(),
-            'latest_block_hash': blockchain.get_latest_block().hash
+            'latest_block_hash': chain_data[-1]['hash'],
+            'memory': blockchain.memory_stats()
         },
         'blocks': chain_data
     }), 200
 
 
+# ===============================================
+# 5.1 GET /transactions/by-message/<message_id> - Bloque de un mensaje
+# ===============================================
+@chat_bp.route('/transactions/by-message/<message_id>', methods=['GET'])
+@token_required
+def get_message_transaction(current_user, message_id):
+    """
+    Devuelve el bloque que registra un mensaje junto con los hashes de sus
+    bloques vecinos, para verificar el enlace sin descargar la cadena.
+    Usa el índice mensaje → bloque de 'message_chain'.
+    """
+    db = get_db()
+
+    ubicacion = ledger.locate_message(message_id)
+    if not ubicacion:
+        return jsonify({'error': 'El mensaje no está registrado en el blockchain'}), 404
+
+    block = ubicacion['block']
+    current_user_id = str(current_user['_id'])
+    if block.data.get('grupo_id'):
+        es_participante = db.groups.count_documents(
+            {'_id': block.data['grupo_id'], 'members': current_user_id}, limit=1
+        ) > 0
+    else:
+        es_participante = current_user_id in block_participants(block.data)
+    if not es_participante:
+        return jsonify({'error': 'No tienes permisos para ver esta transacción'}), 403
+
+    previous = ubicacion['previous']
+    following = ubicacion['next']
+
+    # Comparar el digest del bloque con el mensaje tal como está guardado
+    digest_matches = None
+    if block.data.get('digest') and ObjectId.is_valid(message_id):
+        mensaje = db.messages.find_one(
+            {'_id': ObjectId(message_id)},
+            projection={'ciphertext': 1, 'digital_signature': 1}
+        )
+        if mensaje:
+            digest_matches = block.data['digest'] == message_digest(
+                mensaje['ciphertext'],
+                mensaje['digital_signature']
+            )
+
+    return jsonify({
+        'message_id': message_id,
+        'chain_id': ubicacion['chain_id'],
+        'block': block.to_dict(),
+        'neighbors': {
+            'previous': previous,
+            'next': following
+        },
+        'verification': {
+            'block_hash_valid': block.hash == block.calculate_hash(),
+            'linked_to_previous': previous is not None and previous['hash'] == block.previous_hash,
+            'linked_to_next': following is None or following['previous_hash'] == block.hash,
+            'digest_matches': digest_matches
+        }
+    }), 200
+
+
 # ===============================================
 # 6. POST /groups - Crear grupo con flujo correcto
 # ===============================================
 @chat_bp.route('/groups', methods=['POST'])
 @token_required
+@crypto_bound
+@rate_limited(cost=2)
 def create_group(current_user):
     """Crea un nuevo grupo seguro"""
     db = get_db()
@@ -478,7 +796,8 @@ def create_group(current_user):
     
     try:
         # Obtener usuario actual completo
-        admin = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+        usuarios = identity_map(db)
+        admin = usuarios.get_user(current_user['_id'])
         if not admin:
             return jsonify({'error': 'Usuario administrador no encontrado'}), 404
         
@@ -492,7 +811,7 @@ def create_group(current_user):
         aes_key = key_manager.create_group(group_id, str(current_user['_id']), group_name)
         
         # Agregar clave cifrada para el admin
-        encrypted_key_admin = encrypt_with_public_key(aes_key, admin['public_key'])
+        encrypted_key_admin = run_crypto(encrypt_with_public_key, aes_key, admin['public_key'])
         db.group_keys.insert_one({
             'group_id': group_id,
             'user_id': str(current_user['_id']),
@@ -501,11 +820,12 @@ def create_group(current_user):
             'added_at': datetime.utcnow()
         })
         
-        # Agregar miembros adicionales si se especificaron
+        # Agregar miembros adicionales si se especificaron (leídos en una sola consulta)
+        usuarios.get_users(member_ids)
         added_members = []
         for member_id in member_ids:
             try:
-                member = db.users.find_one({'_id': ObjectId(member_id)})
+                member = usuarios.get_user(member_id)
                 if member:
                     key_manager.add_member_to_group(
                         group_id,
@@ -522,6 +842,10 @@ def create_group(current_user):
             except Exception as e:
                 print(f"❌ Error agregando miembro {member_id}: {str(e)}")
         
+        # Costo variable: la clave del grupo se descifra y cifra por cada miembro agregado
+        rate_limit_charge(len(added_members))
+        inbox.record_group(db, usuarios.get_group(group_id))
+        
         return jsonify({
             'status': 'Grupo creado exitosamente',
             'group_id': group_id,
@@ -547,22 +871,34 @@ def create_group(current_user):
 # ===============================================
 @chat_bp.route('/groups', methods=['GET'])
 @token_required
+@rate_limited(cost=1)
 def get_user_groups(current_user):
-    """Obtiene todos los grupos donde el usuario es miembro"""
+    """
+    Obtiene todos los grupos donde el usuario es miembro. El último mensaje
+    y los no leídos salen de la bandeja de entrada (una consulta, sin
+    descifrar): el contenido se lee del historial, del stream o de /sync.
+    """
     db = get_db()
     
     try:
         current_user_id = str(current_user['_id'])
         
         # Buscar grupos donde el usuario es miembro
-        groups = db.groups.find({'members': current_user_id})
+        usuarios = identity_map(db)
+        groups = [usuarios.add_group(group) for group in db.groups.find({'members': current_user_id})]
+        
+        # Leer de una vez a todos los miembros de todos los grupos
+        usuarios.get_users(member_id for group in groups for member_id in group.get('members', []))
+        
+        inbox.ensure_inbox(db)
+        summaries = inbox.group_summaries(db, [group['_id'] for group in groups])
         
         user_groups = []
         for group in groups:
             # Obtener información de miembros
             member_details = []
             for member_id in group.get('members', []):
-                member = db.users.find_one({'_id': ObjectId(member_id)})
+                member = usuarios.get_user(member_id)
                 if member:
                     member_details.append({
                         'id': member_id,
@@ -570,37 +906,8 @@ def get_user_groups(current_user):
                         'email': member['email']
                     })
             
-            # Obtener último mensaje del grupo
-            last_message = db.messages.find_one(
-                {'group_id': group['_id'], 'is_group': True},
-                sort=[('timestamp', -1)]
-            )
-            
-            last_message_preview = 'Sin mensajes'
-            last_message_time = None
-            if last_message:
-                # Intentar descifrar para preview
-                try:
-                    key_manager = GroupKeyManager(db)
-                    aes_key = key_manager.get_group_key_for_user(
-                        group['_id'],
-                        current_user_id,
-                        current_user['private_key']
-                    )
-                    
-                    nonce = base64.b64decode(last_message['nonce'])
-                    ciphertext = base64.b64decode(last_message['ciphertext'])
-                    tag = base64.b64decode(last_message['tag'])
-                    
-                    mensaje_json = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                    mensaje_data = json.loads(mensaje_json.decode('utf-8'))
-                    
-                    # Preview corto
-                    content = mensaje_data['mensaje']
-                    last_message_preview = content[:50] + '...' if len(content) > 50 else content
-                    last_message_time = last_message['timestamp']
-                except:
-                    last_message_preview = 'Mensaje cifrado'
+            summary = summaries.get(group['_id'], {})
+            last_message = summary.get('last_message')
             
             user_groups.append({
                 'id': group['_id'],
@@ -609,8 +916,13 @@ def get_user_groups(current_user):
                 'is_admin': group['admin_id'] == current_user_id,
                 'member_count': len(group.get('members', [])),
                 'members': member_details,
-                'last_message': last_message_preview,
-                'last_message_time': last_message_time,
+                'last_message': {
+                    'id': str(last_message['id']),
+                    'sender_id': last_message['sender_id'],
+                    'timestamp': last_message['timestamp']
+                } if last_message else None,
+                'last_message_time': last_message['timestamp'] if last_message else None,
+                'unread': summary.get('unread', {}).get(current_user_id, 0),
                 'created_at': group.get('created_at')
             })
         
@@ -631,6 +943,8 @@ def get_user_groups(current_user):
 # ===============================================
 @chat_bp.route('/groups/<group_id>/messages', methods=['POST'])
 @token_required
+@crypto_bound
+@rate_limited(cost=3)
 def send_group_message(current_user, group_id):
     """
     Envía mensaje a grupo con FLUJO CORRECTO:
@@ -647,13 +961,14 @@ def send_group_message(current_user, group_id):
     
     try:
         # Obtener usuario completo
-        user = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+        usuarios = identity_map(db)
+        user = usuarios.get_user(current_user['_id'])
         if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
         # Verificar que el usuario es miembro del grupo
-        group = db.groups.find_one({'_id': group_id, 'members': str(current_user['_id'])})
-        if not group:
+        group = usuarios.get_group(group_id)
+        if not group or str(current_user['_id']) not in group['members']:
             return jsonify({'error': 'No eres miembro de este grupo'}), 403
         
         print(f"👥 Enviando mensaje grupal de {user['email']} al grupo '{group['name']}'")
@@ -680,7 +995,7 @@ def send_group_message(current_user, group_id):
         mensaje_json = json.dumps(mensaje_con_metadata)
         
         # Cifrar con la clave del grupo
-        nonce, ciphertext, tag = encrypt_aes_gcm(mensaje_json, aes_key)
+        nonce, ciphertext, tag = run_crypto(encrypt_aes_gcm, mensaje_json, aes_key)
         print(f"✅ Mensaje cifrado - Tamaño: {len(ciphertext)} bytes")
         
         # === PASO 2: FIRMAR EL MENSAJE CIFRADO ===
@@ -689,7 +1004,7 @@ def send_group_message(current_user, group_id):
         # Firmar el mensaje cifrado (no el original)
         mensaje_para_firmar = base64.b64encode(ciphertext).decode('utf-8')
         signing_key = user.get('signing_private_key', user['private_key'])
-        firma_digital = sign_message(signing_key, mensaje_para_firmar)
+        firma_digital = run_crypto(sign_message, signing_key, mensaje_para_firmar)
         
         print(f"✅ Firma digital generada")
         
@@ -717,6 +1032,20 @@ def send_group_message(current_user, group_id):
         }
         
         result = db.messages.insert_one(mensaje_seguro)
+        broker.publish(mensaje_seguro, message_audience(mensaje_seguro, group))
+        inbox.record_group_message(db, mensaje_seguro, group)
+        
+        # Registro en el blockchain (subcadena del grupo en modo sharded)
+        bloque = ledger.record(
+            compact_message_payload(
+                result.inserted_id,
+                mensaje_seguro['ciphertext'],
+                firma_digital,
+                [current_user['_id']],
+                group_id=group_id
+            ),
+            group_chain_id(group_id)
+        )
         
         print(f"✅ GUARDADO GRUPAL COMPLETO:")
         print(f"  - Mensaje original: NUNCA se guarda")
@@ -727,6 +1056,7 @@ def send_group_message(current_user, group_id):
         return jsonify({
             'status': 'Mensaje grupal enviado exitosamente',
             'message_id': str(result.inserted_id),
+            'blockchain_recorded': bloque is not None,
             'group_id': group_id,
             'group_name': group['name'],
             'security_features': {
@@ -745,29 +1075,225 @@ def send_group_message(current_user, group_id):
             'details': str(e)
         }), 500
 
+def _decrypt_group_message(msg, group_id, key_version, aes_key, usuarios):
+    """
+    Descifra un mensaje de grupo con la clave AES vigente del grupo.
+
+    Returns:
+        dict: Mensaje para la respuesta, o None si el emisor ya no existe
+    """
+    try:
+        sender_id = str(msg['sender_id'])
+
+        print(f"📨 Procesando mensaje grupal ID: {msg['_id']}")
+
+        # === VERIFICAR SISTEMA (v2 = nuevo, v1 = antiguo) ===
+        is_new_system = msg.get('version') == 'v2_group_correct_flow'
+
+        if is_new_system:
+            print(f"🆕 Sistema NUEVO (v2) - Flujo correcto grupal")
+
+            # === PASO 1: VERIFICAR INTEGRIDAD (FIRMA) ===
+            ciphertext_b64 = msg['ciphertext']
+            firma_digital = msg['digital_signature']
+
+            # Obtener clave pública del emisor
+            emisor = usuarios.get_user(msg['sender_id'])
+            if not emisor:
+                return None
+
+            verification_key = emisor.get('signing_public_key', emisor['public_key'])
+            signature_valid = run_crypto(verify_signature, verification_key, ciphertext_b64, firma_digital)
+
+            print(f"🔏 Verificación de integridad: {'VÁLIDA' if signature_valid else 'INVÁLIDA'}")
+
+            # === PASO 2: SOLO SI FIRMA VÁLIDA, DESCIFRAR ===
+            if signature_valid:
+                nonce = base64.b64decode(msg['nonce'])
+                ciphertext = base64.b64decode(msg['ciphertext'])
+                tag = base64.b64decode(msg['tag'])
+
+                mensaje_json = run_crypto(decrypt_aes_gcm, ciphertext, aes_key, nonce, tag)
+                mensaje_data = json.loads(mensaje_json.decode('utf-8'))
+
+                content = mensaje_data['mensaje']
+                sender_name = mensaje_data.get('emisor_nombre', 'Usuario desconocido')
+
+                print(f"✅ Mensaje grupal descifrado: {content[:50]}... de {sender_name}")
+            else:
+                content = "[MENSAJE CORRUPTO - Firma inválida]"
+                sender_name = "Desconocido"
+                print(f"❌ Mensaje grupal rechazado por firma inválida")
+
+            return {
+                'id': str(msg['_id']),
+                'sender_id': sender_id,
+                'sender_name': sender_name,
+                'group_id': group_id,
+                'content': content,
+                'timestamp': msg['timestamp'],
+                'security_info': {
+                    'is_signed': True,
+                    'signature_valid': signature_valid,
+                    'encrypted': True,
+                    'system': 'v2_group_correct_flow'
+                }
+            }
+
+        else:
+            # === COMPATIBILIDAD CON SISTEMA ANTIGUO ===
+            print(f"🔄 Sistema ANTIGUO (v1) - Compatibilidad grupal")
+
+            # Solo intentar si la versión de clave coincide
+            if msg.get('key_version', 1) == key_version:
+                nonce = base64.b64decode(msg['nonce'])
+                ciphertext = base64.b64decode(msg['ciphertext'])
+                tag = base64.b64decode(msg['tag'])
+
+                mensaje_json = run_crypto(decrypt_aes_gcm, ciphertext, aes_key, nonce, tag)
+                mensaje_con_firma = json.loads(mensaje_json.decode('utf-8'))
+
+                content = mensaje_con_firma['mensaje']
+
+                # Verificar firma del mensaje original (sistema antiguo)
+                signature_valid = False
+                if msg.get('is_signed', False):
+                    emisor = usuarios.get_user(msg['sender_id'])
+                    if emisor:
+                        verification_key = emisor.get('signing_public_key', emisor['public_key'])
+                        signature_valid = run_crypto(
+                            verify_signature,
+                            verification_key,
+                            content,
+                            mensaje_con_firma['firma']
+                        )
+
+                # Obtener nombre del emisor
+                emisor = usuarios.get_user(msg['sender_id'])
+                sender_name = f"{emisor['givenName']} {emisor['familyName']}" if emisor else "Usuario desconocido"
+
+                return {
+                    'id': str(msg['_id']),
+                    'sender_id': sender_id,
+                    'sender_name': sender_name,
+                    'group_id': group_id,
+                    'content': content,
+                    'timestamp': msg['timestamp'],
+                    'security_info': {
+                        'is_signed': msg.get('is_signed', False),
+                        'signature_valid': signature_valid,
+                        'encrypted': True,
+                        'system': 'v1_group_legacy'
+                    }
+                }
+            else:
+                return {
+                    'id': str(msg['_id']),
+                    'sender_id': sender_id,
+                    'sender_name': 'Sistema',
+                    'group_id': group_id,
+                    'content': 'Este mensaje usa una versión antigua de clave',
+                    'timestamp': msg['timestamp'],
+                    'security_info': {
+                        'is_signed': False,
+                        'signature_valid': False,
+                        'encrypted': True,
+                        'system': 'v0_old_key'
+                    }
+                }
+
+    except Exception as e:
+        print(f"❌ Error procesando mensaje grupal {msg['_id']}: {str(e)}")
+        return {
+            'id': str(msg['_id']),
+            'sender_id': str(msg.get('sender_id', '')),
+            'sender_name': 'Error',
+            'group_id': group_id,
+            'content': 'Error al descifrar mensaje',
+            'error': f'Error: {str(e)}',
+            'timestamp': msg['timestamp'],
+            'security_info': {'is_signed': False, 'signature_valid': False, 'encrypted': True}
+        }
+
+
+class _MessageDecryptor:
+    """
+    Descifra mensajes directos y de grupo de cualquier conversación de un
+    usuario (stream SSE, sincronización). Las claves de grupo se descifran
+    una vez y se vuelven a leer si aparece un mensaje con una versión de
+    clave más nueva (rotación).
+    """
+
+    def __init__(self, db, current_user_id, user_from_db, usuarios):
+        self.db = db
+        self.current_user_id = current_user_id
+        self.user_from_db = user_from_db
+        self.usuarios = usuarios
+        self.group_keys = {}   # group_id -> (key_version, aes_key)
+
+    def decrypt(self, msg):
+        """
+        Returns:
+            tuple: ('message' | 'group_message', mensaje descifrado), o None si el usuario no puede verlo
+        """
+        if not msg.get('is_group'):
+            item = _decrypt_direct_message(msg, self.current_user_id, self.user_from_db, self.usuarios)
+            return ('message', item) if item is not None else None
+        
+        group_id = msg['group_id']
+        cached = self.group_keys.get(group_id)
+        if cached is None or msg.get('key_version', 1) > cached[0]:
+            if cached is not None:
+                self.usuarios.forget_group(group_id)
+            group = self.usuarios.get_group(group_id)
+            if not group or self.current_user_id not in group['members']:
+                return None
+            try:
+                aes_key = GroupKeyManager(self.db).get_group_key_for_user(
+                    group_id, self.current_user_id, self.user_from_db['private_key']
+                )
+            except CryptoOverloaded:
+                # g.crypto_overloaded ya quedó marcado: la ruta responde 503 / retry
+                return None
+            except ValueError as e:
+                print(f"❌ Sin acceso a la clave del grupo {group_id}: {str(e)}")
+                return None
+            cached = self.group_keys[group_id] = (group['key_version'], aes_key)
+        
+        item = _decrypt_group_message(msg, group_id, cached[0], cached[1], self.usuarios)
+        return ('group_message', item) if item is not None else None
+
+
 # ===============================================
 # 9. GET /groups/<group_id>/messages - Obtener mensajes del grupo
 # ===============================================
 @chat_bp.route('/groups/<group_id>/messages', methods=['GET'])
 @token_required
+@conditional_history(group_history_etag)
+@crypto_bound
+@rate_limited(cost=2)
 def get_group_messages(current_user, group_id):
     """
     Obtiene mensajes de grupo con FLUJO CORRECTO:
     1. Verifica integridad (firma del mensaje cifrado)
     2. Si válido, descifra con clave del grupo
     3. Muestra mensaje + info del emisor
+
+    Con If-None-Match igual al ETag (último mensaje + versión de clave + página)
+    responde 304 sin descifrar.
     """
     db = get_db()
     
     try:
         # Obtener usuario completo
-        user = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+        usuarios = identity_map(db)
+        user = usuarios.get_user(current_user['_id'])
         if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
         # Verificar que el usuario es miembro del grupo
-        group = db.groups.find_one({'_id': group_id, 'members': str(current_user['_id'])})
-        if not group:
+        group = usuarios.get_group(group_id)
+        if not group or str(current_user['_id']) not in group['members']:
             return jsonify({'error': 'No eres miembro de este grupo'}), 403
         
         print(f"👥 Obteniendo mensajes del grupo '{group['name']}' para {user['email']}")
@@ -789,140 +1315,15 @@ def get_group_messages(current_user, group_id):
         decrypted_messages = []
         
         for msg in messages:
-            try:
-                sender_id = str(msg['sender_id'])
-                
-                print(f"📨 Procesando mensaje grupal ID: {msg['_id']}")
-                
-                # === VERIFICAR SISTEMA (v2 = nuevo, v1 = antiguo) ===
-                is_new_system = msg.get('version') == 'v2_group_correct_flow'
-                
-                if is_new_system:
-                    print(f"🆕 Sistema NUEVO (v2) - Flujo correcto grupal")
-                    
-                    # === PASO 1: VERIFICAR INTEGRIDAD (FIRMA) ===
-                    ciphertext_b64 = msg['ciphertext']
-                    firma_digital = msg['digital_signature']
-                    
-                    # Obtener clave pública del emisor
-                    emisor = db.users.find_one({'_id': msg['sender_id']})
-                    if not emisor:
-                        continue
-                        
-                    verification_key = emisor.get('signing_public_key', emisor['public_key'])
-                    signature_valid = verify_signature(verification_key, ciphertext_b64, firma_digital)
-                    
-                    print(f"🔏 Verificación de integridad: {'VÁLIDA' if signature_valid else 'INVÁLIDA'}")
-                    
-                    # === PASO 2: SOLO SI FIRMA VÁLIDA, DESCIFRAR ===
-                    if signature_valid:
-                        nonce = base64.b64decode(msg['nonce'])
-                        ciphertext = base64.b64decode(msg['ciphertext'])
-                        tag = base64.b64decode(msg['tag'])
-                        
-                        mensaje_json = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                        mensaje_data = json.loads(mensaje_json.decode('utf-8'))
-                        
-                        content = mensaje_data['mensaje']
-                        sender_name = mensaje_data.get('emisor_nombre', 'Usuario desconocido')
-                        
-                        print(f"✅ Mensaje grupal descifrado: {content[:50]}... de {sender_name}")
-                    else:
-                        content = "[MENSAJE CORRUPTO - Firma inválida]"
-                        sender_name = "Desconocido"
-                        print(f"❌ Mensaje grupal rechazado por firma inválida")
-                    
-                    decrypted_messages.append({
-                        'id': str(msg['_id']),
-                        'sender_id': sender_id,
-                        'sender_name': sender_name,
-                        'group_id': group_id,
-                        'content': content,
-                        'timestamp': msg['timestamp'],
-                        'security_info': {
-                            'is_signed': True,
-                            'signature_valid': signature_valid,
-                            'encrypted': True,
-                            'system': 'v2_group_correct_flow'
-                        }
-                    })
-                    
-                else:
-                    # === COMPATIBILIDAD CON SISTEMA ANTIGUO ===
-                    print(f"🔄 Sistema ANTIGUO (v1) - Compatibilidad grupal")
-                    
-                    # Solo intentar si la versión de clave coincide
-                    if msg.get('key_version', 1) == group['key_version']:
-                        nonce = base64.b64decode(msg['nonce'])
-                        ciphertext = base64.b64decode(msg['ciphertext'])
-                        tag = base64.b64decode(msg['tag'])
-                        
-                        mensaje_json = decrypt_aes_gcm(ciphertext, aes_key, nonce, tag)
-                        mensaje_con_firma = json.loads(mensaje_json.decode('utf-8'))
-                        
-                        content = mensaje_con_firma['mensaje']
-                        
-                        # Verificar firma del mensaje original (sistema antiguo)
-                        signature_valid = False
-                        if msg.get('is_signed', False):
-                            emisor = db.users.find_one({'_id': msg['sender_id']})
-                            if emisor:
-                                verification_key = emisor.get('signing_public_key', emisor['public_key'])
-                                signature_valid = verify_signature(
-                                    verification_key,
-                                    content,
-                                    mensaje_con_firma['firma']
-                                )
-                        
-                        # Obtener nombre del emisor
-                        emisor = db.users.find_one({'_id': msg['sender_id']})
-                        sender_name = f"{emisor['givenName']} {emisor['familyName']}" if emisor else "Usuario desconocido"
-                        
-                        decrypted_messages.append({
-                            'id': str(msg['_id']),
-                            'sender_id': sender_id,
-                            'sender_name': sender_name,
-                            'group_id': group_id,
-                            'content': content,
-                            'timestamp': msg['timestamp'],
-                            'security_info': {
-                                'is_signed': msg.get('is_signed', False),
-                                'signature_valid': signature_valid,
-                                'encrypted': True,
-                                'system': 'v1_group_legacy'
-                            }
-                        })
-                    else:
-                        decrypted_messages.append({
-                            'id': str(msg['_id']),
-                            'sender_id': sender_id,
-                            'sender_name': 'Sistema',
-                            'group_id': group_id,
-                            'content': 'Este mensaje usa una versión antigua de clave',
-                            'timestamp': msg['timestamp'],
-                            'security_info': {
-                                'is_signed': False,
-                                'signature_valid': False,
-                                'encrypted': True,
-                                'system': 'v0_old_key'
-                            }
-                        })
-                        
-            except Exception as e:
-                print(f"❌ Error procesando mensaje grupal {msg['_id']}: {str(e)}")
-                decrypted_messages.append({
-                    'id': str(msg['_id']),
-                    'sender_id': str(msg.get('sender_id', '')),
-                    'sender_name': 'Error',
-                    'group_id': group_id,
-                    'content': 'Error al descifrar mensaje',
-                    'error': f'Error: {str(e)}',
-                    'timestamp': msg['timestamp'],
-                    'security_info': {'is_signed': False, 'signature_valid': False, 'encrypted': True}
-                })
+            item = _decrypt_group_message(msg, group_id, group['key_version'], aes_key, usuarios)
+            if item is not None:
+                decrypted_messages.append(item)
         
         print(f"📋 Total mensajes grupales procesados: {len(decrypted_messages)}")
         
+        # Costo variable: verificación y descifrado por mensaje de la página
+        rate_limit_charge(len(decrypted_messages))
+        
         return jsonify({
             'group_id': group_id,
             'group_name': group['name'],
@@ -944,6 +1345,7 @@ def get_group_messages(current_user, group_id):
 # ===============================================
 @chat_bp.route('/groups/<group_id>/members', methods=['POST'])
 @token_required
+@crypto_bound
 def add_group_member(current_user, group_id):
     """Agrega un nuevo miembro al grupo"""
     db = get_db()
@@ -955,12 +1357,13 @@ def add_group_member(current_user, group_id):
     
     try:
         # Obtener usuario actual (admin)
-        admin = db.users.find_one({'_id': ObjectId(current_user['_id'])})
+        usuarios = identity_map(db)
+        admin = usuarios.get_user(current_user['_id'])
         if not admin:
             return jsonify({'error': 'Usuario administrador no encontrado'}), 404
         
         # Obtener nuevo miembro
-        new_member = db.users.find_one({'_id': ObjectId(new_member_id)})
+        new_member = usuarios.get_user(new_member_id)
         if not new_member:
             return jsonify({'error': 'Usuario a agregar no encontrado'}), 404
         
@@ -976,6 +1379,7 @@ def add_group_member(current_user, group_id):
         )
         
         if success:
+            inbox.record_group(db, usuarios.get_group(group_id))
             return jsonify({
                 'status': 'Miembro añadido exitosamente',
                 'group_id': group_id,
@@ -1001,6 +1405,7 @@ def add_group_member(current_user, group_id):
 # ===============================================
 @chat_bp.route('/groups/<group_id>/key/rotate', methods=['POST'])
 @token_required
+@crypto_bound
 def rotate_group_key(current_user, group_id):
     """Rota la clave del grupo (solo administradores)"""
     db = get_db()
@@ -1033,6 +1438,7 @@ def rotate_group_key(current_user, group_id):
 # ===============================================
 @chat_bp.route('/groups/<group_id>/members/<member_id>', methods=['DELETE'])
 @token_required
+@crypto_bound
 def remove_group_member(current_user, group_id, member_id):
     """Remueve un miembro del grupo (solo administradores)"""
     db = get_db()
@@ -1049,6 +1455,7 @@ def remove_group_member(current_user, group_id, member_id):
         )
         
         if success:
+            inbox.remove_group_member(db, group_id, member_id)
             return jsonify({
                 'status': 'Miembro removido exitosamente',
                 'group_id': group_id,
@@ -1065,4 +1472,371 @@ def remove_group_member(current_user, group_id, member_id):
         return jsonify({
             'error': 'Error al remover miembro del grupo',
             'details': str(e)
-        }), 500
\ No newline at end of file
+        }), 500
+
+
+# ===============================================
+# 13. GET /stream - Mensajes nuevos en tiempo real (SSE)
+# ===============================================
+@chat_bp.route('/stream', methods=['GET'])
+@token_required
+@rate_limited(cost=1)
+def stream_messages(current_user):
+    """
+    Stream text/event-stream con los mensajes directos y grupales nuevos del
+    usuario, ya descifrados para él. El id de cada evento es el id del
+    mensaje: al reconectar con Last-Event-ID (header o ?last_event_id=) se
+    envían primero los mensajes guardados después de ese id.
+
+    Eventos:
+        message: mensaje directo (mismo formato que GET /messages/<a>/<b>)
+        group_message: mensaje de grupo (mismo formato que GET /groups/<id>/messages)
+        resync: había más mensajes pendientes que SSE_REPLAY_LIMIT; el cliente
+            debe recargar los historiales
+    """
+    db = get_db()
+    current_user_id = str(current_user['_id'])
+    
+    usuarios = identity_map(db)
+    user_from_db = usuarios.get_user(current_user['_id'])
+    if not user_from_db:
+        return jsonify({'error': 'Usuario no encontrado'}), 404
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id and not ObjectId.is_valid(last_event_id):
+        return jsonify({'error': 'Last-Event-ID inválido'}), 400
+    
+    # Suscribirse antes de leer lo pendiente: lo que llegue entre medio queda en la cola
+    subscription = broker.subscribe(current_user_id)
+    print(f"📡 Stream abierto para {user_from_db['email']} (conexiones: {broker.connection_count()})")
+    
+    decryptor = _MessageDecryptor(db, current_user_id, user_from_db, usuarios)
+    
+    def event(msg):
+        rendered = decryptor.decrypt(msg)
+        if rendered is None:
+            return None
+        rate_limit_charge(1)
+        return f"id: {msg['_id']}\nevent: {rendered[0]}\ndata: {flask_json.dumps(rendered[1])}\n\n"
+    
+    def overloaded_retry():
+        # Ejecutor saturado: cerrar sin avanzar el id, el cliente reintenta más tarde
+        return f"retry: {max(1, round(g.crypto_overloaded.estimated_wait)) * 1000}\n\n"
+    
+    def generate():
+        started = time.monotonic()
+        replayed = set()
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            
+            if last_event_id:
+                group_ids = [group['_id'] for group in db.groups.find({'members': current_user_id}, {'_id': 1})]
+                pending = list(db.messages.find({
+                    '_id': {'$gt': ObjectId(last_event_id)},
+                    '$or': [
+                        {'is_group': {'$ne': True}, 'sender_id': ObjectId(current_user_id)},
+                        {'is_group': {'$ne': True}, 'recipient_id': ObjectId(current_user_id)},
+                        {'is_group': True, 'group_id': {'$in': group_ids}}
+                    ]
+                }).sort('_id', 1).limit(SSE_REPLAY_LIMIT + 1))
+                
+                if len(pending) > SSE_REPLAY_LIMIT:
+                    yield "event: resync\ndata: {}\n\n"
+                    pending = []
+                for msg in pending:
+                    replayed.add(msg['_id'])
+                    data = event(msg)
+                    if g.get('crypto_overloaded'):
+                        yield overloaded_retry()
+                        return
+                    if data:
+                        yield data
+            
+            while time.monotonic() - started < SSE_MAX_DURATION:
+                msg = subscription.get(timeout=SSE_HEARTBEAT)
+                if subscription.overflowed:
+                    # Cliente demasiado lento: que se reconecte y recupere desde la BD
+                    return
+                if msg is None:
+                    yield ": keepalive\n\n"
+                    continue
+                if msg['_id'] in replayed:
+                    continue
+                data = event(msg)
+                if g.get('crypto_overloaded'):
+                    yield overloaded_retry()
+                    return
+                if data:
+                    yield data
+        finally:
+            broker.unsubscribe(subscription)
+            print(f"📡 Stream cerrado para {user_from_db['email']}")
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# ===============================================
+# 14. POST /sync - Mensajes nuevos desde las marcas del cliente
+# ===============================================
+@chat_bp.route('/sync', methods=['POST'])
+@token_required
+@crypto_bound
+@rate_limited(cost=2)
+def sync_messages(current_user):
+    """
+    Sincronización incremental: devuelve sólo los mensajes posteriores a las
+    marcas del cliente en todas sus conversaciones (directas y grupos), ya
+    descifrados, junto con las marcas nuevas y tombstones:
+
+        group_removed: el usuario ya no es miembro de un grupo que tenía marca
+        key_rotated: la clave del grupo cambió desde la key_version del cliente
+
+    Si has_more es true, el cliente vuelve a llamar con las marcas devueltas.
+    """
+    db = get_db()
+    current_user_id = str(current_user['_id'])
+    
+    try:
+        sync = parse_sync_request(request.get_json(silent=True))
+    except SyncRequestError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    usuarios = identity_map(db)
+    user_from_db = usuarios.get_user(current_user['_id'])
+    if not user_from_db:
+        return jsonify({'error': 'Usuario no encontrado'}), 404
+    
+    groups = {group['_id']: usuarios.add_group(group) for group in db.groups.find({'members': current_user_id})}
+    
+    tombstones = []
+    for group_id, (_, key_version) in sync['groups'].items():
+        if group_id not in groups:
+            tombstones.append({'type': 'group_removed', 'group_id': group_id})
+        elif key_version is not None and key_version != groups[group_id]['key_version']:
+            tombstones.append({
+                'type': 'key_rotated',
+                'group_id': group_id,
+                'previous_key_version': key_version,
+                'key_version': groups[group_id]['key_version']
+            })
+    
+    ensure_message_indexes(db)
+    pending = list(
+        db.messages.find(sync_query(current_user_id, sync, list(groups)))
+        .sort('_id', 1)
+        .limit(sync['limit'] + 1)
+    )
+    truncated = len(pending) > sync['limit']
+    pending = pending[:sync['limit']]
+    
+    decryptor = _MessageDecryptor(db, current_user_id, user_from_db, usuarios)
+    messages = []
+    conversations = {str(peer): watermark for peer, watermark in sync['conversations'].items()}
+    for msg in pending:
+        rendered = decryptor.decrypt(msg)
+        if rendered is None:
+            continue
+        kind, item = rendered
+        item['type'] = 'group' if kind == 'group_message' else 'direct'
+        messages.append(item)
+        if kind == 'message':
+            peer = item['recipient_id'] if item['sender_id'] == current_user_id else item['sender_id']
+            conversations.setdefault(peer, sync['since'])
+    
+    # Costo variable: un descifrado por mensaje entregado
+    rate_limit_charge(len(messages))
+    
+    cap = settled_cap(pending[-1]['_id'], truncated) if pending else settled_cap(None, False)
+    watermarks = {
+        'since': str(advance(sync['since'], cap)),
+        'conversations': {peer: str(advance(watermark, cap)) for peer, watermark in conversations.items()},
+        'groups': {
+            group_id: {
+                'after': str(advance(sync['groups'].get(group_id, (sync['since'], None))[0], cap)),
+                'key_version': group['key_version']
+            }
+            for group_id, group in groups.items()
+        }
+    }
+    
+    print(f"🔄 Sync de {user_from_db['email']}: {len(messages)} mensajes, {len(tombstones)} tombstones")
+    
+    return jsonify({
+        'messages': messages,
+        'message_count': len(messages),
+        'watermarks': watermarks,
+        'tombstones': tombstones,
+        'has_more': truncated
+    }), 200
+
+
+# ===============================================
+# 15. GET /inbox - Conversaciones con último mensaje y no leídos
+# ===============================================
+@chat_bp.route('/inbox', methods=['GET'])
+@token_required
+def get_inbox(current_user):
+    """
+    Lista de conversaciones (directas y grupos) del usuario, la más reciente
+    primero, con la referencia al último mensaje y sus mensajes sin leer.
+    No descifra nada: el contenido se obtiene del historial, del stream o de /sync.
+    """
+    db = get_db()
+    current_user_id = str(current_user['_id'])
+    
+    try:
+        limit = min(max(1, int(request.args.get('limit', inbox.INBOX_PAGE_SIZE))), inbox.INBOX_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit debe ser un número'}), 400
+    
+    inbox.ensure_inbox(db)
+    entries = inbox.inbox_page(db, current_user_id, limit)
+    
+    # Datos de los contactos de las conversaciones directas (una sola consulta)
+    peer_of = {
+        entry['_id']: next((m for m in entry['members'] if m != current_user_id), current_user_id)
+        for entry in entries if entry['type'] == 'direct'
+    }
+    peers = identity_map(db).get_users(peer_of.values())
+    
+    conversations = []
+    for entry in entries:
+        last_message = entry.get('last_message')
+        conversation = {
+            'id': entry['_id'],
+            'type': entry['type'],
+            'last_message': {
+                'id': str(last_message['id']),
+                'sender_id': last_message['sender_id'],
+                'timestamp': last_message['timestamp']
+            } if last_message else None,
+            'unread': entry.get('unread', {}).get(current_user_id, 0)
+        }
+        if entry['type'] == 'direct':
+            peer_id = peer_of[entry['_id']]
+            peer = peers.get(peer_id)
+            conversation['peer'] = {
+                'id': peer_id,
+                'name': f"{peer['givenName']} {peer['familyName']}" if peer else None,
+                'email': peer['email'] if peer else None
+            }
+        else:
+            conversation['group_id'] = entry['group_id']
+            conversation['name'] = entry.get('name')
+        conversations.append(conversation)
+    
+    return jsonify({
+        'conversations': conversations,
+        'count': len(conversations),
+        'total_unread': sum(conversation['unread'] for conversation in conversations)
+    }), 200
+
+
+# ===============================================
+# 16. POST /inbox/read - Marcar conversaciones como leídas
+# ===============================================
+@chat_bp.route('/inbox/read', methods=['POST'])
+@token_required
+def mark_inbox_read(current_user):
+    """
+    Pone en cero los no leídos de varias conversaciones en una sola escritura.
+    Body: {"conversations": ["dm:<a>:<b>", "group:<id>", ...]} o {"all": true}
+    """
+    db = get_db()
+    data = request.get_json(silent=True) or {}
+    
+    if data.get('all') is True:
+        conversation_ids = None
+    else:
+        conversation_ids = data.get('conversations')
+        if not isinstance(conversation_ids, list) or not all(isinstance(c, str) for c in conversation_ids):
+            return jsonify({'error': 'Se requiere "conversations" (lista de IDs) o "all": true'}), 400
+        if len(conversation_ids) > inbox.INBOX_MAX_PAGE_SIZE:
+            return jsonify({'error': f'Máximo {inbox.INBOX_MAX_PAGE_SIZE} conversaciones por petición'}), 400
+    
+    inbox.ensure_inbox(db)
+    updated = inbox.mark_read(db, current_user['_id'], conversation_ids)
+    
+    return jsonify({'status': 'Conversaciones marcadas como leídas', 'updated': updated}), 200
+
+
+# ===============================================
+# 17. GET /export - Historial cifrado en NDJSON
+# ===============================================
+@chat_bp.route('/export', methods=['GET'])
+@token_required
+@rate_limited(cost=10)
+def export_history(current_user):
+    """
+    Descarga los mensajes directos y de grupos del usuario tal como están
+    guardados (cifrados), uno por línea en NDJSON, leídos con un cursor por
+    lotes. ?since=<message_id> exporta sólo lo posterior a ese mensaje.
+    """
+    db = get_db()
+    
+    since = request.args.get('since')
+    if since and not ObjectId.is_valid(since):
+        return jsonify({'error': 'since inválido'}), 400
+    
+    lines = history_transfer.export_lines(db, str(current_user['_id']), ObjectId(since) if since else None)
+    
+    response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f"attachment; filename=historial-{current_user['_id']}.ndjson"
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# ===============================================
+# 18. POST /import - Cargar un historial NDJSON exportado
+# ===============================================
+@chat_bp.route('/import', methods=['POST'])
+@token_required
+@crypto_bound
+@rate_limited(cost=10)
+def import_history(current_user):
+    """
+    Carga un archivo de GET /export (body NDJSON, leído línea por línea).
+    Sólo se aceptan mensajes v2 enviados por el usuario (a sus
+    conversaciones o a sus grupos) con una firma que verifica contra su
+    llave; los que ya existen (mismo id) se ignoran. Si el ejecutor se
+    satura a mitad de camino responde 503 y se puede reenviar el archivo.
+    """
+    db = get_db()
+    
+    inbox.ensure_inbox(db)
+    try:
+        report = history_transfer.import_lines(
+            db,
+            history_transfer.read_lines(request.stream),
+            str(current_user['_id'])
+        )
+    except history_transfer.HistoryImportError as e:
+        return jsonify({'error': str(e)}), 400
+    except CryptoOverloaded:
+        # crypto_bound responde 503 con Retry-After
+        return jsonify({'error': 'Servidor ocupado'}), 503
+    
+    # Una ficha por cada cien firmas verificadas
+    rate_limit_charge((report['inserted'] + report['duplicates'] + report['rejected']) // 100)
+    
+    return jsonify(dict(report, status='Historial importado')), 200
+
+
+# ===============================================
+# 19. GET /metrics - Tiempos y tamaños de respuesta por endpoint
+# ===============================================
+@chat_bp.route('/metrics', methods=['GET'])
+@token_required
+def get_response_metrics(current_user):
+    """
+    Métricas de este worker desde que arrancó: tiempo de respuesta y de
+    serialización JSON, bytes generados y bytes enviados tras la compresión.
+    """
+    return jsonify({
+        'json_backend': get_json_backend().name,
+        'compression': available_encodings(),
+        'endpoints': endpoint_metrics.snapshot()
+    }), 200
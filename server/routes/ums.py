@@ -1,15 +1,21 @@
-from flask import Blueprint, request, jsonify, current_app
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Blueprint, request, current_app, url_for
+from hashing.passwords import hash_password, verify_password, PasswordPoolBusy
 import jwt
 from datetime import datetime, timedelta
 from config.database import get_db
 from utils.crypto import generate_key_pair, get_public_key_pem, get_private_key_pem
-from utils.google import get_google_tokens
-from middleware.jwt import token_required
+from utils.google import get_google_tokens, verify_id_token, GoogleAuthError
+from utils.mfa import provisioning_uri, render_qr_svg, verify_totp
+from middleware.jwt import token_required, invalidate_principal
+from utils.json_provider import jsonify
+from utils.directory import (
+    PAGE_SIZE, MAX_PAGE_SIZE, directory_fields, index_terms, bump_directory_version, directory_version,
+    parse_cursor, parse_fields, directory_page
+)
+import hashlib
 import pyotp
-import qrcode
-import io
 import base64
+import uuid
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -21,7 +27,8 @@ def generate_tokens(user_id, provider = 'local', mfa_enabled = False):
             'exp': datetime.utcnow() + timedelta(minutes=int(current_app.config['ACCESS_TOKEN_EXPIRATION_TIME'])),
             'type': 'access',
             'provider': provider,
-            'mfa_enabled': mfa_enabled
+            'mfa_enabled': mfa_enabled,
+            'jti': uuid.uuid4().hex
         },
         current_app.config['SECRET_KEY'],
         algorithm='HS256'
@@ -34,7 +41,8 @@ def generate_tokens(user_id, provider = 'local', mfa_enabled = False):
             'exp': datetime.utcnow() + timedelta(days=int(current_app.config['REFRESH_TOKEN_EXPIRATION_TIME'])),
             'type': 'refresh',
             'provider': provider,
-            'mfa_enabled': mfa_enabled
+            'mfa_enabled': mfa_enabled,
+            'jti': uuid.uuid4().hex
         },
         current_app.config['SECRET_KEY'],
         algorithm='HS256'
@@ -42,6 +50,10 @@ def generate_tokens(user_id, provider = 'local', mfa_enabled = False):
     
     return access_token, refresh_token
 
+def server_busy():
+    # the password pool is saturated: fail fast so the client retries later
+    return jsonify({'error': 'Server busy, try again later'}), 503, {'Retry-After': str(PasswordPoolBusy.retry_after)}
+
 @auth_bp.route('/register', methods=['POST'])
 def register():
     data = request.get_json()
@@ -56,16 +68,24 @@ def register():
 
     # check if the user is already registered
     existing_user = db.users.find_one({'email': data['email']})
+    if existing_user and 'password' in existing_user:
+        return jsonify({'error': 'Email already exists'}), 400
+    
+    # hash the password off the request thread (rejected fast if the pool is saturated)
+    try:
+        password_hash = hash_password(data['password'])
+    except PasswordPoolBusy:
+        return server_busy()
+    
     if existing_user:
         # if the user exists but doesn't have a password, set it
         if 'password' not in existing_user:
-            db.users.update_one({'email': data['email']}, {'$set': {'password': generate_password_hash(data['password'])}})
+            db.users.update_one({'email': data['email']}, {'$set': {'password': password_hash, 'updated_at': datetime.utcnow()}})
             # add the provider to the user
-            db.users.update_one({'email': data['email']}, {'$push': {'providers': 'local'}})
+            db.users.update_one({'email': data['email']}, {'$push': {'providers': 'local'}, '$set': {'updated_at': datetime.utcnow()}})
+            invalidate_principal(existing_user['_id'])
             userId = existing_user['_id']
             mfa_enabled = existing_user['mfa_enabled']
-        else:
-            return jsonify({'error': 'Email already exists'}), 400
     else:
         # if the user is not registered, create a new user
         user = {
@@ -73,16 +93,19 @@ def register():
             'givenName': data['givenName'],
             'familyName': data['familyName'],
             'providers': ['local'],
-            'password': generate_password_hash(data['password']),
+            'password': password_hash,
             'private_key': private_key_pem,
             'public_key': public_key_pem,
             'created_at': datetime.utcnow(),
             'mfa_secret': None,
             'mfa_enabled': False
         }
+        user.update(directory_fields(user))
     
         result = db.users.insert_one(user)
         userId = result.inserted_id
+        index_terms(db, userId, user['search_terms'])
+        bump_directory_version(db)
     
     access_token, refresh_token = generate_tokens(userId, mfa_enabled = mfa_enabled)
     
@@ -99,11 +122,25 @@ def login():
     data = request.get_json()
     db = get_db()
     
-    user = db.users.find_one({'email': data['email']})
-    mfa_enabled = user['mfa_enabled']
-    if not user or not check_password_hash(user['password'], data['password']):
+    user = db.users.find_one({'email': data['email']}, {'password': 1, 'mfa_enabled': 1})
+    if not user or 'password' not in user:
+        return jsonify({'error': 'Invalid credentials'}), 401
+    
+    try:
+        valid, upgraded_hash = verify_password(user['password'], data['password'])
+    except PasswordPoolBusy:
+        return server_busy()
+    if not valid:
         return jsonify({'error': 'Invalid credentials'}), 401
     
+    # store the hash with the current parameters (only if nobody changed it meanwhile)
+    if upgraded_hash:
+        db.users.update_one(
+            {'_id': user['_id'], 'password': user['password']},
+            {'$set': {'password': upgraded_hash, 'updated_at': datetime.utcnow()}}
+        )
+    
+    mfa_enabled = user.get('mfa_enabled', False)
     access_token, refresh_token = generate_tokens(user['_id'], mfa_enabled = mfa_enabled)
     
     return jsonify({
@@ -142,7 +179,8 @@ def refresh():
                 'exp': datetime.utcnow() + timedelta(minutes=int(current_app.config['ACCESS_TOKEN_EXPIRATION_TIME'])),
                 'type': 'access',
                 'provider': provider,
-                'mfa_enabled': mfa_enabled
+                'mfa_enabled': mfa_enabled,
+                'jti': uuid.uuid4().hex
             },
             current_app.config['SECRET_KEY'],
             algorithm='HS256'
@@ -161,6 +199,47 @@ def refresh():
 
 
 
+def upsert_oauth_user(db, provider, email, claims):
+    # returning users: one round trip that also records the provider
+    user = db.users.find_one_and_update(
+        {'email': email},
+        {'$addToSet': {'providers': provider}, '$set': {'updated_at': datetime.utcnow()}},
+        projection={'_id': 1}
+    )
+    if user:
+        return user['_id']
+
+    # first login: generate the keys and insert, unless another request won the race
+    private_key, public_key = generate_key_pair()
+    new_user = {
+        'email': email,
+        'providers': [provider],
+        'private_key': get_private_key_pem(private_key).decode('utf-8'),
+        'public_key': get_public_key_pem(public_key).decode('utf-8'),
+        'created_at': datetime.utcnow(),
+        'givenName': claims.get('given_name', ''),
+        'familyName': claims.get('family_name', ''),
+        'picture': claims.get('picture', ''),
+        'mfa_secret': None,
+        'mfa_enabled': False
+    }
+    new_user.update(directory_fields(new_user))
+    providers = new_user.pop('providers')
+    result = db.users.update_one(
+        {'email': email},
+        {
+            '$setOnInsert': new_user,
+            '$addToSet': {'providers': {'$each': providers}},
+            '$set': {'updated_at': datetime.utcnow()}
+        },
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        index_terms(db, result.upserted_id, new_user['search_terms'])
+        bump_directory_version(db)
+        return result.upserted_id
+    return db.users.find_one({'email': email}, {'_id': 1})['_id']
+
 @auth_bp.route('/oauth/login', methods=['POST'])
 def oauth_login():
     data = request.get_json()
@@ -168,39 +247,17 @@ def oauth_login():
     provider = data['provider']
     code = data['code']
     if provider == 'google':
-        tokens = get_google_tokens(code)
-        idToken = tokens['id_token']
-        # decode idToken
-        decoded_token = jwt.decode(idToken, options={"verify_signature": False})
+        try:
+            tokens = get_google_tokens(code)
+            # verify the id_token signature locally against Google's (cached) JWKS
+            decoded_token = verify_id_token(tokens['id_token'])
+        except (GoogleAuthError, KeyError) as e:
+            print("Google login failed", e)
+            return jsonify({'error': 'Invalid Google credentials'}), 401
         email = decoded_token.get('email', '')
-        givenName = decoded_token.get('given_name', '')
-        familyName = decoded_token.get('family_name', '')
-        picture = decoded_token.get('picture', '')
         db = get_db()
-        # check the email is already registered
-        if not db.users.find_one({'email': email}):
-            # register the user
-            private_key, public_key = generate_key_pair()
-            private_key_pem = get_private_key_pem(private_key).decode('utf-8')
-            public_key_pem = get_public_key_pem(public_key).decode('utf-8')
-            user = {
-                'email': email,
-                'providers': [provider],
-                'private_key': private_key_pem,
-                'public_key': public_key_pem,
-                'created_at': datetime.utcnow(),
-                'givenName': givenName,
-                'familyName': familyName,
-                'picture': picture,
-                'mfa_secret': None,
-                'mfa_enabled': False
-            }
-            db.users.insert_one(user)
-
-        # check if for provider is already registered
-        if not db.users.find_one({'email': email, 'providers': {'$in': [provider]}}):
-            db.users.update_one({'email': email}, {'$push': {'providers': provider}})
-        userId = db.users.find_one({'email': email})['_id']
+        userId = upsert_oauth_user(db, provider, email, decoded_token)
+        invalidate_principal(userId)
         print("userId", userId)
         access_token, refresh_token = generate_tokens(userId, 'google')
         return jsonify({
@@ -221,32 +278,18 @@ def configure_mfa(current_user):
     if has_mfa and mfa_secret:
         return jsonify({'qrcode': None})
 
-    mfa_secret = pyotp.random_base32()
-    db = get_db()
-    db.users.update_one({'email': username}, {'$set': {'mfa_secret': mfa_secret}})
-    
-    provisioning_url = pyotp.totp.TOTP(mfa_secret).provisioning_uri(
-        name=username,
-        issuer_name="SecureChat"
-    )
-
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(provisioning_url)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
+    # a pending (not yet verified) secret is reused: repeated setups render the same cached QR
+    if not mfa_secret:
+        mfa_secret = pyotp.random_base32()
+        db = get_db()
+        db.users.update_one({'email': username}, {'$set': {'mfa_secret': mfa_secret, 'updated_at': datetime.utcnow()}})
+        invalidate_principal(current_user['_id'])
     
-    buffered = io.BytesIO()
-    img.save(buffered)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    svg = render_qr_svg(provisioning_uri(mfa_secret, username))
     
     return jsonify({
-        "qrcode": img_str
+        "qrcode": base64.b64encode(svg.encode('utf-8')).decode(),
+        "qrcode_format": "svg"
     })
 
 @auth_bp.route('/mfa/verify', methods=['POST'])
@@ -257,11 +300,11 @@ def verify_mfa(current_user):
     mfa_secret = current_user['mfa_secret']
     if not mfa_secret:
         return jsonify({'error': 'MFA secret not found'}), 400
-    totp = pyotp.TOTP(mfa_secret)
-    is_valid = totp.verify(otp)
+    db = get_db()
+    # each code (time step) is accepted once; enabling MFA goes in the same update
+    is_valid = verify_totp(db, current_user, otp, {'mfa_enabled': True, 'updated_at': datetime.utcnow()})
     if is_valid:
-        db = get_db()
-        db.users.update_one({'email': current_user['email']}, {'$set': {'mfa_enabled': True}})
+        invalidate_principal(current_user['_id'])
         return jsonify({'valid': True}), 200
     else:
         return jsonify({'error': 'Invalid OTP'}), 400
@@ -269,21 +312,45 @@ def verify_mfa(current_user):
 @auth_bp.route('/users', methods=['GET'])
 @token_required
 def get_users(current_user):
+    # query params: q (prefix of name or email), cursor, limit, fields (comma separated)
     db = get_db()
-    users = db.users.find({}, {
-        'email': 1, 
-        'givenName': 1, 
-        'familyName': 1, 
-        'created_at': 1
-    })
-    
-    users_list = []
-    for user in users:
-        users_list.append({
-            'id': str(user['_id']),
-            'email': user['email'],
-            'name': f"{user['givenName']} {user['familyName']}",
-            'created_at': user.get('created_at', '')
-        })
-    
-    return jsonify(users_list), 200
\ No newline at end of file
+
+    query = request.args.get('q', '')
+    fields = parse_fields(request.args.get('fields'))
+    if fields is None:
+        return jsonify({'error': 'Invalid fields'}), 400
+
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    cursor = request.args.get('cursor')
+    try:
+        after = parse_cursor(query, cursor)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    # the page only changes when the directory version does
+    page_key = f"{query}|{cursor}|{limit}|{','.join(fields)}"
+    etag = f"dir-{directory_version(db)}-{hashlib.sha256(page_key.encode()).hexdigest()[:16]}"
+    if request.if_none_match.contains_weak(etag):
+        return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+
+    users_list, next_cursor = directory_page(
+        db,
+        query=query,
+        cursor=after,
+        limit=limit,
+        fields=fields
+    )
+
+    response = jsonify(users_list)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    if next_cursor is not None:
+        args = dict(request.args, cursor=next_cursor)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{url_for("auth.get_users", _external=True, **args)}>; rel="next"'
+
+    return response, 200
@@ -1,6 +1,7 @@
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import hashes
+import hashlib
 import os
 
 def generate_rsa_key_pair():
@@ -67,4 +68,27 @@ def decrypt_with_private_key(ciphertext, private_key_pem):
             label=None
         )
     )
-    return plaintext
\ No newline at end of file
+    return plaintext
+
+def public_key_fingerprint(public_key_pem):
+    """
+    Huella SHA-256 de una clave pública (RSA o ECDSA)
+    
+    Se calcula sobre la codificación DER (SubjectPublicKeyInfo), así que no
+    depende de saltos de línea ni del formato del PEM.
+    
+    Args:
+        public_key_pem: Clave pública en formato PEM (str o bytes)
+    
+    Returns:
+        str: Huella en hexadecimal con prefijo 'sha256:'
+    """
+    if isinstance(public_key_pem, str):
+        public_key_pem = public_key_pem.encode('utf-8')
+    
+    public_key = serialization.load_pem_public_key(public_key_pem)
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return 'sha256:' + hashlib.sha256(der).hexdigest()
\ No newline at end of file
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Cache en memoria acotado (LRU) con expiración por entrada, seguro entre hilos.
+
+    Si se pasa group_of, cada clave pertenece a un grupo (por ejemplo, el
+    ID de usuario) y se pueden invalidar todas las entradas de un grupo de
+    una vez sin recorrer el cache completo.
+    """
+
+    def __init__(self, maxsize, ttl, group_of=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._group_of = group_of
+        self._data = OrderedDict()   # key -> (expira_en, valor)
+        self._groups = {}            # grupo -> set(keys)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            if self._group_of is not None:
+                self._groups.setdefault(self._group_of(key), set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._data:
+                return self._remove(key)[1]
+            return None
+
+    def invalidate_group(self, group):
+        """Elimina todas las entradas del grupo indicado"""
+        with self._lock:
+            for key in list(self._groups.get(group, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._groups.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        entry = self._data.pop(key)
+        if self._group_of is not None:
+            group = self._group_of(key)
+            keys = self._groups.get(group)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._groups[group]
+        return entry
@@ -0,0 +1,237 @@
+'''
+Ejecutor global de operaciones criptográficas.
+
+Todas las operaciones RSA, ECDSA y AES de las rutas de chat y del
+GroupKeyManager pasan por un único pool de hilos del tamaño de los núcleos
+(las operaciones de cryptography sueltan el GIL mientras trabajan en
+OpenSSL). El ejecutor lleva la cuenta de tareas pendientes y promedios
+móviles del tiempo de espera y de servicio; si la espera estimada de una
+tarea nueva supera CRYPTO_MAX_WAIT la rechaza de inmediato con
+CryptoOverloaded, y las rutas decoradas con @crypto_bound responden 503
+en lugar de encolar hasta que la latencia se dispare.
+
+Configuración:
+    CRYPTO_WORKERS: hilos del pool (por defecto, núcleos disponibles)
+    CRYPTO_MAX_WAIT: espera estimada máxima en segundos antes de rechazar
+    CRYPTO_DEADLINE: tiempo máximo en segundos para obtener un resultado
+'''
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import wraps
+from flask import g, has_request_context, jsonify, make_response
+
+CRYPTO_WORKERS = int(os.getenv('CRYPTO_WORKERS', os.cpu_count() or 2))
+CRYPTO_MAX_WAIT = float(os.getenv('CRYPTO_MAX_WAIT', 0.5))
+CRYPTO_DEADLINE = float(os.getenv('CRYPTO_DEADLINE', 5))
+
+# Peso de la última muestra en los promedios móviles
+_EWMA_ALPHA = 0.1
+
+
+class CryptoOverloaded(Exception):
+    def __init__(self, estimated_wait):
+        super().__init__(f"Ejecutor criptográfico saturado (espera estimada {estimated_wait:.2f}s)")
+        self.estimated_wait = estimated_wait
+
+
+class CryptoExecutor:
+    def __init__(self, workers=CRYPTO_WORKERS, max_wait=CRYPTO_MAX_WAIT, deadline=CRYPTO_DEADLINE):
+        self.workers = workers
+        self.max_wait = max_wait
+        self.deadline = deadline
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crypto')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.pending = 0            # en cola + ejecutándose
+        self.avg_service = 0.002    # segundos por operación (promedio móvil)
+        self.avg_wait = 0.0         # segundos en cola (promedio móvil)
+        self.completed = 0
+        self.rejected = 0
+
+    def estimated_wait(self):
+        '''Espera estimada de una tarea nueva: trabajo por delante repartido entre los hilos'''
+        ahead = self.pending - self.workers + 1
+        if ahead <= 0:
+            return 0.0
+        return ahead * self.avg_service / self.workers
+
+    def run(self, fn, *args, **kwargs):
+        '''
+        Ejecuta fn en el pool y espera su resultado.
+
+        Raises:
+            CryptoOverloaded: si la espera estimada supera max_wait o no hay
+                resultado antes de deadline
+        '''
+        # Desde un hilo del pool (llamadas anidadas) se ejecuta directo para no bloquearlo
+        if getattr(self._local, 'inside', False):
+            return fn(*args, **kwargs)
+
+        with self._lock:
+            self._admit()
+            self.pending += 1
+
+        future = self._pool.submit(self._execute, time.monotonic(), fn, args, kwargs)
+        try:
+            return future.result(timeout=self.deadline)
+        except FutureTimeoutError:
+            if future.cancel():
+                # No llegó a ejecutarse: _execute no va a descontarla
+                with self._lock:
+                    self.pending -= 1
+            raise CryptoOverloaded(self.estimated_wait())
+
+    def map(self, fn, arg_tuples):
+        '''
+        Aplica fn a cada tupla de argumentos repartiendo el trabajo en un
+        bloque por hilo (una tarea por operación costaría más en cola que
+        en cómputo para operaciones cortas como cifrar con llave pública).
+        Cada operación cuenta como una tarea pendiente para la estimación.
+
+        Returns:
+            list: Resultados en el mismo orden que arg_tuples
+
+        Raises:
+            CryptoOverloaded: si el ejecutor está saturado o no termina antes de deadline
+        '''
+        arg_tuples = list(arg_tuples)
+        if not arg_tuples:
+            return []
+        if getattr(self._local, 'inside', False):
+            return [fn(*args) for args in arg_tuples]
+
+        size = math.ceil(len(arg_tuples) / self.workers)
+        chunks = [arg_tuples[i:i + size] for i in range(0, len(arg_tuples), size)]
+
+        with self._lock:
+            self._admit()
+            self.pending += len(arg_tuples)
+
+        enqueued_at = time.monotonic()
+        futures = [
+            (self._pool.submit(self._execute, enqueued_at, _apply_chunk, (fn, chunk), {}, len(chunk)), len(chunk))
+            for chunk in chunks
+        ]
+        deadline = enqueued_at + self.deadline
+        results = []
+        try:
+            for future, _ in futures:
+                results.extend(future.result(timeout=max(0, deadline - time.monotonic())))
+        except FutureTimeoutError:
+            for future, weight in futures:
+                if future.cancel():
+                    with self._lock:
+                        self.pending -= weight
+            raise CryptoOverloaded(self.estimated_wait())
+        return results
+
+    def check_admission(self):
+        '''Lanza CryptoOverloaded si una tarea nueva tendría que esperar más de max_wait'''
+        with self._lock:
+            self._admit()
+
+    def _admit(self):
+        wait = self.estimated_wait()
+        if wait > self.max_wait:
+            self.rejected += 1
+            raise CryptoOverloaded(wait)
+
+    def _execute(self, enqueued_at, fn, args, kwargs, weight=1):
+        started = time.monotonic()
+        self._local.inside = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._local.inside = False
+            finished = time.monotonic()
+            with self._lock:
+                self.pending -= weight
+                self.completed += weight
+                self.avg_wait += _EWMA_ALPHA * ((started - enqueued_at) - self.avg_wait)
+                self.avg_service += _EWMA_ALPHA * ((finished - started) / weight - self.avg_service)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'queue_depth': max(0, self.pending - self.workers),
+                'avg_wait_ms': round(self.avg_wait * 1000, 3),
+                'avg_service_ms': round(self.avg_service * 1000, 3),
+                'estimated_wait_ms': round(self.estimated_wait() * 1000, 3),
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
+
+
+def _apply_chunk(fn, chunk):
+    return [fn(*args) for args in chunk]
+
+
+crypto_executor = CryptoExecutor()
+
+
+def run_crypto(fn, *args, **kwargs):
+    """
+    Ejecuta una operación criptográfica en el ejecutor global.
+
+    Dentro de una petición, después del primer rechazo las siguientes
+    operaciones fallan sin volver a encolar: la ruta va a responder 503.
+    """
+    if has_request_context() and g.get('crypto_overloaded'):
+        raise g.crypto_overloaded
+    try:
+        return crypto_executor.run(fn, *args, **kwargs)
+    except CryptoOverloaded as e:
+        if has_request_context():
+            g.crypto_overloaded = e
+        raise
+
+
+def map_crypto(fn, arg_tuples):
+    """Como run_crypto, para la misma operación sobre muchos argumentos en paralelo"""
+    if has_request_context() and g.get('crypto_overloaded'):
+        raise g.crypto_overloaded
+    try:
+        return crypto_executor.map(fn, arg_tuples)
+    except CryptoOverloaded as e:
+        if has_request_context():
+            g.crypto_overloaded = e
+        raise
+
+
+def crypto_bound(f):
+    """
+    Para rutas que hacen trabajo criptográfico: responde 503 antes de
+    empezar si el ejecutor ya está saturado, y también si alguna operación
+    fue rechazada durante la petición (la ruta la haya capturado o no).
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            crypto_executor.check_admission()
+        except CryptoOverloaded as e:
+            return _overloaded(e)
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except CryptoOverloaded as e:
+            return _overloaded(e)
+        if g.get('crypto_overloaded'):
+            return _overloaded(g.crypto_overloaded)
+        return response
+
+    return decorated
+
+
+def _overloaded(error):
+    retry_after = max(1, math.ceil(error.estimated_wait))
+    response = jsonify({'error': 'Servidor ocupado, intenta de nuevo', 'retry_after': retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
@@ -0,0 +1,288 @@
+'''
+Directorio de usuarios (GET /api/auth/users).
+
+Sin búsqueda se pagina 'users' por _id. Con búsqueda por prefijo se
+pagina 'directory_terms', que tiene una entrada por término de cada
+usuario con _id "<término>\x00<user_id>": el índice de _id ya está en el
+orden (término, usuario) y un prefijo es un rango de ese índice, sin
+ordenar en memoria (un índice multikey sobre users.search_terms no puede
+dar ese orden).
+
+Los usuarios registrados antes de 'directory_terms' se completan una vez
+con la herramienta de línea de comandos, fuera de las peticiones:
+    python -m utils.directory backfill
+'''
+
+import argparse
+import base64
+import os
+import re
+import sys
+import unicodedata
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument, UpdateOne
+from config.database import get_db_from_uri
+
+load_dotenv()
+
+# Tamaño de página por defecto y máximo de GET /api/auth/users
+PAGE_SIZE = int(os.getenv('DIRECTORY_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('DIRECTORY_MAX_PAGE_SIZE', 200))
+BACKFILL_BATCH_SIZE = 500
+
+# Campos públicos del directorio; 'id' siempre se incluye
+DIRECTORY_FIELDS = ('email', 'name', 'givenName', 'familyName', 'created_at')
+
+_VERSION_ID = 'user_directory'
+_TERMS = 'directory_terms'
+
+
+def normalize(text):
+    """Pasa a minúsculas y quita acentos para buscar por prefijo ("Álvaro" → "alvaro")"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.casefold().split())
+
+
+def search_terms(given_name, family_name, email):
+    """
+    Términos normalizados por los que se encuentra a un usuario: nombre
+    completo, apellido y email. Se guardan en 'search_terms' (índice multikey).
+    """
+    terms = [
+        normalize(f"{given_name or ''} {family_name or ''}"),
+        normalize(family_name),
+        normalize(email)
+    ]
+    return sorted({term for term in terms if term})
+
+
+def directory_fields(user):
+    """Campos derivados que deben guardarse junto a un usuario nuevo o renombrado"""
+    return {'search_terms': search_terms(user.get('givenName'), user.get('familyName'), user.get('email'))}
+
+
+def _term_key(term, user_id):
+    # \x00 es menor que cualquier carácter: el orden de las claves es el de (término, _id)
+    return f"{term}\x00{user_id}"
+
+
+def index_terms(db, user_id, terms):
+    """Guarda las entradas de búsqueda de un usuario en 'directory_terms' (idempotente)"""
+    if terms:
+        db[_TERMS].bulk_write([
+            UpdateOne({'_id': _term_key(term, user_id)}, {'$setOnInsert': {'user_id': user_id}}, upsert=True)
+            for term in terms
+        ], ordered=False)
+
+
+def bump_directory_version(db):
+    """Incrementa el contador de versión del directorio (altas, cambios de nombre o email)"""
+    return db.counters.find_one_and_update(
+        {'_id': _VERSION_ID},
+        {'$inc': {'version': 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )['version']
+
+
+def directory_version(db):
+    counter = db.counters.find_one({'_id': _VERSION_ID})
+    return counter['version'] if counter else 0
+
+
+def backfill(db, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Completa 'search_terms' y 'directory_terms' de los usuarios existentes
+    (los que se registraron antes de que existieran). Se puede repetir.
+
+    Returns:
+        int: Cantidad de usuarios procesados
+    """
+    total = 0
+    users_pending, terms_pending = [], []
+    users = db.users.find(
+        {},
+        {'email': 1, 'givenName': 1, 'familyName': 1, 'search_terms': 1}
+    ).sort('_id', 1).batch_size(batch_size)
+    for user in users:
+        terms = user.get('search_terms')
+        if terms is None:
+            terms = directory_fields(user)['search_terms']
+            users_pending.append(UpdateOne({'_id': user['_id']}, {'$set': {'search_terms': terms}}))
+        terms_pending.extend(
+            UpdateOne({'_id': _term_key(term, user['_id'])}, {'$setOnInsert': {'user_id': user['_id']}}, upsert=True)
+            for term in terms
+        )
+        total += 1
+        if len(terms_pending) >= batch_size:
+            if users_pending:
+                db.users.bulk_write(users_pending, ordered=False)
+            db[_TERMS].bulk_write(terms_pending, ordered=False)
+            users_pending, terms_pending = [], []
+    if users_pending:
+        db.users.bulk_write(users_pending, ordered=False)
+    if terms_pending:
+        db[_TERMS].bulk_write(terms_pending, ordered=False)
+    return total
+
+
+def parse_fields(raw):
+    """
+    Campos pedidos con ?fields=email,name. Devuelve None si hay alguno desconocido.
+    """
+    if not raw:
+        return DIRECTORY_FIELDS
+    fields = tuple(field.strip() for field in raw.split(',') if field.strip() and field.strip() != 'id')
+    if any(field not in DIRECTORY_FIELDS for field in fields):
+        return None
+    return fields
+
+
+def parse_cursor(query, raw):
+    """
+    Cursor de ?cursor= tal como lo devolvió directory_page para la misma
+    búsqueda: un _id sin búsqueda, o la clave de 'directory_terms' en
+    base64 con búsqueda. Lanza ValueError si no es válido.
+    """
+    if raw is None:
+        return None
+    if not normalize(query):
+        if not ObjectId.is_valid(raw):
+            raise ValueError("Cursor inválido")
+        return ObjectId(raw)
+
+    try:
+        key = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Cursor inválido")
+    term, _, user_id = key.rpartition('\x00')
+    if not term or not ObjectId.is_valid(user_id):
+        raise ValueError("Cursor inválido")
+    return key
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode().rstrip('=')
+
+
+def _project(fields):
+    # El nombre se arma en MongoDB: sólo viajan los campos pedidos
+    project = {'_id': 1}
+    for field in fields:
+        if field == 'name':
+            project['name'] = {'$concat': [
+                {'$ifNull': ['$givenName', '']}, ' ', {'$ifNull': ['$familyName', '']}
+            ]}
+        elif field == 'created_at':
+            project['created_at'] = {'$ifNull': ['$created_at', '']}
+        else:
+            project[field] = 1
+    return project
+
+
+def _search(db, prefix, after, limit, project):
+    """
+    Recorre 'directory_terms' en orden desde after. Un usuario con varios
+    términos que empiezan con el prefijo aparece sólo en el menor de ellos.
+
+    Returns:
+        list: (clave, documento) de hasta limit + 1 usuarios
+    """
+    pattern = '^' + re.escape(prefix)
+    project = dict(project, search_terms=1)
+    found = []
+    while len(found) <= limit:
+        wanted = limit + 1 - len(found)
+        key_match = {'$regex': pattern}
+        if after is not None:
+            key_match['$gt'] = after
+        entries = list(db[_TERMS].find({'_id': key_match}, {'user_id': 1}).sort('_id', 1).limit(wanted))
+        if not entries:
+            break
+
+        users = {
+            document['_id']: document
+            for document in db.users.aggregate([
+                {'$match': {'_id': {'$in': [entry['user_id'] for entry in entries]}}},
+                {'$project': project}
+            ])
+        }
+        for entry in entries:
+            after = entry['_id']
+            document = users.get(entry['user_id'])
+            if document is None:
+                continue  # usuario borrado
+            term = entry['_id'].rpartition('\x00')[0]
+            matching = [t for t in document.get('search_terms', ()) if t.startswith(prefix)]
+            if matching and min(matching) != term:
+                continue
+            found.append((entry['_id'], dict(document)))
+        if len(entries) < wanted:
+            break
+    return found
+
+
+def directory_page(db, query='', cursor=None, limit=PAGE_SIZE, fields=DIRECTORY_FIELDS):
+    """
+    Una página del directorio: ordenada por _id, o por (término, _id) si
+    hay búsqueda.
+
+    Args:
+        query (str): Prefijo a buscar en nombre, apellido o email
+        cursor: Cursor de la página anterior (ver parse_cursor)
+        limit (int): Cantidad de usuarios por página
+        fields (tuple): Campos a devolver (además de 'id')
+
+    Returns:
+        tuple: (lista de usuarios, cursor de la página siguiente si hay más o None)
+    """
+    project = _project(fields)
+    prefix = normalize(query)
+    if prefix:
+        found = _search(db, prefix, cursor, limit, project)
+        has_more = len(found) > limit
+        found = found[:limit]
+        next_cursor = _encode_cursor(found[-1][0]) if has_more else None
+        documents = [document for _, document in found]
+    else:
+        match = {'_id': {'$gt': cursor}} if cursor is not None else {}
+        documents = list(db.users.aggregate([
+            {'$match': match},
+            {'$sort': {'_id': 1}},
+            {'$limit': limit + 1},
+            {'$project': project}
+        ]))
+        has_more = len(documents) > limit
+        documents = documents[:limit]
+        next_cursor = str(documents[-1]['_id']) if has_more else None
+
+    users = []
+    for document in documents:
+        document.pop('search_terms', None)
+        user = {'id': str(document.pop('_id'))}
+        user.update(document)
+        users.append(user)
+
+    return users, next_cursor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mantenimiento del directorio de usuarios")
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"), help="URI de MongoDB (por defecto MONGODB_URI)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="Completa los términos de búsqueda de los usuarios existentes")
+    backfill_parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="Operaciones por bulk_write")
+
+    args = parser.parse_args(argv)
+    if not args.uri:
+        parser.error("Se requiere --uri o la variable de entorno MONGODB_URI")
+
+    total = backfill(get_db_from_uri(args.uri), args.batch_size)
+    print(f"✅ Usuarios procesados: {total}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
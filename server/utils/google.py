@@ -1,8 +1,12 @@
 from dotenv import load_dotenv
 import os
+import re
+import threading
+import time
+import jwt
 import requests
-import json
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 
@@ -10,9 +14,126 @@ CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("DEVELOP_REDIRECT_URL")
 
-# Google OAuth2 endpoints
-TOKEN_URL = "https://oauth2.googleapis.com/token"
-USER_INFO_URL = "https://www.googleapis.com/oauth2/v3/userinfo"
+# Google OAuth2 endpoints (overridable to point at a local stub)
+TOKEN_URL = os.getenv("GOOGLE_TOKEN_URL", "https://oauth2.googleapis.com/token")
+USER_INFO_URL = os.getenv("GOOGLE_USER_INFO_URL", "https://www.googleapis.com/oauth2/v3/userinfo")
+JWKS_URL = os.getenv("GOOGLE_JWKS_URL", "https://www.googleapis.com/oauth2/v3/certs")
+ISSUERS = tuple(os.getenv("GOOGLE_ISSUERS", "accounts.google.com,https://accounts.google.com").split(","))
+
+# HTTP client settings
+CONNECT_TIMEOUT = float(os.getenv("GOOGLE_HTTP_CONNECT_TIMEOUT", 3))
+READ_TIMEOUT = float(os.getenv("GOOGLE_HTTP_READ_TIMEOUT", 10))
+HTTP_RETRIES = int(os.getenv("GOOGLE_HTTP_RETRIES", 2))
+POOL_SIZE = int(os.getenv("GOOGLE_HTTP_POOL_SIZE", 10))
+
+# JWKS cache: used until Cache-Control max-age expires; an unknown kid forces
+# a refresh (key rotation), but at most once per JWKS_MIN_REFRESH_INTERVAL
+JWKS_DEFAULT_TTL = float(os.getenv("GOOGLE_JWKS_DEFAULT_TTL", 3600))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("GOOGLE_JWKS_MIN_REFRESH_INTERVAL", 30))
+CLOCK_SKEW = int(os.getenv("GOOGLE_ID_TOKEN_LEEWAY", 60))
+
+
+class GoogleAuthError(Exception):
+    pass
+
+
+def _build_session():
+    # connection errors are retried for every method (nothing was sent yet);
+    # read and status retries only for GET, since an auth code can be used once
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+session = _build_session()
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+
+class JWKSCache:
+    def __init__(self, url=JWKS_URL):
+        self.url = url
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        response = session.get(self.url, timeout=TIMEOUT)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            if jwk.get("kid"):
+                keys[jwk["kid"]] = jwt.PyJWK(jwk)
+
+        match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        ttl = int(match.group(1)) if match else JWKS_DEFAULT_TTL
+
+        now = time.monotonic()
+        self._keys = keys
+        self._expires_at = now + ttl
+        self._last_fetch = now
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        key = self._keys.get(kid)
+        if key is not None and now < self._expires_at:
+            return key
+
+        with self._lock:
+            key = self._keys.get(kid)
+            expired = time.monotonic() >= self._expires_at
+            # unknown kid: Google rotated its keys, refresh (rate limited)
+            if expired or (key is None and time.monotonic() - self._last_fetch >= JWKS_MIN_REFRESH_INTERVAL):
+                try:
+                    self._fetch()
+                except requests.RequestException as e:
+                    # keep serving the keys we have if the JWKS endpoint is down
+                    if not self._keys:
+                        raise GoogleAuthError(f"Could not fetch Google signing keys: {e}")
+                    print(f"Could not refresh Google JWKS, using cached keys: {e}")
+                key = self._keys.get(kid)
+
+        if key is None:
+            raise GoogleAuthError(f"Unknown signing key: {kid}")
+        return key
+
+
+jwks_cache = JWKSCache()
+
+
+def verify_id_token(id_token):
+    # verify the id_token locally: signature (cached JWKS), audience, issuer and expiration
+    try:
+        header = jwt.get_unverified_header(id_token)
+        key = jwks_cache.get_key(header.get("kid"))
+        claims = jwt.decode(
+            id_token,
+            key.key,
+            algorithms=["RS256"],
+            audience=CLIENT_ID,
+            leeway=CLOCK_SKEW
+        )
+    except jwt.InvalidTokenError as e:
+        raise GoogleAuthError(f"Invalid id_token: {e}")
+
+    if claims.get("iss") not in ISSUERS:
+        raise GoogleAuthError(f"Invalid id_token issuer: {claims.get('iss')}")
+    if not claims.get("email") or claims.get("email_verified") is False:
+        raise GoogleAuthError("Google account email is not verified")
+    return claims
+
 
 def get_google_tokens(auth_code):
     data = {
@@ -22,16 +143,19 @@ def get_google_tokens(auth_code):
         "redirect_uri": REDIRECT_URI,
         "grant_type": "authorization_code"
     }
-    
-    response = requests.post(TOKEN_URL, data=data)
-    token_data = response.json()
-    
+
+    try:
+        response = session.post(TOKEN_URL, data=data, timeout=TIMEOUT)
+        token_data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise GoogleAuthError(f"Error getting tokens: {e}")
+
     if 'error' in token_data:
-        raise Exception(f"Error getting tokens: {token_data['error']}")
-    
+        raise GoogleAuthError(f"Error getting tokens: {token_data['error']}")
+
     return token_data
 
 def get_user_info(access_token):
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(USER_INFO_URL, headers=headers)
-    return response.json()
\ No newline at end of file
+    response = session.get(USER_INFO_URL, headers=headers, timeout=TIMEOUT)
+    return response.json()
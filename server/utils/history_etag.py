@@ -0,0 +1,118 @@
+'''
+ETags de los historiales (GET /messages/<a>/<b> y GET /groups/<id>/messages).
+
+El ETag se calcula sin descifrar nada, con:
+
+    - la versión de la conversación en la bandeja ('inbox'.version, por
+      _id), que sube con cada mensaje guardado o importado: cubre las
+      importaciones con _id anteriores al último o elegidos a propósito
+    - el _id del último mensaje (consulta cubierta por los índices de
+      utils.sync.ensure_message_indexes), por si falla la actualización de
+      la bandeja, que no hace fallar el envío
+    - la versión de clave del grupo, el usuario que lee (cada uno recibe su
+      propia vista descifrada) y los parámetros de la página
+
+Si coincide con If-None-Match la ruta responde 304 antes de pasar por el
+ejecutor criptográfico y el rate limiter.
+'''
+
+import hashlib
+from functools import wraps
+from bson import ObjectId
+from flask import make_response, request
+from pymongo import DESCENDING
+from blockchain.ledger import direct_chain_id, group_chain_id
+from config.database import get_db
+from utils.inbox import conversation_version
+from utils.identity_map import identity_map
+from utils.sync import ensure_message_indexes
+
+CACHE_CONTROL = 'private, no-cache'
+
+
+def _last_id(db, query):
+    message = db.messages.find_one(query, {'_id': 1}, sort=[('_id', DESCENDING)])
+    return message['_id'] if message else None
+
+
+def last_direct_message_id(db, user_a, user_b):
+    """Último _id de la conversación entre dos usuarios: una consulta por sentido sobre (sender_id, recipient_id, _id)"""
+    user_a, user_b = ObjectId(user_a), ObjectId(user_b)
+    ids = [
+        _last_id(db, {'sender_id': user_a, 'recipient_id': user_b}),
+        _last_id(db, {'sender_id': user_b, 'recipient_id': user_a})
+    ]
+    ids = [message_id for message_id in ids if message_id is not None]
+    return max(ids) if ids else None
+
+
+def last_group_message_id(db, group_id):
+    return _last_id(db, {'group_id': group_id})
+
+
+def history_etag(*parts):
+    material = '|'.join('' if part is None else str(part) for part in parts)
+    return f"hist-{hashlib.sha256(material.encode()).hexdigest()[:32]}"
+
+
+def _page_cursor():
+    return '&'.join(f"{key}={value}" for key, value in sorted(request.args.items(multi=True)))
+
+
+def conversation_etag(current_user, user_origen, user_destino):
+    """ETag del historial directo, o None si el usuario no puede verlo (la ruta responde el error)"""
+    current_user_id = str(current_user['_id'])
+    if current_user_id not in (user_origen, user_destino):
+        return None
+    if not ObjectId.is_valid(user_origen) or not ObjectId.is_valid(user_destino):
+        return None
+
+    db = get_db()
+    ensure_message_indexes(db)
+    last_id = last_direct_message_id(db, user_origen, user_destino)
+    version = conversation_version(db, direct_chain_id(user_origen, user_destino))
+    return history_etag(
+        'dm', *sorted((user_origen, user_destino)), current_user_id, version, last_id, None, _page_cursor()
+    )
+
+
+def group_history_etag(current_user, group_id):
+    """ETag del historial de un grupo, o None si el usuario no es miembro"""
+    current_user_id = str(current_user['_id'])
+    db = get_db()
+    group = identity_map(db).get_group(group_id)
+    if not group or current_user_id not in group['members']:
+        return None
+
+    ensure_message_indexes(db)
+    last_id = last_group_message_id(db, group_id)
+    version = conversation_version(db, group_chain_id(group_id))
+    return history_etag(
+        'group', group_id, current_user_id, version, last_id, group.get('key_version'), _page_cursor(), group.get('name')
+    )
+
+
+def conditional_history(etag_for):
+    """
+    Para rutas GET de historial (entre @token_required y @crypto_bound):
+    responde 304 si If-None-Match coincide con etag_for(current_user, **kwargs)
+    y, si no, agrega el ETag a la respuesta 200 de la ruta.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            etag = etag_for(current_user, **kwargs)
+            if etag is None:
+                return f(current_user, *args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                return '', 304, {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+
+            response = make_response(f(current_user, *args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = CACHE_CONTROL
+            return response
+
+        return decorated
+
+    return decorator
@@ -0,0 +1,348 @@
+'''
+Exportación e importación del historial de mensajes en NDJSON.
+
+Los registros se copian tal como están en 'messages' (cifrados, con sus
+claves envueltas y su firma): el servidor nunca descifra nada. Cada línea
+es un documento en Extended JSON (ObjectId y fechas sin perder tipo); la
+primera línea es un encabezado con el formato y el alcance:
+
+    {"format": "secure-chat-history", "version": 1, "user_id": "<id>" | null, ...}
+    {"_id": {"$oid": "..."}, "sender_id": {"$oid": "..."}, "ciphertext": "...", ...}
+
+La exportación lee con un cursor por lotes ordenado por _id y escribe línea
+por línea; la importación agrupa las líneas en lotes de bulk_write sin
+orden, con upserts por _id ($setOnInsert): importar dos veces el mismo
+archivo no duplica mensajes. La memoria usada no depende del tamaño del
+historial.
+
+Uso (desde la carpeta server):
+    python -m utils.history_transfer export --user <user_id> --output historial.ndjson
+    python -m utils.history_transfer export --output todo.ndjson
+    python -m utils.history_transfer import --input historial.ndjson
+
+Sin --user se exportan o importan los mensajes de todos los usuarios (para
+migrar una instalación completa); las colecciones 'users' y 'groups' se
+migran aparte.
+
+Con un usuario (POST /api/chat/import, o --user) sólo se aceptan mensajes
+que ese usuario envió, en formato v2 (firmado) con exactamente los campos
+de ese formato y con una firma que verifica contra su llave de firma: nadie
+puede agregar mensajes a nombre de otro en un historial ajeno. Los formatos
+antiguos sin firma sólo se importan con la herramienta de línea de comandos
+sin --user.
+'''
+
+import argparse
+import os
+import sys
+from datetime import datetime
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from config.database import get_db_from_uri
+from hashing.signing import verify_signature
+from utils import inbox
+from utils.crypto_executor import map_crypto
+from utils.sync import ensure_message_indexes
+
+load_dotenv()
+
+FORMAT = 'secure-chat-history'
+VERSION = 1
+EXPORT_BATCH_SIZE = int(os.getenv('HISTORY_EXPORT_BATCH_SIZE', 1000))
+IMPORT_BATCH_SIZE = int(os.getenv('HISTORY_IMPORT_BATCH_SIZE', 1000))
+MAX_LINE_BYTES = int(os.getenv('HISTORY_IMPORT_MAX_LINE_BYTES', 1024 * 1024))
+MAX_REPORTED_ERRORS = 20
+
+_JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+# Campos de los mensajes v2 (directos y de grupo) que acepta la importación de un usuario
+_DIRECT_FIELDS = {
+    'required': {'_id', 'sender_id', 'recipient_id', 'ciphertext', 'nonce', 'tag', 'encrypted_key_sender',
+                 'encrypted_key_recipient', 'digital_signature', 'timestamp', 'is_signed', 'is_group', 'version'},
+    'optional': {'multicast_id'},
+    'version': 'v2_correct_flow'
+}
+_GROUP_FIELDS = {
+    'required': {'_id', 'sender_id', 'group_id', 'ciphertext', 'nonce', 'tag', 'digital_signature',
+                 'key_version', 'timestamp', 'is_signed', 'is_group', 'version'},
+    'optional': set(),
+    'version': 'v2_group_correct_flow'
+}
+
+
+class HistoryImportError(ValueError):
+    pass
+
+
+def _dumps(document):
+    return json_util.dumps(document, json_options=_JSON_OPTIONS) + '\n'
+
+
+def history_query(user_id=None, group_ids=()):
+    """Mensajes directos del usuario y de sus grupos (todos si user_id es None)"""
+    if user_id is None:
+        return {}
+    me = ObjectId(user_id)
+    return {'$or': [
+        {'is_group': {'$ne': True}, 'sender_id': me},
+        {'is_group': {'$ne': True}, 'recipient_id': me},
+        {'is_group': True, 'group_id': {'$in': list(group_ids)}}
+    ]}
+
+
+def user_group_ids(db, user_id):
+    return [group['_id'] for group in db.groups.find({'members': str(user_id)}, {'_id': 1})]
+
+
+def export_lines(db, user_id=None, since=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Genera las líneas NDJSON del historial: el encabezado y un mensaje por
+    línea, en orden de _id. El cursor trae batch_size documentos por viaje.
+
+    Args:
+        user_id (str): Usuario cuyo historial se exporta (None: todos)
+        since (ObjectId): Sólo mensajes con _id mayor (exportación incremental)
+    """
+    ensure_message_indexes(db)
+    group_ids = user_group_ids(db, user_id) if user_id is not None else ()
+    query = history_query(user_id, group_ids)
+    if since is not None:
+        query['_id'] = {'$gt': since}
+
+    yield _dumps({
+        'format': FORMAT,
+        'version': VERSION,
+        'user_id': str(user_id) if user_id is not None else None,
+        'since': str(since) if since is not None else None,
+        'exported_at': datetime.utcnow()
+    })
+    for message in db.messages.find(query).sort('_id', 1).batch_size(batch_size):
+        yield _dumps(message)
+
+
+def _validate(record, user_id, group_ids):
+    """Comprueba que el registro sea un mensaje importable por el usuario"""
+    if not isinstance(record.get('_id'), ObjectId):
+        raise HistoryImportError("Falta '_id' (ObjectId)")
+    if not isinstance(record.get('ciphertext'), str) or not isinstance(record.get('timestamp'), datetime):
+        raise HistoryImportError("Faltan 'ciphertext' o 'timestamp'")
+    if not isinstance(record.get('sender_id'), ObjectId):
+        raise HistoryImportError("Falta 'sender_id' (ObjectId)")
+
+    if record.get('is_group'):
+        if not isinstance(record.get('group_id'), str):
+            raise HistoryImportError("Falta 'group_id'")
+        if user_id is not None and record['group_id'] not in group_ids:
+            raise HistoryImportError("El usuario no es miembro del grupo del mensaje")
+    else:
+        if not isinstance(record.get('recipient_id'), ObjectId):
+            raise HistoryImportError("Falta 'recipient_id' (ObjectId)")
+        if user_id is not None and ObjectId(user_id) not in (record['sender_id'], record['recipient_id']):
+            raise HistoryImportError("El mensaje no pertenece al usuario")
+
+    if user_id is not None:
+        _validate_signed_v2(record, user_id)
+
+
+def _validate_signed_v2(record, user_id):
+    """Importación de un usuario: sólo sus propios mensajes v2, sin campos extra (la firma se verifica al escribir)"""
+    if record['sender_id'] != ObjectId(user_id):
+        raise HistoryImportError("Sólo se pueden importar mensajes enviados por el usuario")
+
+    schema = _GROUP_FIELDS if record.get('is_group') else _DIRECT_FIELDS
+    if record.get('version') != schema['version'] or record.get('is_signed') is not True:
+        raise HistoryImportError(f"Formato no admitido: se requiere un mensaje firmado {schema['version']}")
+    fields = set(record)
+    missing = schema['required'] - fields
+    extra = fields - schema['required'] - schema['optional']
+    if missing or extra:
+        raise HistoryImportError(f"Campos inválidos (faltan: {sorted(missing)}, sobran: {sorted(extra)})")
+    for field in ('nonce', 'tag', 'digital_signature'):
+        if not isinstance(record[field], str):
+            raise HistoryImportError(f"'{field}' debe ser texto")
+    if record.get('is_group'):
+        if not isinstance(record['key_version'], int):
+            raise HistoryImportError("'key_version' debe ser un entero")
+    elif not isinstance(record['encrypted_key_sender'], str) or not isinstance(record['encrypted_key_recipient'], str):
+        raise HistoryImportError("Las claves cifradas deben ser texto")
+
+
+def _verification_key(db, user_id):
+    user = db.users.find_one({'_id': ObjectId(user_id)}, {'signing_public_key': 1, 'public_key': 1})
+    if not user:
+        raise HistoryImportError("Usuario no encontrado")
+    return user.get('signing_public_key', user['public_key'])
+
+
+def read_lines(stream, max_line_bytes=MAX_LINE_BYTES):
+    """Líneas de un stream binario o de texto, sin cargarlo completo"""
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        if len(line) > max_line_bytes:
+            raise HistoryImportError(f"Línea de más de {max_line_bytes} bytes")
+        yield line
+
+
+def import_lines(db, lines, user_id=None, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Importa un historial NDJSON. Los mensajes que ya existen (mismo _id) se
+    cuentan como duplicados y no se modifican; las líneas inválidas se
+    cuentan como rechazadas sin detener la importación.
+
+    Args:
+        lines (iterable): Líneas NDJSON (str o bytes), la primera es el encabezado
+        user_id (str): Si se indica, sólo se aceptan mensajes v2 enviados
+            por él (a sus conversaciones o a sus grupos actuales) cuya firma
+            verifica con su llave; las firmas se verifican por lote en el
+            ejecutor criptográfico
+
+    Returns:
+        dict: inserted, duplicates, rejected, errors (las primeras)
+
+    Raises:
+        HistoryImportError: si falta el encabezado o el formato no es compatible
+        CryptoOverloaded: si el ejecutor criptográfico está saturado (los lotes
+            ya escritos quedan; reimportar el archivo no los duplica)
+    """
+    ensure_message_indexes(db)
+    group_ids = set(user_group_ids(db, user_id)) if user_id is not None else set()
+    verification_key = _verification_key(db, user_id) if user_id is not None else None
+    report = {'inserted': 0, 'duplicates': 0, 'rejected': 0, 'errors': []}
+    pending = []
+    line_numbers = []
+
+    def reject(number, record, error):
+        report['rejected'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'line': number, 'id': str(record.get('_id', '')), 'error': error})
+
+    def flush():
+        if verification_key is not None:
+            valid = map_crypto(
+                verify_signature,
+                [(verification_key, record['ciphertext'], record['digital_signature']) for record in pending]
+            )
+            verified = []
+            for number, record, ok in zip(line_numbers, pending, valid):
+                if ok:
+                    verified.append(record)
+                else:
+                    reject(number, record, "La firma no corresponde al usuario")
+            pending[:] = verified
+        line_numbers.clear()
+        if not pending:
+            return
+
+        result = db.messages.bulk_write(
+            [UpdateOne({'_id': record['_id']}, {'$setOnInsert': record}, upsert=True) for record in pending],
+            ordered=False
+        )
+        report['inserted'] += result.upserted_count
+        report['duplicates'] += len(pending) - result.upserted_count
+        inserted_ids = set(result.upserted_ids.values())
+        inbox.record_imported_messages(db, [record for record in pending if record['_id'] in inserted_ids])
+        pending.clear()
+
+    header = None
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            record = json_util.loads(line, json_options=_JSON_OPTIONS)
+            if not isinstance(record, dict):
+                raise HistoryImportError("La línea no es un objeto JSON")
+        except (ValueError, TypeError, InvalidId) as e:
+            if header is None:
+                raise HistoryImportError(f"Encabezado inválido: {e}")
+            report['rejected'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': number, 'error': str(e)})
+            continue
+
+        if header is None:
+            if record.get('format') != FORMAT or record.get('version') != VERSION:
+                raise HistoryImportError(f"Se esperaba un encabezado {FORMAT} versión {VERSION}")
+            header = record
+            continue
+
+        try:
+            _validate(record, user_id, group_ids)
+        except HistoryImportError as e:
+            reject(number, record, str(e))
+            continue
+
+        pending.append(record)
+        line_numbers.append(number)
+        if len(pending) >= batch_size:
+            flush()
+
+    if header is None:
+        raise HistoryImportError("Archivo vacío: falta el encabezado")
+    if pending:
+        flush()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta o importa el historial de mensajes cifrados en NDJSON")
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"), help="URI de MongoDB (por defecto MONGODB_URI)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Escribe el historial en un archivo NDJSON")
+    export_parser.add_argument("--user", default=None, help="ID del usuario (por defecto, todos)")
+    export_parser.add_argument("--since", default=None, help="Sólo mensajes posteriores a este ID")
+    export_parser.add_argument("--output", default="-", help="Archivo de salida (por defecto, stdout)")
+    export_parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="Tamaño de lote del cursor")
+
+    import_parser = subparsers.add_parser("import", help="Carga un archivo NDJSON exportado")
+    import_parser.add_argument("--user", default=None, help="Sólo aceptar mensajes de este usuario")
+    import_parser.add_argument("--input", default="-", help="Archivo de entrada (por defecto, stdin)")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Mensajes por bulk_write")
+
+    args = parser.parse_args(argv)
+    if not args.uri:
+        parser.error("Se requiere --uri o la variable de entorno MONGODB_URI")
+    for value in (args.user, getattr(args, 'since', None)):
+        if value is not None and not ObjectId.is_valid(value):
+            parser.error(f"ID inválido: {value}")
+
+    db = get_db_from_uri(args.uri)
+
+    if args.command == "export":
+        since = ObjectId(args.since) if args.since else None
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        total = -1   # sin contar el encabezado
+        try:
+            for line in export_lines(db, args.user, since, args.batch_size):
+                output.write(line)
+                total += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        print(f"✅ Mensajes exportados: {total}", file=sys.stderr)
+        return 0
+
+    source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        report = import_lines(db, read_lines(source), args.user, args.batch_size)
+    except HistoryImportError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+    print(f"✅ Importados: {report['inserted']}  Duplicados: {report['duplicates']}  Rechazados: {report['rejected']}")
+    for error in report['errors']:
+        print(f"   línea {error['line']}: {error['error']}")
+    return 0 if not report['rejected'] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+from bson import ObjectId
+from flask import g, has_app_context
+from config.database import get_db
+
+
+class IdentityMap:
+    """
+    Mapa de identidad de una petición: guarda los usuarios y grupos ya leídos
+    para que las lecturas repetidas del mismo documento dentro de la misma
+    petición se sirvan desde memoria en lugar de volver a MongoDB.
+
+    Los documentos se comparten por referencia; quien modifica un usuario o
+    grupo en la base de datos debe actualizar el documento en memoria o
+    llamar a forget_user / forget_group.
+    """
+
+    def __init__(self, db=None):
+        self._db = db
+        self.users = {}    # str(_id) -> documento
+        self.groups = {}   # _id -> documento
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = get_db()
+        return self._db
+
+    def add_user(self, user):
+        if user is not None:
+            self.users[str(user['_id'])] = user
+        return user
+
+    def get_user(self, user_id):
+        key = str(user_id)
+        if key not in self.users:
+            user = self.db.users.find_one({'_id': ObjectId(key)}) if ObjectId.is_valid(key) else None
+            if user is None:
+                return None
+            self.users[key] = user
+        return self.users[key]
+
+    def get_users(self, user_ids):
+        """Devuelve {str(_id): documento} leyendo en una sola consulta los que falten"""
+        keys = {str(user_id) for user_id in user_ids}
+        missing = [ObjectId(key) for key in keys if key not in self.users and ObjectId.is_valid(key)]
+        if missing:
+            for user in self.db.users.find({'_id': {'$in': missing}}):
+                self.users[str(user['_id'])] = user
+        return {key: self.users[key] for key in keys if key in self.users}
+
+    def forget_user(self, user_id):
+        self.users.pop(str(user_id), None)
+
+    def add_group(self, group):
+        if group is not None:
+            self.groups[group['_id']] = group
+        return group
+
+    def get_group(self, group_id):
+        if group_id not in self.groups:
+            group = self.db.groups.find_one({'_id': group_id})
+            if group is None:
+                return None
+            self.groups[group_id] = group
+        return self.groups[group_id]
+
+    def forget_group(self, group_id):
+        self.groups.pop(group_id, None)
+
+
+def identity_map(db=None):
+    """
+    Devuelve el mapa de identidad de la petición actual (guardado en flask.g).
+    Fuera de un contexto de aplicación devuelve uno nuevo, sin compartir.
+    """
+    if not has_app_context():
+        return IdentityMap(db)
+
+    current = g.get('identity_map')
+    if current is None:
+        current = g.identity_map = IdentityMap(db)
+    return current
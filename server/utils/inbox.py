@@ -0,0 +1,269 @@
+'''
+Bandeja de entrada materializada (colección 'inbox').
+
+Un documento por conversación (directa o de grupo) con sus miembros, una
+referencia al último mensaje (id, emisor y fecha, nunca el contenido) y un
+contador de no leídos por miembro:
+
+    {
+        '_id': 'dm:<user_a>:<user_b>' | 'group:<group_id>',
+        'type': 'direct' | 'group',
+        'members': ['<user_id>', ...],
+        'group_id': '<group_id>', 'name': '<nombre del grupo>',   # sólo grupos
+        'last_message': {'id': ObjectId, 'sender_id': '<user_id>', 'timestamp': datetime},
+        'last_timestamp': datetime,
+        'unread': {'<user_id>': 3, ...},
+        'version': 12   # sube con cada mensaje guardado o importado (ETag del historial)
+    }
+
+Cada envío actualiza el documento con un solo update_one ($set del último
+mensaje y $inc del contador de cada destinatario), y GET /inbox lo lee con
+una consulta sobre el índice (members, last_timestamp). Es un dato
+derivado: si la actualización falla el mensaje ya está guardado, así que
+sólo se registra el error.
+
+Las conversaciones y grupos anteriores a la bandeja se cargan una vez con
+la herramienta de línea de comandos, fuera de las peticiones (se puede
+repetir y correr con la aplicación en marcha):
+    python -m utils.inbox backfill
+'''
+
+import argparse
+import os
+import sys
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import PyMongoError
+from blockchain.ledger import direct_chain_id, group_chain_id
+from config.database import get_db_from_uri
+
+load_dotenv()
+
+INBOX_PAGE_SIZE = int(os.getenv('INBOX_PAGE_SIZE', 100))
+INBOX_MAX_PAGE_SIZE = int(os.getenv('INBOX_MAX_PAGE_SIZE', 500))
+BACKFILL_BATCH_SIZE = 500
+
+_ready = False
+_ready_lock = threading.Lock()
+
+
+def _last_message(message):
+    return {
+        'id': message['_id'],
+        'sender_id': str(message['sender_id']),
+        'timestamp': message['timestamp']
+    }
+
+
+def _direct_update(message):
+    sender_id = str(message['sender_id'])
+    recipient_id = str(message['recipient_id'])
+    update = {
+        '$set': {
+            'type': 'direct',
+            'members': sorted({sender_id, recipient_id}),
+            'last_message': _last_message(message),
+            'last_timestamp': message['timestamp']
+        },
+        '$inc': {'version': 1}
+    }
+    if recipient_id != sender_id:
+        update['$inc'][f'unread.{recipient_id}'] = 1
+    return {'_id': direct_chain_id(sender_id, recipient_id)}, update
+
+
+def record_direct_message(db, message):
+    """Actualiza la conversación directa con un mensaje recién guardado"""
+    query, update = _direct_update(message)
+    try:
+        db.inbox.update_one(query, update, upsert=True)
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def record_direct_messages(db, messages):
+    """Como record_direct_message para muchos mensajes (envío múltiple), en un solo bulk_write"""
+    try:
+        for start in range(0, len(messages), BACKFILL_BATCH_SIZE):
+            batch = messages[start:start + BACKFILL_BATCH_SIZE]
+            db.inbox.bulk_write([UpdateOne(*_direct_update(m), upsert=True) for m in batch], ordered=False)
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def record_group_message(db, message, group):
+    """
+    Actualiza la conversación de un grupo con un mensaje recién guardado.
+    Los miembros se copian del grupo en cada envío.
+    """
+    sender_id = str(message['sender_id'])
+    update = {
+        '$set': {
+            'type': 'group',
+            'group_id': group['_id'],
+            'name': group['name'],
+            'members': list(group['members']),
+            'last_message': _last_message(message),
+            'last_timestamp': message['timestamp']
+        },
+        '$inc': {f'unread.{member_id}': 1 for member_id in group['members'] if member_id != sender_id}
+    }
+    update['$inc']['version'] = 1
+    try:
+        db.inbox.update_one({'_id': group_chain_id(group['_id'])}, update, upsert=True)
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def record_imported_messages(db, messages):
+    """
+    Refleja en la bandeja mensajes importados de un historial: crea las
+    conversaciones directas que falten y adelanta el último mensaje si el
+    importado es más reciente. No suma no leídos (es historial, no correo
+    nuevo), pero sí la versión: el historial cambió aunque los mensajes sean
+    anteriores al último.
+    """
+    latest = {}
+    for message in messages:
+        if message.get('is_group'):
+            key = group_chain_id(message['group_id'])
+        else:
+            key = direct_chain_id(message['sender_id'], message['recipient_id'])
+        if key not in latest or message['timestamp'] > latest[key]['timestamp']:
+            latest[key] = message
+
+    operations = []
+    for key, message in latest.items():
+        last = {'last_message': _last_message(message), 'last_timestamp': message['timestamp']}
+        if not message.get('is_group'):
+            # Conversación nueva: se crea con este mensaje como el último
+            members = sorted({str(message['sender_id']), str(message['recipient_id'])})
+            operations.append(UpdateOne(
+                {'_id': key},
+                {'$setOnInsert': dict(last, type='direct', members=members), '$inc': {'version': 1}},
+                upsert=True
+            ))
+        else:
+            # Grupos: sólo los que existen (su documento se crea con el grupo)
+            operations.append(UpdateOne({'_id': key}, {'$inc': {'version': 1}}))
+        operations.append(UpdateOne({'_id': key, 'last_timestamp': {'$lt': message['timestamp']}}, {'$set': last}))
+
+    try:
+        for start in range(0, len(operations), BACKFILL_BATCH_SIZE):
+            db.inbox.bulk_write(operations[start:start + BACKFILL_BATCH_SIZE])
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def record_group(db, group):
+    """Crea o actualiza la conversación de un grupo sin mensajes nuevos (alta, cambios de miembros)"""
+    members = list(group['members'])
+    try:
+        db.inbox.update_one(
+            {'_id': group_chain_id(group['_id'])},
+            {
+                '$set': {'type': 'group', 'group_id': group['_id'], 'name': group['name'], 'members': members},
+                '$setOnInsert': {'last_message': None, 'last_timestamp': group.get('created_at') or datetime.utcnow()}
+            },
+            upsert=True
+        )
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def remove_group_member(db, group_id, member_id):
+    try:
+        db.inbox.update_one(
+            {'_id': group_chain_id(group_id)},
+            {'$pull': {'members': member_id}, '$unset': {f'unread.{member_id}': ''}}
+        )
+    except PyMongoError as e:
+        print(f"⚠️ No se pudo actualizar la bandeja de entrada: {e}")
+
+
+def conversation_version(db, conversation_id):
+    """Versión del contenido de una conversación (None si todavía no tiene mensajes registrados)"""
+    entry = db.inbox.find_one({'_id': conversation_id}, {'version': 1})
+    return entry.get('version') if entry else None
+
+
+def mark_read(db, user_id, conversation_ids=None):
+    """
+    Pone en cero los no leídos del usuario en varias conversaciones (o en
+    todas si conversation_ids es None) con un solo update_many.
+
+    Returns:
+        int: Conversaciones que tenían mensajes sin leer
+    """
+    user_id = str(user_id)
+    query = {'members': user_id, f'unread.{user_id}': {'$gt': 0}}
+    if conversation_ids is not None:
+        query['_id'] = {'$in': list(conversation_ids)}
+    return db.inbox.update_many(query, {'$set': {f'unread.{user_id}': 0}}).modified_count
+
+
+def inbox_page(db, user_id, limit):
+    """Conversaciones del usuario, la más reciente primero"""
+    return list(
+        db.inbox.find({'members': str(user_id)})
+        .sort([('last_timestamp', DESCENDING), ('_id', DESCENDING)])
+        .limit(limit)
+    )
+
+
+def group_summaries(db, group_ids):
+    """Documentos de la bandeja de varios grupos (una consulta por _id), por group_id"""
+    keys = {group_chain_id(group_id): group_id for group_id in group_ids}
+    if not keys:
+        return {}
+    entries = db.inbox.find({'_id': {'$in': list(keys)}}, {'last_message': 1, 'unread': 1})
+    return {keys[entry['_id']]: entry for entry in entries}
+
+
+def ensure_inbox(db):
+    """Crea el índice de la bandeja (una vez por proceso)"""
+    global _ready
+    if _ready:
+        return
+    with _ready_lock:
+        if _ready:
+            return
+        db.inbox.create_index([('members', ASCENDING), ('last_timestamp', DESCENDING), ('_id', DESCENDING)])
+        _ready = True
+
+
+def backfill(db):
+    """
+    Carga en la bandeja las conversaciones y grupos anteriores a ella, sin
+    contadores de no leídos. Usa las mismas escrituras condicionales que la
+    importación de historial: nunca retrocede el último mensaje que haya
+    registrado un envío en curso.
+    """
+    ensure_inbox(db)
+    for group in db.groups.find({}, {'name': 1, 'members': 1, 'created_at': 1}):
+        record_group(db, group)
+
+    projection = {'sender_id': 1, 'recipient_id': 1, 'group_id': 1, 'is_group': 1, 'timestamp': 1}
+    query = {'$or': [{'is_group': True}, {'recipient_id': {'$exists': True}}]}
+    record_imported_messages(db, db.messages.find(query, projection).batch_size(BACKFILL_BATCH_SIZE))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mantenimiento de la bandeja de entrada")
+    parser.add_argument("--uri", default=os.getenv("MONGODB_URI"), help="URI de MongoDB (por defecto MONGODB_URI)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("backfill", help="Carga las conversaciones y grupos anteriores a la bandeja")
+
+    args = parser.parse_args(argv)
+    if not args.uri:
+        parser.error("Se requiere --uri o la variable de entorno MONGODB_URI")
+
+    backfill(get_db_from_uri(args.uri))
+    print("✅ Bandeja de entrada completada")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+'''
+Bus de invalidación de caches entre workers.
+
+Cada worker guarda en memoria caches de usuarios, llaves y grupos. Cuando
+otro worker modifica 'users', 'groups' o 'group_keys', este módulo se
+entera con un change stream de MongoDB y despacha eventos tipados a los
+caches registrados con subscribe(). El token de reanudación se guarda en
+memoria para retomar el stream tras una desconexión. Tras un reinicio no
+hay nada que retomar (los caches empiezan vacíos) y el stream empieza
+desde ahora, salvo que el worker tenga un nombre estable
+(INVALIDATION_CONSUMER): entonces el token se guarda en
+'invalidation_state', con un índice TTL sobre updated_at que borra los
+documentos de consumidores que ya no existen.
+
+Si MongoDB no soporta change streams (servidor standalone) se cae a un
+sondeo periódico por los campos de fecha de cada colección
+(users.updated_at, groups.last_activity, group_keys.added_at).
+
+Configuración:
+    INVALIDATION_MODE: auto (por defecto), changestream, poll u off
+    INVALIDATION_POLL_INTERVAL: segundos entre sondeos (modo poll)
+    INVALIDATION_CONSUMER: nombre estable del worker (por ejemplo su número
+        de slot) con el que se guarda el token de reanudación; sin él no se guarda
+    INVALIDATION_STATE_TTL: segundos sin actualizar tras los que se borra el
+        token guardado de un consumidor
+'''
+
+import os
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from config.database import get_db_from_uri
+
+INVALIDATION_MODE = os.getenv('INVALIDATION_MODE', 'auto')
+POLL_INTERVAL = float(os.getenv('INVALIDATION_POLL_INTERVAL', 2))
+CONSUMER = os.getenv('INVALIDATION_CONSUMER')
+TOKEN_SAVE_INTERVAL = float(os.getenv('INVALIDATION_TOKEN_SAVE_INTERVAL', 1))
+STATE_TTL = int(os.getenv('INVALIDATION_STATE_TTL', 86400))
+RECONNECT_DELAY_MAX = 30
+
+# Tipos de evento
+USER = 'user'
+GROUP = 'group'
+GROUP_KEY = 'group_key'
+ALL = 'all'   # se perdieron eventos: vaciar todo
+
+WATCHED_COLLECTIONS = ('users', 'groups', 'group_keys')
+
+# Códigos de MongoDB: change streams no soportados / historial de oplog perdido
+_CHANGE_STREAMS_UNSUPPORTED = (40573, 40324)
+_HISTORY_LOST = (136, 280, 286)
+
+# Campos de fecha que usa el modo de sondeo
+_POLL_FIELDS = {
+    'users': 'updated_at',
+    'groups': 'last_activity',
+    'group_keys': 'added_at'
+}
+
+
+class InvalidationEvent:
+    """
+    Evento de invalidación.
+
+    Attributes:
+        kind (str): USER, GROUP, GROUP_KEY o ALL
+        key (str): ID del usuario o grupo afectado (None si no se conoce)
+        operation (str): insert, update, replace, delete, poll o flush
+        user_id (str): En eventos GROUP_KEY, el usuario dueño de la llave si se conoce
+    """
+
+    __slots__ = ('kind', 'key', 'operation', 'user_id')
+
+    def __init__(self, kind, key, operation, user_id=None):
+        self.kind = kind
+        self.key = key
+        self.operation = operation
+        self.user_id = user_id
+
+    def __repr__(self):
+        return f"InvalidationEvent({self.kind}, {self.key}, {self.operation})"
+
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def subscribe(kinds, handler):
+    """
+    Registra un handler para uno o varios tipos de evento. Los eventos ALL
+    se entregan a todos los handlers registrados.
+
+    Args:
+        kinds (str | tuple): Tipo(s) de evento
+        handler (callable): Recibe un InvalidationEvent
+    """
+    if isinstance(kinds, str):
+        kinds = (kinds,)
+    with _handlers_lock:
+        for kind in kinds:
+            _handlers.setdefault(kind, []).append(handler)
+
+
+def dispatch(event):
+    """Entrega un evento a los handlers registrados para su tipo"""
+    with _handlers_lock:
+        if event.kind == ALL:
+            handlers = {id(h): h for hs in _handlers.values() for h in hs}.values()
+        else:
+            handlers = list(_handlers.get(event.kind, ()))
+
+    for handler in handlers:
+        try:
+            handler(event)
+        except Exception as e:
+            print(f"❌ Error en handler de invalidación {handler}: {e}")
+
+
+def events_from_change(change):
+    """
+    Traduce un evento de change stream a eventos de invalidación.
+    Un cambio en un grupo también invalida sus llaves (la rotación borra
+    y vuelve a crear todos los registros de group_keys).
+    """
+    collection = change.get('ns', {}).get('coll')
+    operation = change.get('operationType')
+    document_id = change.get('documentKey', {}).get('_id')
+
+    if operation in ('drop', 'dropDatabase', 'rename', 'invalidate'):
+        return [InvalidationEvent(ALL, None, operation)]
+
+    if collection == 'users':
+        return [InvalidationEvent(USER, str(document_id), operation)]
+
+    if collection == 'groups':
+        return [
+            InvalidationEvent(GROUP, str(document_id), operation),
+            InvalidationEvent(GROUP_KEY, str(document_id), operation)
+        ]
+
+    if collection == 'group_keys':
+        document = change.get('fullDocument') or {}
+        # En un delete sólo viene el _id del registro: no se sabe de qué grupo era
+        return [InvalidationEvent(GROUP_KEY, document.get('group_id'), operation, document.get('user_id'))]
+
+    return []
+
+
+class InvalidationBus:
+    def __init__(self, mode=INVALIDATION_MODE, consumer=CONSUMER, poll_interval=POLL_INTERVAL, uri=None):
+        self.mode = mode
+        self.uri = uri
+        # None: el token sólo vive en memoria
+        self.consumer = consumer
+        self.poll_interval = poll_interval
+        self._resume_token = None
+        self._token_dirty = False
+        self._last_token_save = 0.0
+        self._poll_since = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._db = None
+
+    @property
+    def db(self):
+        # El hilo del bus no tiene contexto de aplicación: conexión propia por URI
+        if self._db is None:
+            self._db = get_db_from_uri(self.uri)
+        return self._db
+
+    def _disconnect(self):
+        if self._db is not None:
+            self._db.client.close()
+            self._db = None
+
+    # --- ciclo de vida ---
+
+    def start(self):
+        '''Arranca el hilo del bus; sin uri, debe llamarse con contexto de aplicación'''
+        if self.mode == 'off' or (self._thread and self._thread.is_alive()):
+            return
+        if self.uri is None:
+            self.uri = current_app.config['MONGODB_URI']
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='invalidation-bus', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._save_token(force=True)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                if self.mode in ('auto', 'changestream'):
+                    self._watch()
+                else:
+                    self._poll_forever()
+                delay = 1
+            except OperationFailure as e:
+                if e.code in _CHANGE_STREAMS_UNSUPPORTED and self.mode == 'auto':
+                    print("⚠️ Change streams no disponibles: invalidación por sondeo")
+                    self.mode = 'poll'
+                    continue
+                if e.code in _HISTORY_LOST:
+                    # El token ya no está en el oplog: pudimos perder cambios
+                    print("⚠️ Token de reanudación expirado: se vacían los caches")
+                    self._resume_token = None
+                    self._token_dirty = False
+                    if self.consumer:
+                        self.db.invalidation_state.delete_one({'_id': self.consumer})
+                    dispatch(InvalidationEvent(ALL, None, 'flush'))
+                    continue
+                print(f"❌ Error en el bus de invalidación: {e}")
+            except PyMongoError as e:
+                print(f"❌ Conexión perdida en el bus de invalidación: {e}")
+                self._disconnect()
+            except Exception as e:
+                print(f"❌ Error inesperado en el bus de invalidación: {e}")
+            self._stop.wait(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    # --- change streams ---
+
+    def _load_token(self):
+        if not self.consumer:
+            return None
+        self.db.invalidation_state.create_index([('updated_at', ASCENDING)], expireAfterSeconds=STATE_TTL)
+        state = self.db.invalidation_state.find_one({'_id': self.consumer})
+        return state.get('resume_token') if state else None
+
+    def _save_token(self, force=False):
+        if not self._token_dirty or not self.consumer:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_token_save < TOKEN_SAVE_INTERVAL:
+            return
+        try:
+            self.db.invalidation_state.update_one(
+                {'_id': self.consumer},
+                {'$set': {'resume_token': self._resume_token, 'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+            self._token_dirty = False
+            self._last_token_save = now
+        except PyMongoError as e:
+            print(f"⚠️ No se pudo guardar el token de invalidación: {e}")
+
+    def _watch(self):
+        if self._resume_token is None:
+            self._resume_token = self._load_token()
+
+        pipeline = [{'$match': {'ns.coll': {'$in': list(WATCHED_COLLECTIONS)}}}]
+        with self.db.watch(pipeline, full_document='updateLookup', resume_after=self._resume_token) as stream:
+            print(f"👂 Bus de invalidación escuchando {', '.join(WATCHED_COLLECTIONS)}")
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    for event in events_from_change(change):
+                        dispatch(event)
+                if stream.resume_token is not None and stream.resume_token != self._resume_token:
+                    self._resume_token = stream.resume_token
+                    self._token_dirty = True
+                self._save_token()
+                if change is None:
+                    self._stop.wait(0.1)
+
+    # --- sondeo ---
+
+    def _poll_forever(self):
+        if not self._poll_since:
+            # Al pasar a sondeo no sabemos qué se perdió mientras tanto
+            dispatch(InvalidationEvent(ALL, None, 'flush'))
+            now = datetime.utcnow()
+            self._poll_since = {name: (now, set()) for name in WATCHED_COLLECTIONS}
+
+        while not self._stop.is_set():
+            self.poll_once()
+            self._stop.wait(self.poll_interval)
+
+    def poll_once(self):
+        '''Busca documentos modificados desde el último sondeo y despacha sus eventos'''
+        for collection, field in _POLL_FIELDS.items():
+            # (fecha más reciente vista, IDs ya vistos con esa fecha exacta)
+            since, seen = self._poll_since.get(collection) or (datetime.utcnow(), set())
+            projection = {field: 1, 'group_id': 1, 'user_id': 1}
+            for document in self.db[collection].find({field: {'$gte': since}}, projection):
+                stamp = document[field]
+                if stamp == since and document['_id'] in seen:
+                    continue
+                if stamp > since:
+                    since, seen = stamp, set()
+                seen.add(document['_id'])
+
+                change = {
+                    'ns': {'coll': collection},
+                    'operationType': 'poll',
+                    'documentKey': {'_id': document['_id']},
+                    'fullDocument': document
+                }
+                for event in events_from_change(change):
+                    dispatch(event)
+            self._poll_since[collection] = (since, seen)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def start_invalidation_bus():
+    """Arranca (una vez por proceso) el bus de invalidación configurado con INVALIDATION_MODE"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = InvalidationBus()
+        _bus.start()
+    return _bus
@@ -0,0 +1,123 @@
+'''
+Serialización JSON de las respuestas de la API.
+
+jsonify de este módulo reemplaza al de Flask en las rutas con el mismo
+formato de salida (ObjectId como string, fechas en formato HTTP como el
+encoder de Flask, claves ordenadas si JSON_SORT_KEYS) y un backend
+enchufable:
+
+    orjson: serializa en C, varias veces más rápido con listas grandes
+        (historiales, grupos, transacciones). Se usa si está instalado.
+    stdlib: módulo json de la biblioteca estándar con ChatJSONEncoder
+
+El tiempo de serialización de cada petición queda en g.json_seconds para
+las métricas por endpoint.
+
+Configuración:
+    JSON_BACKEND: auto (orjson si está disponible), orjson o stdlib
+'''
+
+import json
+import os
+import time
+from datetime import datetime
+from bson import ObjectId
+from flask import current_app, g, has_request_context
+from flask.json import JSONEncoder
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'auto')
+
+
+class ChatJSONEncoder(JSONEncoder):
+    """Encoder de Flask que además convierte ObjectId en string"""
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        return super().default(o)
+
+
+_encoder = ChatJSONEncoder()
+
+
+class StdlibBackend:
+    name = 'stdlib'
+
+    def dumps(self, obj, sort_keys=False, indent=None):
+        separators = None if indent else (',', ':')
+        return json.dumps(obj, cls=ChatJSONEncoder, sort_keys=sort_keys, indent=indent, separators=separators).encode('utf-8')
+
+
+class OrjsonBackend:
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson no está instalado")
+        self._fallback = StdlibBackend()
+
+    @staticmethod
+    def _default(o):
+        # Fechas en formato HTTP como Flask (orjson usaría RFC 3339)
+        if isinstance(o, datetime):
+            return http_date(o)
+        return _encoder.default(o)
+
+    def dumps(self, obj, sort_keys=False, indent=None):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=self._default, option=option)
+        except TypeError:
+            # Enteros de más de 64 bits u otros tipos que orjson no acepta
+            return self._fallback.dumps(obj, sort_keys, indent)
+
+
+def _default_backend():
+    if JSON_BACKEND == 'orjson' or (JSON_BACKEND == 'auto' and orjson is not None):
+        return OrjsonBackend()
+    return StdlibBackend()
+
+
+_backend = _default_backend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    """Cambia el backend: cualquier objeto con name y dumps(obj, sort_keys, indent) -> bytes"""
+    global _backend
+    _backend = backend
+
+
+def dumps(obj):
+    """Serializa obj a bytes con el backend actual y las opciones de la app"""
+    started = time.perf_counter()
+    config = current_app.config
+    indent = 2 if config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug else None
+    data = _backend.dumps(obj, sort_keys=config['JSON_SORT_KEYS'], indent=indent)
+    if has_request_context():
+        g.json_seconds = g.get('json_seconds', 0.0) + (time.perf_counter() - started)
+    return data
+
+
+def jsonify(*args, **kwargs):
+    """Como flask.jsonify, con el backend de este módulo"""
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return current_app.response_class(dumps(data) + b"\n", mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,128 @@
+'''
+Broker en memoria de mensajes nuevos para el stream SSE.
+
+Las rutas de envío publican aquí el documento recién guardado (cifrado)
+junto con la lista de usuarios que pueden verlo; cada conexión SSE abierta
+tiene una Subscription con una cola acotada de la que lee su generador y
+descifra para su usuario. Si un suscriptor lento llena su cola se marca
+como desbordado: el stream se cierra y el cliente se reconecta con
+Last-Event-ID, recuperando lo pendiente desde la base de datos.
+
+Un mismo mensaje puede publicarse más de una vez (desde la ruta de envío y
+desde el fan-out entre workers): el broker recuerda los IDs recientes y
+entrega cada uno una sola vez.
+
+Configuración:
+    SSE_QUEUE_SIZE: mensajes pendientes por conexión antes de desbordarse
+    SSE_HEARTBEAT: segundos entre comentarios keepalive
+    SSE_MAX_DURATION: segundos que dura una conexión antes de pedir reconexión
+    SSE_REPLAY_LIMIT: mensajes máximos a recuperar por Last-Event-ID
+'''
+
+import os
+import queue
+import threading
+from utils.cache import TTLCache
+
+SSE_QUEUE_SIZE = int(os.getenv('SSE_QUEUE_SIZE', 256))
+SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', 15))
+SSE_MAX_DURATION = float(os.getenv('SSE_MAX_DURATION', 300))
+SSE_REPLAY_LIMIT = int(os.getenv('SSE_REPLAY_LIMIT', 500))
+SSE_RETRY_MS = 3000
+DEDUP_SIZE = int(os.getenv('SSE_DEDUP_SIZE', 10000))
+DEDUP_TTL = 120
+
+
+class Subscription:
+    __slots__ = ('user_id', 'overflowed', '_queue')
+
+    def __init__(self, user_id, maxsize):
+        self.user_id = user_id
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize)
+
+    def put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.overflowed = True
+
+    def close(self):
+        # Mismo efecto que un desborde: el stream termina y el cliente se reconecta
+        self.overflowed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        '''Siguiente mensaje, o None si no llegó ninguno en timeout segundos'''
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class MessageBroker:
+    def __init__(self, queue_size=SSE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscriptions = {}   # user_id -> set(Subscription)
+        self._recent = TTLCache(maxsize=DEDUP_SIZE, ttl=DEDUP_TTL)   # IDs ya entregados
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscription = Subscription(str(user_id), self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(subscription.user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, message, audience):
+        '''
+        Entrega un mensaje guardado a las conexiones de los usuarios de audience
+
+        Args:
+            message (dict): Documento de 'messages' (con _id)
+            audience (iterable): IDs de los usuarios que pueden verlo
+        '''
+        with self._lock:
+            if self._recent.get(message['_id']):
+                return
+            self._recent.set(message['_id'], True)
+            targets = [
+                subscription
+                for user_id in {str(user_id) for user_id in audience}
+                for subscription in self._subscriptions.get(user_id, ())
+            ]
+        for subscription in targets:
+            subscription.put(message)
+
+    def disconnect_all(self):
+        with self._lock:
+            subscriptions = [s for subs in self._subscriptions.values() for s in subs]
+        for subscription in subscriptions:
+            subscription.close()
+
+    def connection_count(self):
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+broker = MessageBroker()
+
+
+def message_audience(message, group=None):
+    '''
+    Usuarios que pueden ver un mensaje: emisor y destinatario en los
+    directos, los miembros actuales del grupo en los grupales
+    '''
+    if message.get('is_group'):
+        return list(group['members']) if group else []
+    return [str(message['sender_id']), str(message['recipient_id'])]
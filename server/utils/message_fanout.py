@@ -0,0 +1,254 @@
+'''
+Fan-out de mensajes nuevos entre workers para el stream SSE.
+
+El broker en memoria sólo ve los mensajes enviados por su propio worker.
+Este módulo sigue un change stream sobre las inserciones de 'messages'
+(directas o de grupo) y entrega cada documento a las conexiones SSE
+abiertas en este worker, así cualquier worker puede atender a cualquier
+suscriptor sin sesiones pegajosas. Las rutas de envío siguen publicando
+localmente para no esperar al stream; el broker descarta el duplicado.
+
+El token de reanudación se guarda en memoria para retomar el stream tras
+una desconexión. Tras un reinicio el stream empieza desde ahora: las
+conexiones SSE murieron con el proceso y los clientes recuperan lo
+perdido con Last-Event-ID. Con un nombre estable de worker
+(MESSAGE_FANOUT_CONSUMER) el token se guarda además en 'fanout_state', con
+un índice TTL sobre updated_at que borra los de consumidores que ya no
+existen. Si el token ya no está en el oplog se cierran las conexiones
+abiertas: los clientes se reconectan con Last-Event-ID y recuperan lo
+perdido desde la base de datos.
+
+Si MongoDB no soporta change streams (servidor standalone) se cae a un
+sondeo periódico por messages.timestamp (con una ventana hacia atrás para
+las inserciones que otro worker confirma tarde).
+
+Configuración:
+    MESSAGE_FANOUT_MODE: auto (por defecto), changestream, poll o local
+        (local: sólo el broker del propio worker)
+    MESSAGE_FANOUT_POLL_INTERVAL: segundos entre sondeos (modo poll)
+    MESSAGE_FANOUT_CONSUMER: nombre estable del worker (por ejemplo su número
+        de slot) con el que se guarda el token de reanudación; sin él no se guarda
+    MESSAGE_FANOUT_STATE_TTL: segundos sin actualizar tras los que se borra el
+        token guardado de un consumidor
+'''
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from config.database import get_db_from_uri
+from utils import invalidation
+from utils.cache import TTLCache
+from utils.invalidation import _CHANGE_STREAMS_UNSUPPORTED, _HISTORY_LOST
+from utils.message_broker import broker, message_audience
+
+FANOUT_MODE = os.getenv('MESSAGE_FANOUT_MODE', 'auto')
+POLL_INTERVAL = float(os.getenv('MESSAGE_FANOUT_POLL_INTERVAL', 1))
+CONSUMER = os.getenv('MESSAGE_FANOUT_CONSUMER')
+TOKEN_SAVE_INTERVAL = float(os.getenv('MESSAGE_FANOUT_TOKEN_SAVE_INTERVAL', 1))
+STATE_TTL = int(os.getenv('MESSAGE_FANOUT_STATE_TTL', 86400))
+RECONNECT_DELAY_MAX = 30
+POLL_LOOKBACK = timedelta(seconds=float(os.getenv('MESSAGE_FANOUT_POLL_LOOKBACK', 5)))
+
+# Sólo inserciones de mensajes con destino (directo o grupo)
+PIPELINE = [{
+    '$match': {
+        'operationType': 'insert',
+        '$or': [
+            {'fullDocument.recipient_id': {'$exists': True}},
+            {'fullDocument.group_id': {'$exists': True}}
+        ]
+    }
+}]
+
+# Miembros por grupo para calcular la audiencia de los mensajes grupales
+group_members = TTLCache(
+    maxsize=int(os.getenv('MESSAGE_FANOUT_GROUP_CACHE_SIZE', 10000)),
+    ttl=float(os.getenv('MESSAGE_FANOUT_GROUP_CACHE_TTL', 60))
+)
+
+
+def _on_group_invalidation(event):
+    if event.kind == invalidation.ALL:
+        group_members.clear()
+    else:
+        group_members.pop(event.key)
+
+
+invalidation.subscribe(invalidation.GROUP, _on_group_invalidation)
+
+
+class MessageFanout:
+    def __init__(self, mode=FANOUT_MODE, consumer=CONSUMER, poll_interval=POLL_INTERVAL, uri=None):
+        self.mode = mode
+        self.uri = uri
+        # None: el token sólo vive en memoria
+        self.consumer = consumer
+        self.poll_interval = poll_interval
+        self._resume_token = None
+        self._token_dirty = False
+        self._last_token_save = 0.0
+        self._poll_since = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._db = None
+
+    @property
+    def db(self):
+        # El hilo del fan-out no tiene contexto de aplicación: conexión propia por URI
+        if self._db is None:
+            self._db = get_db_from_uri(self.uri)
+        return self._db
+
+    def _disconnect(self):
+        if self._db is not None:
+            self._db.client.close()
+            self._db = None
+
+    # --- ciclo de vida ---
+
+    def start(self):
+        '''Arranca el hilo del fan-out; sin uri, debe llamarse con contexto de aplicación'''
+        if self.mode == 'local' or (self._thread and self._thread.is_alive()):
+            return
+        if self.uri is None:
+            self.uri = current_app.config['MONGODB_URI']
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='message-fanout', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._save_token(force=True)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                if self.mode in ('auto', 'changestream'):
+                    self._watch()
+                else:
+                    self._poll_forever()
+                delay = 1
+            except OperationFailure as e:
+                if e.code in _CHANGE_STREAMS_UNSUPPORTED and self.mode == 'auto':
+                    print("⚠️ Change streams no disponibles: fan-out de mensajes por sondeo")
+                    self.mode = 'poll'
+                    continue
+                if e.code in _HISTORY_LOST:
+                    # Pudimos perder mensajes: que los clientes los recuperen con Last-Event-ID
+                    print("⚠️ Token de fan-out expirado: se cierran las conexiones SSE")
+                    self._resume_token = None
+                    self._token_dirty = False
+                    if self.consumer:
+                        self.db.fanout_state.delete_one({'_id': self.consumer})
+                    broker.disconnect_all()
+                    continue
+                print(f"❌ Error en el fan-out de mensajes: {e}")
+            except PyMongoError as e:
+                print(f"❌ Conexión perdida en el fan-out de mensajes: {e}")
+                self._disconnect()
+            except Exception as e:
+                print(f"❌ Error inesperado en el fan-out de mensajes: {e}")
+            self._stop.wait(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+    def deliver(self, message):
+        '''Entrega un mensaje insertado a las conexiones SSE de este worker'''
+        if not broker.connection_count():
+            return
+        group = None
+        if message.get('is_group'):
+            members = group_members.get(message['group_id'])
+            if members is None:
+                group = self.db.groups.find_one({'_id': message['group_id']}, {'members': 1})
+                members = group['members'] if group else []
+                group_members.set(message['group_id'], members)
+            group = {'members': members}
+        broker.publish(message, message_audience(message, group))
+
+    # --- change streams ---
+
+    def _load_token(self):
+        if not self.consumer:
+            return None
+        self.db.fanout_state.create_index([('updated_at', ASCENDING)], expireAfterSeconds=STATE_TTL)
+        state = self.db.fanout_state.find_one({'_id': self.consumer})
+        return state.get('resume_token') if state else None
+
+    def _save_token(self, force=False):
+        if not self._token_dirty or not self.consumer:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_token_save < TOKEN_SAVE_INTERVAL:
+            return
+        try:
+            self.db.fanout_state.update_one(
+                {'_id': self.consumer},
+                {'$set': {'resume_token': self._resume_token, 'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+            self._token_dirty = False
+            self._last_token_save = now
+        except PyMongoError as e:
+            print(f"⚠️ No se pudo guardar el token de fan-out: {e}")
+
+    def _watch(self):
+        if self._resume_token is None:
+            self._resume_token = self._load_token()
+
+        with self.db.messages.watch(PIPELINE, resume_after=self._resume_token) as stream:
+            print("👂 Fan-out de mensajes escuchando 'messages'")
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.deliver(change['fullDocument'])
+                if stream.resume_token is not None and stream.resume_token != self._resume_token:
+                    self._resume_token = stream.resume_token
+                    self._token_dirty = True
+                self._save_token()
+                if change is None:
+                    self._stop.wait(0.05)
+
+    # --- sondeo ---
+
+    def _poll_forever(self):
+        if self._poll_since is None:
+            self.db.messages.create_index([('timestamp', ASCENDING)])
+            self._poll_since = datetime.utcnow()
+
+        while not self._stop.is_set():
+            self.poll_once()
+            self._stop.wait(self.poll_interval)
+
+    def poll_once(self):
+        '''
+        Entrega los mensajes guardados desde el último sondeo. Se relee una
+        ventana de POLL_LOOKBACK: los repetidos los descarta el broker.
+        '''
+        since = self._poll_since or datetime.utcnow()
+        query = {'timestamp': {'$gte': since - POLL_LOOKBACK}}
+        for message in self.db.messages.find(query).sort('timestamp', 1):
+            since = max(since, message['timestamp'])
+            if 'recipient_id' in message or 'group_id' in message:
+                self.deliver(message)
+        self._poll_since = since
+
+
+_fanout = None
+_fanout_lock = threading.Lock()
+
+
+def start_message_fanout():
+    """Arranca (una vez por proceso) el fan-out configurado con MESSAGE_FANOUT_MODE"""
+    global _fanout
+    with _fanout_lock:
+        if _fanout is None:
+            _fanout = MessageFanout()
+        _fanout.start()
+    return _fanout
@@ -0,0 +1,117 @@
+import hmac
+import os
+from datetime import datetime
+import pyotp
+from utils.cache import TTLCache
+
+MFA_ISSUER = os.getenv('MFA_ISSUER', 'SecureChat')
+
+# QRs renderizados por URI de aprovisionamiento (la URI incluye el secreto: TTL corto)
+qr_cache = TTLCache(
+    maxsize=int(os.getenv('MFA_QR_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('MFA_QR_CACHE_TTL', 600))
+)
+
+# Códigos ya aceptados: un reintento del mismo código se rechaza sin calcular HMACs
+used_codes = TTLCache(maxsize=int(os.getenv('MFA_USED_CODES_CACHE_SIZE', 10000)), ttl=90)
+
+# Pasos de tiempo aceptados a cada lado del actual. 0 (por defecto) acepta sólo
+# el paso actual, como el totp.verify(otp) de antes; 1 tolera ±30 s de desfase
+# de reloj a cambio de una ventana de reutilización más larga.
+VALID_WINDOW = int(os.getenv('MFA_VALID_WINDOW', 0))
+
+
+def provisioning_uri(secret, email):
+    return pyotp.totp.TOTP(secret).provisioning_uri(name=email, issuer_name=MFA_ISSUER)
+
+
+def render_qr_svg(uri):
+    """
+    Renderiza el QR de una URI como SVG (sin PIL). Las filas se dibujan
+    como tramos horizontales unidos en un solo path.
+
+    Returns:
+        str: Documento SVG
+    """
+    cached = qr_cache.get(uri)
+    if cached is not None:
+        return cached
+
+    # Import diferido: el stack de QR sólo se carga si alguien configura MFA
+    import qrcode
+
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, border=4)
+    qr.add_data(uri)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                start = x
+                while x < len(row) and row[x]:
+                    x += 1
+                path.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+            else:
+                x += 1
+
+    size = len(matrix)
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+        f'width="{size * 10}" height="{size * 10}" shape-rendering="crispEdges">'
+        f'<rect width="100%" height="100%" fill="#fff"/>'
+        f'<path fill="#000" d="{"".join(path)}"/></svg>'
+    )
+    qr_cache.set(uri, svg)
+    return svg
+
+
+def verify_totp(db, user, otp, on_success=None):
+    """
+    Verifica un código TOTP y lo marca como usado.
+
+    El paso de tiempo aceptado se guarda en 'mfa_last_step' con una
+    actualización condicional, así un código (o uno anterior) no se puede
+    reutilizar aunque llegue a otro worker.
+
+    Args:
+        user (dict): Usuario con '_id' y 'mfa_secret'
+        otp (str): Código ingresado
+        on_success (dict): Campos a guardar en la misma actualización si el código es válido
+
+    Returns:
+        bool: True si el código es válido y no se había usado
+    """
+    otp = str(otp).strip()
+    secret = user.get('mfa_secret')
+    if not secret or not otp.isdigit():
+        return False
+
+    replay_key = (str(user['_id']), otp)
+    if used_codes.get(replay_key):
+        return False
+
+    totp = pyotp.TOTP(secret)
+    if len(otp) != totp.digits:
+        return False
+
+    current = totp.timecode(datetime.now())
+    step = None
+    for candidate in range(current - VALID_WINDOW, current + VALID_WINDOW + 1):
+        if hmac.compare_digest(totp.generate_otp(candidate), otp):
+            step = candidate
+            break
+    if step is None:
+        return False
+
+    result = db.users.update_one(
+        {
+            '_id': user['_id'],
+            '$or': [{'mfa_last_step': {'$exists': False}}, {'mfa_last_step': {'$lt': step}}]
+        },
+        {'$set': dict(on_success or {}, mfa_last_step=step)}
+    )
+    used_codes.set(replay_key, True, ttl=totp.interval * (2 * VALID_WINDOW + 1))
+    return result.modified_count == 1
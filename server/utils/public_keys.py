@@ -0,0 +1,81 @@
+import hashlib
+import os
+from bson import ObjectId
+from rsa_crypto.rsaCrypto import public_key_fingerprint
+from utils.cache import TTLCache
+from utils import invalidation
+
+# Máximo de usuarios por petición en GET /api/chat/users/keys
+BATCH_MAX = int(os.getenv('PUBLIC_KEY_BATCH_MAX', 100))
+
+# Las llaves públicas casi nunca cambian: TTL largo, el bus de invalidación avisa si cambian
+key_cache = TTLCache(
+    maxsize=int(os.getenv('PUBLIC_KEY_CACHE_SIZE', 50000)),
+    ttl=float(os.getenv('PUBLIC_KEY_CACHE_TTL', 3600))
+)
+
+_PROJECTION = {'email': 1, 'givenName': 1, 'familyName': 1, 'public_key': 1, 'signing_public_key': 1}
+
+
+def _entry(user):
+    """Entrada del directorio de llaves con sus huellas y su ETag"""
+    entry = {
+        'user_id': str(user['_id']),
+        'email': user['email'],
+        'name': f"{user['givenName']} {user['familyName']}",
+        'public_key': user['public_key'],
+        'fingerprints': {'public_key': public_key_fingerprint(user['public_key'])}
+    }
+    if 'signing_public_key' in user:
+        entry['signing_public_key'] = user['signing_public_key']
+        entry['fingerprints']['signing_public_key'] = public_key_fingerprint(user['signing_public_key'])
+
+    # El ETag cambia si cambia cualquiera de las llaves del usuario
+    material = '|'.join(f"{name}={fp}" for name, fp in sorted(entry['fingerprints'].items()))
+    entry['etag'] = f"key-{entry['user_id']}-{hashlib.sha256(material.encode()).hexdigest()[:32]}"
+    return entry
+
+
+def get_public_keys(db, user_ids):
+    """
+    Devuelve las llaves públicas de varios usuarios, desde el cache cuando
+    es posible y con una sola consulta para las que falten.
+
+    Args:
+        user_ids (list): IDs de usuario (str)
+
+    Returns:
+        dict: {user_id: entrada} sólo con los usuarios encontrados
+    """
+    found = {}
+    missing = []
+    for user_id in user_ids:
+        entry = key_cache.get(user_id)
+        if entry is not None:
+            found[user_id] = entry
+        elif ObjectId.is_valid(user_id):
+            missing.append(ObjectId(user_id))
+
+    if missing:
+        for user in db.users.find({'_id': {'$in': missing}}, _PROJECTION):
+            entry = _entry(user)
+            key_cache.set(entry['user_id'], entry)
+            found[entry['user_id']] = entry
+
+    return found
+
+
+def batch_etag(entries, not_found=()):
+    """ETag del lote: depende del conjunto de usuarios pedidos y de sus llaves"""
+    material = '|'.join(sorted(entry['etag'] for entry in entries)) + '#' + '|'.join(sorted(not_found))
+    return f"keys-{hashlib.sha256(material.encode()).hexdigest()[:32]}"
+
+
+def _on_user_invalidation(event):
+    if event.kind == invalidation.ALL:
+        key_cache.clear()
+    else:
+        key_cache.pop(event.key)
+
+
+invalidation.subscribe(invalidation.USER, _on_user_invalidation)
@@ -0,0 +1,158 @@
+'''
+Sincronización incremental de mensajes (POST /api/chat/sync).
+
+El cliente manda una marca (watermark) por conversación directa y por
+grupo, y una marca general 'since' para las conversaciones que no conoce;
+la respuesta trae sólo los mensajes posteriores de todas sus
+conversaciones, leídos en una sola consulta ordenada por _id.
+
+Las marcas son ObjectIds. Los _id se generan en cada worker, así que en el
+mismo segundo otro worker puede guardar un mensaje con un _id menor al
+último entregado: por eso las marcas devueltas nunca pasan de "ahora menos
+SYNC_SETTLE_SECONDS" (con la resolución de segundos del ObjectId). Los
+mensajes de esos últimos segundos pueden volver a llegar en la siguiente
+sincronización; el cliente los reconoce por id.
+
+Configuración:
+    SYNC_LIMIT: mensajes por respuesta por defecto (máximo SYNC_MAX_LIMIT)
+    SYNC_SETTLE_SECONDS: margen para inserciones concurrentes de otros workers
+'''
+
+import os
+import threading
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import ASCENDING
+
+SYNC_LIMIT = int(os.getenv('SYNC_LIMIT', 200))
+SYNC_MAX_LIMIT = int(os.getenv('SYNC_MAX_LIMIT', 1000))
+SYNC_MAX_WATERMARKS = 500
+SETTLE_SECONDS = float(os.getenv('SYNC_SETTLE_SECONDS', 2))
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+class SyncRequestError(ValueError):
+    pass
+
+
+def ensure_message_indexes(db):
+    """Índices de 'messages' para leer por conversación o grupo a partir de un _id (una vez por proceso)"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        if _indexes_ready:
+            return
+        db.messages.create_index([('sender_id', ASCENDING), ('recipient_id', ASCENDING), ('_id', ASCENDING)])
+        db.messages.create_index([('recipient_id', ASCENDING), ('_id', ASCENDING)])
+        db.messages.create_index([('group_id', ASCENDING), ('_id', ASCENDING)])
+        _indexes_ready = True
+
+
+def _watermark(value, field):
+    if value is None:
+        return None
+    if not isinstance(value, str) or not ObjectId.is_valid(value):
+        raise SyncRequestError(f"Marca inválida en {field}")
+    return ObjectId(value)
+
+
+def parse_sync_request(data):
+    """
+    Valida el cuerpo de la petición:
+
+        {
+            "since": "<id>" | null,
+            "conversations": {"<user_id>": "<id>" | null},
+            "groups": {"<group_id>": {"after": "<id>" | null, "key_version": 3}},
+            "limit": 200
+        }
+
+    Returns:
+        dict: since, conversations {ObjectId: ObjectId|None},
+            groups {group_id: (ObjectId|None, key_version|None)}, limit
+
+    Raises:
+        SyncRequestError: si algún campo es inválido
+    """
+    data = data or {}
+    conversations = data.get('conversations') or {}
+    groups = data.get('groups') or {}
+    if not isinstance(conversations, dict) or not isinstance(groups, dict):
+        raise SyncRequestError("'conversations' y 'groups' deben ser objetos")
+    if len(conversations) + len(groups) > SYNC_MAX_WATERMARKS:
+        raise SyncRequestError(f"Máximo {SYNC_MAX_WATERMARKS} marcas por petición")
+
+    parsed_conversations = {}
+    for user_id, value in conversations.items():
+        if not ObjectId.is_valid(user_id):
+            raise SyncRequestError(f"ID de usuario inválido: {user_id}")
+        parsed_conversations[ObjectId(user_id)] = _watermark(value, f"conversations.{user_id}")
+
+    parsed_groups = {}
+    for group_id, value in groups.items():
+        value = value if isinstance(value, dict) else {'after': value}
+        key_version = value.get('key_version')
+        if key_version is not None and not isinstance(key_version, int):
+            raise SyncRequestError(f"key_version inválida en groups.{group_id}")
+        parsed_groups[group_id] = (_watermark(value.get('after'), f"groups.{group_id}"), key_version)
+
+    try:
+        limit = min(max(1, int(data.get('limit', SYNC_LIMIT))), SYNC_MAX_LIMIT)
+    except (TypeError, ValueError):
+        raise SyncRequestError("'limit' debe ser un número")
+
+    return {
+        'since': _watermark(data.get('since'), 'since'),
+        'conversations': parsed_conversations,
+        'groups': parsed_groups,
+        'limit': limit
+    }
+
+
+def _after(watermark):
+    return {'_id': {'$gt': watermark}} if watermark is not None else {}
+
+
+def sync_query(user_id, sync, group_ids):
+    """
+    Filtro de los mensajes pendientes de todas las conversaciones del usuario:
+    una rama por conversación conocida, dos para las demás conversaciones
+    directas (desde 'since') y una por grupo del que es miembro.
+    """
+    me = ObjectId(user_id)
+    known = list(sync['conversations'])
+    direct = {'is_group': {'$ne': True}}
+
+    branches = [
+        dict(direct, sender_id=me, recipient_id={'$nin': known}, **_after(sync['since'])),
+        dict(direct, recipient_id=me, sender_id={'$nin': known}, **_after(sync['since']))
+    ]
+    for peer, watermark in sync['conversations'].items():
+        branches.append(dict(direct, sender_id=me, recipient_id=peer, **_after(watermark)))
+        branches.append(dict(direct, sender_id=peer, recipient_id=me, **_after(watermark)))
+    for group_id in group_ids:
+        watermark = sync['groups'].get(group_id, (sync['since'], None))[0]
+        branches.append(dict(group_id=group_id, is_group=True, **_after(watermark)))
+
+    return {'$or': branches}
+
+
+def settled_cap(last_returned, truncated, now=None):
+    """
+    Hasta dónde pueden avanzar las marcas: si la respuesta se cortó por el
+    límite, hasta el último mensaje entregado; nunca más allá del margen de
+    inserciones concurrentes.
+    """
+    settled = ObjectId.from_datetime((now or datetime.utcnow()) - timedelta(seconds=SETTLE_SECONDS))
+    if truncated and last_returned < settled:
+        return last_returned
+    return settled
+
+
+def advance(watermark, cap):
+    if watermark is None:
+        return cap
+    return max(watermark, cap)